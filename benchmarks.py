@@ -0,0 +1,450 @@
+"""
+Benchmarks for the logic gate simulation
+
+Run "python benchmarks.py" for the default sizes, or pass gate counts on
+the command line, e.g. "python benchmarks.py 1000 1000000".
+"""
+
+import sys
+import time
+
+from logic_gate_part2 import (Circuit, NotGate, build_full_adder,
+                              build_random_logic, build_ripple_adder,
+                              full_adder)
+
+DEFAULT_SIZES = [10 ** 3, 10 ** 4, 10 ** 5]
+
+# Bytes per gate bench_memory measured before Input, Output and the gate
+# classes had __slots__ (each instance had a __dict__, and every Output its
+# own fanout list), for the same 100k-gate chains
+MEMORY_BASELINE = {"NotGate": 802, "AndGate": 898}
+
+
+def build_chain(circuit, length):
+    """Wire length NOT gates in series; return (first_input, last_output)"""
+    first = previous = NotGate("not0", circuit)
+    for i in range(1, length):
+        gate = NotGate(f"not{i}", circuit)
+        previous.output.connect(gate.input)
+        previous = gate
+    return first.input, previous.output
+
+
+def time_per_call(function, min_time=0.2):
+    """Return the average seconds per call of function()"""
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - start
+    return elapsed / calls
+
+
+def bench_compiled(sizes):
+    """Object model (scheduled) versus CompiledCircuit.run
+
+    Each object model call applies one stimulus that changes every gate;
+    each compiled call evaluates the whole circuit for one input vector.
+    """
+    print("Compiled interpreter vs object model")
+    print(f"{'circuit':>10} {'gates':>9} {'objects':>12} {'compiled':>12} "
+          f"{'speedup':>8}")
+    for size in sizes:
+        circuit = Circuit(Circuit.SCHEDULED)
+        first, _ = build_chain(circuit, size)
+        toggle = [False]
+
+        def object_model():
+            toggle[0] = not toggle[0]
+            first.value = toggle[0]
+
+        compiled = circuit.compile()
+        _report("chain", size, time_per_call(object_model),
+                time_per_call(lambda: compiled.run([toggle[0]])))
+
+        circuit = Circuit(Circuit.SCHEDULED)
+        a_ports, b_ports, ci_inputs, _, _ = build_ripple_adder(circuit,
+                                                               size // 5)
+        # Give every input a value first, then measure one stimulus: a
+        # carry-in toggle.  a = all ones and b = 0, so the toggle ripples
+        # through the whole adder
+        ones = {input_ for port in a_ports for input_ in port}
+        for port in a_ports + b_ports:
+            for input_ in port:
+                input_.value = input_ in ones
+
+        def object_model():
+            toggle[0] = not toggle[0]
+            for input_ in ci_inputs:
+                input_.value = toggle[0]
+
+        compiled = circuit.compile()
+        values = [input_ in ones or (input_ in ci_inputs and toggle[0])
+                  for input_ in compiled.inputs]
+        _report("adder", 5 * (size // 5), time_per_call(object_model),
+                time_per_call(lambda: compiled.run(values)))
+
+
+def bench_codegen():
+    """Generated full adder function versus rebuilding full_adder"""
+    import contextlib
+    import io
+
+    circuit = Circuit()
+    build_full_adder(circuit)
+    evaluate = circuit.to_function()
+    generated = time_per_call(
+        lambda: evaluate(True, False, True, True, False, True))
+    with contextlib.redirect_stdout(io.StringIO()):
+        # full_adder prints its intermediate gates
+        rebuilt = time_per_call(lambda: full_adder(True, False, True))
+    print("Full adder evaluation")
+    print(f"  full_adder():       {rebuilt * 1e9:>10.0f}ns")
+    print(f"  generated function: {generated * 1e9:>10.0f}ns")
+
+
+def build_decoder(circuit, bits, wide):
+    """Wire a bits-to-2**bits decoder: one AND of bits literals per output.
+
+    With wide=True each AND is a single NaryAndGate, otherwise a chain of
+    two-input AndGates.  Returns the select inputs (one tuple per bit).
+    """
+    from logic_gate_part2 import AndGate, NaryAndGate
+
+    inverters = [NotGate(f"not{bit}", circuit) for bit in range(bits)]
+    selects = [[inverter.input] for inverter in inverters]
+    for code in range(1 << bits):
+        literals = []
+        for bit in range(bits):
+            literals.append(None if (code >> bit) & 1
+                            else inverters[bit].output)
+        if wide:
+            gate = NaryAndGate(f"out{code}", circuit, bits)
+            inputs = gate.inputs
+        else:
+            gates = [AndGate(f"out{code}.{k}", circuit)
+                     for k in range(bits - 1)]
+            for gate, following in zip(gates, gates[1:]):
+                gate.output.connect(following.input0)
+            inputs = [gates[0].input0] + [gate.input1 for gate in gates]
+        for bit, (input_, literal) in enumerate(zip(inputs, literals)):
+            if literal is None:
+                selects[bit].append(input_)
+            else:
+                literal.connect(input_)
+    return [tuple(inputs) for inputs in selects]
+
+
+def bench_wide_gates(bits=6):
+    """A decoder built from NaryAndGates versus chains of AndGates"""
+    print(f"{bits}-to-{1 << bits} decoder")
+    print(f"{'form':>10} {'gates':>6} {'cost':>6} {'objects':>10} "
+          f"{'compiled':>10} {'generated':>10}")
+    for wide in (False, True):
+        circuit = Circuit(Circuit.SCHEDULED)
+        selects = build_decoder(circuit, bits, wide)
+        for group in selects:
+            for input_ in group:
+                input_.value = False
+        code = [0]
+
+        def object_model():
+            # Count through the codes, one select line changing per step
+            code[0] += 1
+            bit = (code[0] & -code[0]).bit_length() - 1
+            for input_ in selects[bit % bits]:
+                input_.value = not input_.value
+
+        compiled = circuit.compile()
+        values = [False] * len(compiled.inputs)
+        evaluate = compiled.to_function()
+        print(f"{'wide' if wide else 'chains':>10} {len(circuit):>6} "
+              f"{circuit.cost:>6} "
+              f"{time_per_call(object_model) * 1e6:>8.1f}us "
+              f"{time_per_call(lambda: compiled.run(values)) * 1e6:>8.1f}us "
+              f"{time_per_call(lambda: evaluate(*values)) * 1e6:>8.1f}us")
+
+
+def bench_lut_mapping(inputs=64, gates=5000, bits=256):
+    """Circuits as gates versus mapped to LUT-4 and LUT-6 cells
+
+    Random logic gets one random input vector per call: through the
+    scheduled object model, CompiledCircuit.run and the generated
+    function.  A ripple carry adder gets a carry-in toggle per call, which
+    ripples through every level of the scheduled object model.
+    """
+    import random
+
+    from logic_gate_compiled import CompiledCircuit
+
+    print(f"Random logic, {inputs} inputs, {gates} gates")
+    print(f"{'form':>10} {'gates':>6} {'depth':>6} {'objects':>10} "
+          f"{'compiled':>10} {'generated':>10}")
+    original = Circuit(Circuit.SCHEDULED)
+    build_random_logic(original, inputs, gates)
+    rng = random.Random(1)
+    vectors = [{name: rng.random() < 0.5 for name in original.input_ports()}
+               for _ in range(64)]
+    for k in (None, 4, 6):
+        circuit = original if k is None else original.map_luts(k)[0]
+        # Compiled from the store, so there is one value per input port
+        compiled = CompiledCircuit.from_store(circuit.to_store())
+        evaluate = compiled.to_function()
+        rows = [[vector[name] for name in compiled.inputs]
+                for vector in vectors]
+        step = [0]
+
+        def object_model():
+            step[0] += 1
+            circuit.set_inputs(vectors[step[0] % len(vectors)])
+
+        def run():
+            step[0] += 1
+            compiled.run(rows[step[0] % len(rows)])
+
+        def generated():
+            step[0] += 1
+            evaluate(*rows[step[0] % len(rows)])
+
+        print(f"{'gates' if k is None else f'LUT-{k}':>10} "
+              f"{len(circuit):>6} {circuit.depth:>6} "
+              f"{time_per_call(object_model) * 1e3:>8.2f}ms "
+              f"{time_per_call(run) * 1e3:>8.2f}ms "
+              f"{time_per_call(generated) * 1e3:>8.2f}ms")
+
+    print(f"{bits}-bit ripple carry adder, carry-in toggle")
+    print(f"{'form':>10} {'gates':>6} {'depth':>6} {'objects':>10}")
+    original = Circuit(Circuit.SCHEDULED)
+    a_ports, b_ports, ci_inputs, _, _ = build_ripple_adder(original, bits)
+    for i, (a_inputs, b_inputs) in enumerate(zip(a_ports, b_ports)):
+        original.add_input_port(f"a{i}", *a_inputs)
+        original.add_input_port(f"b{i}", *b_inputs)
+    original.add_input_port("ci", *ci_inputs)
+    # a = all ones and b = 0, so the carry-in ripples to the carry-out
+    original.set_inputs({name: name.startswith("a")
+                         for name in original.input_ports()})
+    for k in (None, 4, 6):
+        circuit = original if k is None else original.map_luts(k)[0]
+        toggle = [False]
+
+        def object_model():
+            toggle[0] = not toggle[0]
+            circuit.set_inputs({"ci": toggle[0]})
+
+        print(f"{'gates' if k is None else f'LUT-{k}':>10} "
+              f"{len(circuit):>6} {circuit.depth:>6} "
+              f"{time_per_call(object_model) * 1e3:>8.2f}ms")
+
+
+def bench_optimize(inputs=64, gates=5000, bits=64):
+    """Circuits before and after Circuit.optimize, with and without aig
+
+    Each call applies one random input vector through the scheduled
+    object model.  The adder adds a constant: its b inputs are unported
+    constants, so constant propagation removes most of it.
+    """
+    import random
+
+    print(f"{'circuit':>10} {'form':>10} {'gates':>6} {'cost':>7} "
+          f"{'depth':>6} {'objects':>10}")
+    random_logic = Circuit(Circuit.SCHEDULED)
+    build_random_logic(random_logic, inputs, gates)
+    adder = Circuit(Circuit.SCHEDULED)
+    a_ports, b_ports, ci_inputs, _, _ = build_ripple_adder(adder, bits)
+    for i, (a_inputs, b_inputs) in enumerate(zip(a_ports, b_ports)):
+        adder.add_input_port(f"a{i}", *a_inputs)
+        for input_ in b_inputs:
+            input_.value = bool((0x5DEECE66D >> i) & 1)
+    for input_ in ci_inputs:
+        input_.value = False
+    rng = random.Random(1)
+    for kind, original in (("random", random_logic), ("adder", adder)):
+        vectors = [{name: rng.random() < 0.5
+                    for name in original.input_ports()} for _ in range(64)]
+        for form in ("gates", "optimized", "aig"):
+            circuit = (original if form == "gates"
+                       else original.optimize(form == "aig")[0])
+            step = [0]
+
+            def object_model():
+                step[0] += 1
+                circuit.set_inputs(vectors[step[0] % len(vectors)])
+
+            print(f"{kind:>10} {form:>10} {len(circuit):>6} "
+                  f"{circuit.cost:>7} {circuit.depth:>6} "
+                  f"{time_per_call(object_model) * 1e3:>8.2f}ms")
+
+
+def bench_equivalence(bits=32, multiplier_bits=8, max_conflicts=20000):
+    """SAT (with and without sweeping) versus BDD equivalence checks
+
+    Each circuit is checked against its aig=True optimization, its LUT-6
+    mapping, and the mapping with one connection cut (not equivalent).
+    The plain miter, without sweeping, gives up after max_conflicts.
+    """
+    from logic_gate_bdd import equivalent
+    from logic_gate_part2 import build_array_multiplier
+    from logic_gate_sat import check_equivalence
+
+    adder = Circuit()
+    a_ports, b_ports, ci_inputs, sums, carry = build_ripple_adder(adder, bits)
+    multiplier = Circuit()
+    x_ports, y_ports, products = build_array_multiplier(multiplier,
+                                                        multiplier_bits)
+    for circuit, pairs, outputs in ((adder, zip(a_ports, b_ports),
+                                     list(sums) + [carry]),
+                                    (multiplier, zip(x_ports, y_ports),
+                                     products)):
+        for i, (a_inputs, b_inputs) in enumerate(pairs):
+            circuit.add_input_port(f"a{i}", *a_inputs)
+            circuit.add_input_port(f"b{i}", *b_inputs)
+        for i, output in enumerate(outputs):
+            circuit.add_output_port(f"s{i}", output)
+    adder.add_input_port("ci", *ci_inputs)
+
+    print(f"{'circuit':>12} {'other':>8} {'equal':>6} {'sweep':>10} "
+          f"{'no sweep':>10} {'bdd':>10}")
+    for kind, original in ((f"{bits}-bit adder", adder),
+                           (f"{multiplier_bits}x{multiplier_bits} mult",
+                            multiplier)):
+        buggy, _ = original.map_luts(6)
+        # Cut one connection near the outputs and tie the input to 1
+        input_ = next(input_ for gate in reversed(buggy.topological_order())
+                      for input_ in gate.inputs if input_.driver is not None)
+        input_.driver.disconnect(input_)
+        input_.value = True
+        for form, other in (("aig", original.optimize(aig=True)[0]),
+                            ("LUT-6", original.map_luts(6)[0]),
+                            ("buggy", buggy)):
+            cells = []
+            for check in (lambda: check_equivalence(original, other)[0],
+                          lambda: check_equivalence(
+                              original, other, max_conflicts,
+                              sweep=False)[0],
+                          lambda: equivalent(original, other)):
+                start = time.perf_counter()
+                result = check()
+                seconds = time.perf_counter() - start
+                cells.append(f"{'gave up':>10}" if result is None
+                             else f"{seconds:>9.3f}s")
+            print(f"{kind:>12} {form:>8} {str(result):>6} "
+                  + " ".join(cells))
+
+
+def build_state_machine(circuit, bits, inputs, gates, seed=0):
+    """Wire random next-state logic for a bits-wide Register into circuit
+
+    Gates read the register, input ports x0, x1, ... or one of the 64 gates
+    before them, like build_random_logic; the last bits gates drive the
+    register, which is returned.
+    """
+    import random
+
+    from logic_gate_part2 import AndGate, OrGate, Register, XorGate
+
+    rng = random.Random(seed)
+    kinds = (AndGate, OrGate, XorGate, AndGate, OrGate, NotGate)
+    register = Register("state", circuit, bits, rng.getrandbits(bits))
+    ports = [[] for _ in range(inputs)]
+    outputs = []
+    for index in range(gates):
+        gate = rng.choice(kinds)(f"g{index}", circuit)
+        for input_ in gate.inputs:
+            choice = rng.randrange(bits + inputs + min(len(outputs), 64))
+            if choice < bits:
+                register.q[choice].connect(input_)
+            elif choice < bits + inputs:
+                ports[choice - bits].append(input_)
+            else:
+                outputs[bits + inputs - choice - 1].connect(input_)
+        outputs.append(gate.output)
+    for index, port in enumerate(ports):
+        circuit.add_input_port(f"x{index}", *port)
+    for output, d in zip(outputs[-bits:], register.d):
+        output.connect(d)
+    for index, output in enumerate(outputs[-bits:]):
+        circuit.add_output_port(f"y{index}", output)
+    return register
+
+
+def bench_sequential(bits=64, inputs=8, gates=5000, width=64):
+    """Clocked simulation: Circuit.clock versus CycleSimulator.run
+
+    Each cycle applies one random value to every input port.  The object
+    model (scheduled) only evaluates the gates whose inputs changed; the
+    simulator evaluates every gate once per cycle, and with width > 1 runs
+    that many simulations at once.
+    """
+    import random
+
+    print(f"State machine, {bits} flip-flops, {gates} gates")
+    print(f"{'form':>16} {'cycles/s':>10} {'gate evals/s':>14}")
+    circuit = Circuit(Circuit.SCHEDULED)
+    build_state_machine(circuit, bits, inputs, gates)
+    rng = random.Random(1)
+    stimulus = [{f"x{i}": rng.random() < 0.5 for i in range(inputs)}
+                for _ in range(256)]
+    step = [0]
+
+    def object_model():
+        step[0] += 1
+        circuit.set_inputs(stimulus[step[0] % len(stimulus)])
+        circuit.clock()
+
+    seconds = time_per_call(object_model)
+    print(f"{'objects':>16} {1 / seconds:>10.0f} {gates / seconds:>14.3g}")
+    for lanes in (1, width):
+        simulator = circuit.simulator(lanes)
+        vectors = ([{name: rng.getrandbits(lanes) for name in vector}
+                    for vector in stimulus] if lanes > 1 else stimulus)
+        seconds = time_per_call(
+            lambda: simulator.run(len(vectors), vectors)) / len(vectors)
+        print(f"{f'simulator x{lanes}':>16} {1 / seconds:>10.0f} "
+              f"{gates * lanes / seconds:>14.3g}")
+
+
+def bench_memory(count=100000):
+    """Bytes allocated per gate for chains of NOT gates and of AND gates
+
+    Printed next to MEMORY_BASELINE, the figures from before __slots__.
+    """
+    import tracemalloc
+
+    from logic_gate_part2 import AndGate
+
+    print("Memory per gate (bytes)")
+    print(f"{'gate':>10} {'before':>8} {'now':>8} {'saved':>7}")
+    for kind in (NotGate, AndGate):
+        tracemalloc.start()
+        circuit = Circuit()
+        previous = None
+        for i in range(count):
+            gate = kind(f"g{i}", circuit)
+            if previous is not None:
+                previous.output.connect(gate.inputs[0])
+            previous = gate
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        before = MEMORY_BASELINE[kind.__name__]
+        print(f"{kind.__name__:>10} {before:>8} {size / count:>8.0f} "
+              f"{1 - size / count / before:>7.0%}")
+        del circuit, gate, previous
+
+
+def _report(kind, gates, objects, compiled):
+    print(f"{kind:>10} {gates:>9} {objects * 1e3:>10.3f}ms "
+          f"{compiled * 1e3:>10.3f}ms {objects / compiled:>7.1f}x")
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    bench_compiled(sizes)
+    bench_codegen()
+    bench_wide_gates()
+    bench_lut_mapping()
+    bench_optimize()
+    bench_equivalence()
+    bench_sequential()
+    bench_memory()
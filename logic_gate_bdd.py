@@ -0,0 +1,677 @@
+"""
+Binary decision diagrams for logic gate circuits (see logic_gate_part2.py)
+
+A BDD manager holds reduced ordered BDDs: every node tests one variable
+and has a low (variable 0) and a high (variable 1) child, variables are
+tested in the same order on every path, and a unique table makes sure no
+two nodes have the same variable and children.  Each Boolean function
+over the manager's variables is then exactly one node, so two circuits
+are equivalent when their outputs are the same node, however wide they
+are; counting solutions and writing out truth tables walk the nodes once.
+
+- ite(f, g, h) (if f then g else h) builds everything, and remembers its
+  results in a computed table of fixed size: a new result evicts the old
+  one in the same slot;
+- swap() exchanges two adjacent variables in place, so node numbers keep
+  their meaning, and reorder() sifts every variable to the position where
+  the BDDs are smallest;
+- circuit_bdds() builds the BDD of every output port of a Circuit, and
+  equivalent(), count_solutions() and truth_table() are built on it.
+"""
+
+from logic_gate_part2 import (Input, OP_AND, OP_LUT, OP_NAND, OP_NOR, OP_NOT,
+                              OP_OR, OP_XNOR, Output, X)
+
+# Computed table slots; a power of two
+CACHE_SIZE = 1 << 16
+
+# circuit_bdds frees unused nodes (and may reorder the variables) when the
+# manager first holds this many nodes, then whenever it has doubled since
+# the last time
+REORDER_THRESHOLD = 1 << 14
+
+# Sifting gives up on a direction once the BDDs grow by this factor, and
+# stops after this many swaps
+MAX_GROWTH = 1.2
+MAX_SWAPS = 5000
+
+
+class BDD:
+    """A manager of reduced ordered BDDs.
+
+    Nodes are ints: 0 and 1 are the constants, and the other nodes are
+    only meaningful to the manager that made them.  Variables are named by
+    any hashable and ordered by level, the first variable on top.
+    """
+
+    FALSE = 0
+    TRUE = 1
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        if cache_size & (cache_size - 1) or cache_size < 1:
+            raise ValueError("The cache size must be a power of two")
+        # Variable, low and high child of every node; the constants have
+        # variable None and free nodes variable -1
+        self._var = [None, None]
+        self._low = [0, 1]
+        self._high = [0, 1]
+        self._free = []
+        # Per variable, (low, high) -> node
+        self._unique = []
+        self._names = []
+        self._variables = {}
+        # Variable -> level and level -> variable
+        self._level = []
+        self._order = []
+        self._cache = [None] * cache_size
+        self._cache_mask = cache_size - 1
+        # References to each node, only while reordering
+        self._refs = None
+
+    def __len__(self):
+        """The number of nodes allocated, including the constants"""
+        return len(self._var) - len(self._free)
+
+    @property
+    def variables(self):
+        """The variable names, in order from the top level down"""
+        return [self._names[variable] for variable in self._order]
+
+    def var(self, name):
+        """Return the node of variable name, adding it below the others"""
+        variable = self._variables.get(name)
+        if variable is None:
+            variable = self._variables[name] = len(self._names)
+            self._names.append(name)
+            self._unique.append({})
+            self._level.append(len(self._order))
+            self._order.append(variable)
+        return self._make(variable, 0, 1)
+
+    def _make(self, variable, low, high):
+        if low == high:
+            return low
+        unique = self._unique[variable]
+        node = unique.get((low, high))
+        if node is None:
+            if self._free:
+                node = self._free.pop()
+                self._var[node] = variable
+                self._low[node] = low
+                self._high[node] = high
+            else:
+                node = len(self._var)
+                self._var.append(variable)
+                self._low.append(low)
+                self._high.append(high)
+            unique[(low, high)] = node
+            if self._refs is not None:
+                # Counting references while reordering
+                if node == len(self._refs):
+                    self._refs.append(0)
+                self._refs[node] = 0
+                self._refs[low] += 1
+                self._refs[high] += 1
+        return node
+
+    def _top(self, node):
+        # The level of node; the constants are below every variable
+        variable = self._var[node]
+        return len(self._order) if variable is None else self._level[variable]
+
+    def ite(self, f, g, h):
+        """Return the node of: if f then g else h"""
+        if f <= 1:
+            return g if f else h
+        if g == h:
+            return g
+        if g == f:
+            g = 1
+        if h == f:
+            h = 0
+        if g == 1 and h == 0:
+            return f
+        key = (f, g, h)
+        slot = hash(key) & self._cache_mask
+        entry = self._cache[slot]
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        level = min(self._top(f), self._top(g), self._top(h))
+        variable = self._order[level]
+        cofactors = []
+        for node in key:
+            if self._var[node] == variable:
+                cofactors.append((self._low[node], self._high[node]))
+            else:
+                cofactors.append((node, node))
+        (f0, f1), (g0, g1), (h0, h1) = cofactors
+        result = self._make(variable, self.ite(f0, g0, h0),
+                            self.ite(f1, g1, h1))
+        self._cache[slot] = (key, result)
+        return result
+
+    def not_(self, f):
+        return self.ite(f, 0, 1)
+
+    def and_(self, f, g):
+        return self.ite(f, g, 0)
+
+    def or_(self, f, g):
+        return self.ite(f, 1, g)
+
+    def xor(self, f, g):
+        return self.ite(f, self.not_(g), g)
+
+    def lut(self, table, nodes):
+        """Return the node of a LUT with truth table table over nodes"""
+        count = len(nodes)
+        if table == 0 or table == (1 << (1 << count)) - 1:
+            return 1 if table else 0
+        half = 1 << (count - 1)
+        low = self.lut(table & ((1 << half) - 1), nodes[:-1])
+        high = self.lut(table >> half, nodes[:-1])
+        return self.ite(nodes[-1], high, low)
+
+    def support(self, f):
+        """Return the names of the variables f depends on, in order"""
+        variables = {self._var[node] for node in self._nodes([f])}
+        return [self._names[variable] for variable in self._order
+                if variable in variables]
+
+    def _nodes(self, roots):
+        # The non-constant nodes reachable from roots
+        seen = set()
+        pending = [root for root in roots if root > 1]
+        while pending:
+            node = pending.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            for child in (self._low[node], self._high[node]):
+                if child > 1:
+                    pending.append(child)
+        return seen
+
+    def size(self, roots):
+        """The number of nodes of the BDDs of roots, without constants"""
+        return len(self._nodes(roots))
+
+    def count(self, f):
+        """The number of assignments of all the variables that satisfy f"""
+        counts = {0: 0, 1: 1}
+        pending = [f]
+        while pending:
+            node = pending[-1]
+            if node in counts:
+                pending.pop()
+                continue
+            low, high = self._low[node], self._high[node]
+            missing = [child for child in (low, high) if child not in counts]
+            if missing:
+                pending.extend(missing)
+                continue
+            pending.pop()
+            level = self._top(node)
+            counts[node] = (
+                counts[low] << (self._top(low) - level - 1)) + (
+                counts[high] << (self._top(high) - level - 1))
+        return counts[f] << self._top(f)
+
+    def satisfy(self, f):
+        """Return {name: value} for the variables on one path to 1, or
+        None if f is 0; variables not named can have either value"""
+        if f == 0:
+            return None
+        assignment = {}
+        while f > 1:
+            name = self._names[self._var[f]]
+            if self._low[f] != 0:
+                assignment[name] = False
+                f = self._low[f]
+            else:
+                assignment[name] = True
+                f = self._high[f]
+        return assignment
+
+    def truth_table(self, f, names):
+        """Return f's truth table as an int: bit k is f for the assignment
+        giving names[i] bit i of k.  f may only depend on names."""
+        missing = set(self.support(f)) - set(names)
+        if missing:
+            raise ValueError(f"The function also depends on {missing}")
+        full = (1 << (1 << len(names))) - 1
+        # Where each variable is 1 (see logic_gate_part2.exhaustive_stimulus)
+        patterns = {}
+        for i, name in enumerate(names):
+            block = ((1 << (1 << i)) - 1) << (1 << i)
+            patterns[self._variables[name]] = full // (
+                (1 << (2 << i)) - 1) * block
+        tables = {0: 0, 1: full}
+        for node in sorted(self._nodes([f]), key=self._top, reverse=True):
+            pattern = patterns[self._var[node]]
+            tables[node] = (tables[self._high[node]] & pattern) | (
+                tables[self._low[node]] & ~pattern & full)
+        return tables[f]
+
+    def collect(self, roots):
+        """Free every node that is not part of the BDDs of roots
+
+        The nodes of the variables themselves are always kept; other nodes
+        that are not kept stop being meaningful.
+        """
+        live = self._nodes(self._roots(roots))
+        for node in range(2, len(self._var)):
+            variable = self._var[node]
+            if variable is not None and variable >= 0 and node not in live:
+                del self._unique[variable][(self._low[node],
+                                            self._high[node])]
+                self._var[node] = -1
+                self._free.append(node)
+        # Freed nodes will be reused
+        self._cache = [None] * len(self._cache)
+
+    def _roots(self, roots):
+        # roots and the nodes of the variables
+        return list(roots) + [unique[(0, 1)] for unique in self._unique
+                              if (0, 1) in unique]
+
+    def swap(self, level):
+        """Exchange the variables at level and level + 1
+
+        Nodes keep their numbers and functions; nodes of the upper variable
+        that read the lower one are rewritten in place.
+        """
+        upper, lower = self._order[level], self._order[level + 1]
+        var, low, high = self._var, self._low, self._high
+        for (f0, f1), node in list(self._unique[upper].items()):
+            if var[f0] != lower and var[f1] != lower:
+                continue
+            f00, f01 = (low[f0], high[f0]) if var[f0] == lower else (f0, f0)
+            f10, f11 = (low[f1], high[f1]) if var[f1] == lower else (f1, f1)
+            del self._unique[upper][(f0, f1)]
+            # Below lower now, upper is tested inside
+            new_low = self._make(upper, f00, f10)
+            new_high = self._make(upper, f01, f11)
+            var[node] = lower
+            low[node] = new_low
+            high[node] = new_high
+            self._unique[lower][(new_low, new_high)] = node
+            if self._refs is not None:
+                self._refs[new_low] += 1
+                self._refs[new_high] += 1
+                self._release(f0)
+                self._release(f1)
+        self._order[level], self._order[level + 1] = lower, upper
+        self._level[lower], self._level[upper] = level, level + 1
+
+    def _release(self, node):
+        # Drop a reference to node, freeing it and what only it reads
+        refs = self._refs
+        pending = [node]
+        while pending:
+            node = pending.pop()
+            refs[node] -= 1
+            if refs[node] or node <= 1:
+                continue
+            del self._unique[self._var[node]][(self._low[node],
+                                               self._high[node])]
+            self._var[node] = -1
+            self._free.append(node)
+            pending += (self._low[node], self._high[node])
+
+    def reorder(self, roots, max_growth=MAX_GROWTH, max_swaps=MAX_SWAPS):
+        """Sift the variables to make the BDDs of roots smaller
+
+        Frees the nodes outside those BDDs (see collect) and returns their
+        size afterwards.  Each variable in turn, the one with the most nodes
+        first, is moved through every level and left where the BDDs were
+        smallest, until max_swaps swaps are done.  While sifting, nodes
+        count their references, so the ones a swap leaves unused are freed
+        at once.
+        """
+        kept = list(roots)
+        roots = self._roots(kept)
+        self.collect(roots)
+        self._refs = refs = [0] * len(self._var)
+        for node in range(2, len(self._var)):
+            if self._var[node] != -1:
+                refs[self._low[node]] += 1
+                refs[self._high[node]] += 1
+        for root in roots:
+            refs[root] += 1
+        best_size = len(self)
+        variables = sorted(range(len(self._order)),
+                           key=lambda variable: -len(self._unique[variable]))
+        swaps = 0
+        for variable in variables:
+            position = best_position = self._level[variable]
+            # To the closer end first, then to the other one
+            ends = [len(self._order) - 1, 0]
+            if position < len(self._order) // 2:
+                ends.reverse()
+            for target in ends:
+                while position != target and swaps < max_swaps:
+                    swaps += 1
+                    if target > position:
+                        self.swap(position)
+                        position += 1
+                    else:
+                        self.swap(position - 1)
+                        position -= 1
+                    if len(self) < best_size:
+                        best_size, best_position = len(self), position
+                    elif len(self) > max_growth * best_size:
+                        break
+            while position < best_position:
+                self.swap(position)
+                position += 1
+            while position > best_position:
+                self.swap(position - 1)
+                position -= 1
+        self._refs = None
+        self._cache = [None] * len(self._cache)
+        return self.size(kept)
+
+
+def circuit_bdds(circuit, manager=None, reorder=False, keep=()):
+    """Return (manager, {output port name: node}) for circuit
+
+    Input ports are variables named by the port name, the Q outputs of
+    flip-flops by the flip-flop's name, and inputs that are not part of a
+    port but have no value (or are driven from outside the circuit) by
+    the Input; other unported inputs are
+    constants, as in write_blif.  New variables are added in the order a
+    depth-first walk from the output ports meets them, which keeps related
+    inputs together.  Whenever the manager holds more than
+    REORDER_THRESHOLD nodes, or twice as many as after the last time, the
+    nodes no longer needed are freed (see BDD.collect), and with reorder,
+    if most were needed, the variables are sifted (see BDD.reorder).  The
+    nodes in keep are kept as well.
+    """
+    circuit._require_acyclic("BDD construction")
+    if manager is None:
+        manager = BDD()
+    reads = circuit._signals()
+    for signal in _depth_first_signals(circuit, reads):
+        manager.var(signal)
+    outputs = circuit.output_ports()
+    # Gate outputs still to be read, so the others can be let go
+    readers = {}
+    for signals in reads.values():
+        for signal in signals:
+            if isinstance(signal, Output):
+                readers[signal] = readers.get(signal, 0) + 1
+    for output in outputs.values():
+        readers[output] = readers.get(output, 0) + 1
+    nodes = {}
+    threshold = max(REORDER_THRESHOLD, 2 * len(manager))
+    for gate, signals in reads.items():
+        inputs = []
+        for signal in signals:
+            if isinstance(signal, Output):
+                inputs.append(nodes[signal])
+            elif (isinstance(signal, Input) and signal.driver is None
+                  and signal.value is not X):
+                inputs.append(1 if signal.value else 0)
+            else:
+                inputs.append(manager.var(signal))
+        if gate.output in readers:
+            nodes[gate.output] = _gate(manager, gate, inputs)
+        for signal in signals:
+            if isinstance(signal, Output):
+                readers[signal] -= 1
+                if not readers[signal]:
+                    del nodes[signal]
+        if len(manager) > threshold:
+            roots = list(keep) + list(nodes.values())
+            manager.collect(roots)
+            # Sift only if most nodes were not garbage
+            if reorder and len(manager) > threshold // 2:
+                manager.reorder(roots)
+            threshold = max(REORDER_THRESHOLD, 2 * len(manager))
+    return manager, {name: nodes[output] for name, output in outputs.items()}
+
+
+def _depth_first_signals(circuit, reads):
+    # The variable signals, in the order a depth-first walk from the
+    # output ports (in order, inputs first to last) meets them
+    signals = []
+    seen = set()
+    for output in circuit.output_ports().values():
+        pending = [(output.owner, 0)]
+        while pending:
+            gate, index = pending.pop()
+            if index == len(reads[gate]):
+                continue
+            pending.append((gate, index + 1))
+            signal = reads[gate][index]
+            if signal in seen:
+                continue
+            seen.add(signal)
+            if isinstance(signal, Output):
+                pending.append((signal.owner, 0))
+            elif not (isinstance(signal, Input) and signal.driver is None
+                      and signal.value is not X):
+                signals.append(signal)
+    return signals
+
+
+def _gate(manager, gate, inputs):
+    # The node of gate's output, given the nodes of its inputs
+    opcode = gate.OPCODE
+    if opcode == OP_NOT:
+        return manager.not_(inputs[0])
+    if opcode == OP_LUT:
+        return manager.lut(gate.table, inputs)
+    if opcode in (OP_AND, OP_NAND):
+        fold = manager.and_
+    elif opcode in (OP_OR, OP_NOR):
+        fold = manager.or_
+    else:
+        fold = manager.xor
+    node = inputs[0]
+    for other in inputs[1:]:
+        node = fold(node, other)
+    if opcode in (OP_NAND, OP_NOR, OP_XNOR):
+        node = manager.not_(node)
+    return node
+
+
+def equivalent(circuit, other, reorder=False):
+    """Return whether two circuits compute the same output ports
+
+    Input ports are matched by name, as are output ports; a port only one
+    circuit has is an input the other one ignores.  Raises ValueError if
+    the output port names differ.  For reorder, see circuit_bdds.
+    """
+    if set(circuit.output_ports()) != set(other.output_ports()):
+        raise ValueError("The circuits have different output ports")
+    manager, outputs = circuit_bdds(circuit, reorder=reorder)
+    _, other_outputs = circuit_bdds(other, manager, reorder,
+                                    outputs.values())
+    return outputs == other_outputs
+
+
+def count_solutions(circuit, output=None):
+    """Return how many assignments of circuit's variables (see
+    circuit_bdds) make output port output 1
+
+    output may be left out if there is only one output port.
+    """
+    manager, outputs = circuit_bdds(circuit)
+    return manager.count(outputs[_output_name(outputs, output)])
+
+
+def truth_table(circuit, output=None):
+    """Return the truth table of output port output as an int
+
+    Bit k is the output for the assignment giving the i-th input port bit
+    i of k, so it equals simulate_packed on exhaustive_stimulus of the
+    input ports.  Inputs outside the ports must not matter (see
+    BDD.truth_table).  output may be left out if there is only one output
+    port.
+    """
+    manager, outputs = circuit_bdds(circuit)
+    return manager.truth_table(outputs[_output_name(outputs, output)],
+                               list(circuit.input_ports()))
+
+
+def _output_name(outputs, output):
+    if output is None:
+        if len(outputs) != 1:
+            raise ValueError("Name the output port: the circuit has "
+                             f"{len(outputs)}")
+        (output,) = outputs
+    if output not in outputs:
+        raise ValueError(f"No output port {output!r}")
+    return output
+
+
+def test():
+    """Umbrella test function"""
+    tests = [
+        test_manager,
+        test_reorder,
+        test_truth_table,
+        test_equivalent,
+        test_wide_equivalence,
+    ]
+    for t in tests:
+        print("Running " + t.__name__ + " " + "-" * 20)
+        t()
+
+
+def test_manager():
+    manager = BDD(cache_size=16)
+    a, b, c = (manager.var(name) for name in "abc")
+    assert manager.var("a") == a
+    assert manager.and_(a, b) == manager.and_(b, a)
+    # De Morgan
+    assert manager.not_(manager.and_(a, b)) == manager.or_(
+        manager.not_(a), manager.not_(b))
+    majority = manager.or_(manager.and_(a, b), manager.and_(c, manager.or_(
+        a, b)))
+    assert majority == manager.lut(0xE8, [a, b, c])
+    assert manager.count(majority) == 4
+    assert manager.count(manager.xor(a, a)) == 0
+    assert manager.count(1) == 8
+    assert manager.truth_table(majority, ["a", "b", "c"]) == 0xE8
+    assert manager.truth_table(b, ["b", "a"]) == 0b1010
+    assert manager.support(manager.and_(c, a)) == ["a", "c"]
+    assignment = manager.satisfy(manager.and_(a, manager.not_(c)))
+    assert assignment == {"a": True, "c": False}
+
+
+def test_reorder():
+    # a0 b0 + a1 b1 + ... is exponential with the a's first and linear
+    # with each a next to its b
+    manager = BDD()
+    pairs = 6
+    a = [manager.var(f"a{i}") for i in range(pairs)]
+    b = [manager.var(f"b{i}") for i in range(pairs)]
+    f = 0
+    for i in range(pairs):
+        f = manager.or_(f, manager.and_(a[i], b[i]))
+    before = manager.size([f])
+    table = manager.truth_table(f, manager.variables)
+    names = manager.variables
+    after = manager.reorder([f])
+    print(f"{before} nodes -> {after}, order {manager.variables}")
+    assert after == manager.size([f]) == 2 * pairs
+    assert manager.truth_table(f, names) == table
+    # Functions built after reordering are still canonical
+    g = 0
+    for i in reversed(range(pairs)):
+        g = manager.or_(manager.and_(b[i], a[i]), g)
+    assert g == f
+
+
+def test_truth_table():
+    from logic_gate_part2 import (AndGate, Circuit, DFlipFlop, NotGate,
+                                  build_full_adder, build_random_logic,
+                                  exhaustive_stimulus)
+
+    circuit = Circuit()
+    (a_inputs, b_inputs, ci_inputs), (sum_output, co_output) = \
+        build_full_adder(circuit)
+    circuit.add_input_port("a", *a_inputs)
+    circuit.add_input_port("b", *b_inputs)
+    circuit.add_input_port("ci", *ci_inputs)
+    circuit.add_output_port("sum", sum_output)
+    circuit.add_output_port("co", co_output)
+    assert truth_table(circuit, "sum") == 0x96
+    assert truth_table(circuit, "co") == 0xE8
+    assert count_solutions(circuit, "co") == 4
+    circuit = Circuit()
+    build_random_logic(circuit, 12, 300, seed=23)
+    patterns, width = exhaustive_stimulus(list(circuit.input_ports()))
+    signals = circuit.simulate_packed(
+        {input_: patterns[name] for name, inputs in
+         circuit.input_ports().items() for input_ in inputs}, width)
+    for name, output in circuit.output_ports().items():
+        table = truth_table(circuit, name)
+        assert table == signals[output]
+        assert count_solutions(circuit, name) == bin(table).count("1")
+    # A flip-flop's Q read by two gates is one variable: q AND NOT q is 0
+    circuit = Circuit()
+    flip_flop = DFlipFlop("q", circuit)
+    gate = AndGate("and", circuit)
+    inverter = NotGate("not", circuit)
+    flip_flop.q.connect(gate.input0)
+    flip_flop.q.connect(inverter.input)
+    inverter.output.connect(gate.input1)
+    circuit.add_output_port("y", gate.output)
+    assert count_solutions(circuit) == 0
+
+
+def test_equivalent():
+    from logic_gate_part2 import Circuit, build_random_logic
+
+    circuit = Circuit()
+    build_random_logic(circuit, 16, 400, seed=24)
+    optimized, _ = circuit.optimize()
+    aig, _ = circuit.optimize(aig=True)
+    mapped, _ = circuit.map_luts(4)
+    for other in (optimized, aig, mapped):
+        assert equivalent(circuit, other)
+    # Cut one connection near the outputs and tie the input to 1
+    input_ = next(input_ for gate in reversed(optimized.topological_order())
+                  for input_ in gate.inputs if input_.driver is not None)
+    input_.driver.disconnect(input_)
+    input_.value = True
+    assert not equivalent(circuit, optimized)
+    try:
+        equivalent(circuit, Circuit())
+    except ValueError as error:
+        print(error)
+    else:
+        raise AssertionError("Different output ports were accepted")
+
+
+def test_wide_equivalence():
+    import time
+
+    from logic_gate_part2 import Circuit, build_ripple_adder
+
+    # A 64-bit adder has 129 inputs: far too many to simulate exhaustively
+    circuit = Circuit()
+    a_ports, b_ports, ci_inputs, _, _ = build_ripple_adder(circuit, 64)
+    for i, (a_inputs, b_inputs) in enumerate(zip(a_ports, b_ports)):
+        circuit.add_input_port(f"a{i}", *a_inputs)
+        circuit.add_input_port(f"b{i}", *b_inputs)
+    circuit.add_input_port("ci", *ci_inputs)
+    start = time.perf_counter()
+    optimized, _ = circuit.optimize(aig=True)
+    mapped, _ = circuit.map_luts(6)
+    assert equivalent(circuit, optimized) and equivalent(circuit, mapped)
+    print(f"64-bit adder: 2 equivalence checks in "
+          f"{time.perf_counter() - start:.2f}s")
+    manager, outputs = circuit_bdds(circuit)
+    carry = outputs[list(outputs)[-1]]
+    print(f"carry-out: {manager.size([carry])} nodes, "
+          f"{manager.count(carry)} solutions")
+    assert manager.count(carry) == 2 ** 128
+
+
+if __name__ == '__main__':
+    test()
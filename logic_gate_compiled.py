@@ -0,0 +1,346 @@
+"""
+Compiled form of a logic gate Circuit (see logic_gate_part2.py)
+
+A CompiledCircuit flattens the object graph into a levelized instruction
+table: one opcode and the operand slot numbers per gate, stored in
+array.array buffers.  Evaluating it is a single loop over that table, with
+no Input/Output properties, setters or connection lists involved.
+
+to_function() goes one step further and generates straight-line Python
+source from the table, so each gate becomes a single statement.
+"""
+
+import operator
+from array import array
+from functools import reduce
+
+from logic_gate_part2 import (Circuit, OP_AND, OP_LUT, OP_NAND, OP_NOR, OP_NOT,
+                              OP_OR, OP_XNOR, OP_XOR, lut_packed)
+
+# Generated functions, keyed by the structure they were generated from, so
+# structurally identical circuits share one function
+_FUNCTION_CACHE = {}
+
+# Operator joining the operands, and whether the result is complemented
+_OPERATORS = {OP_AND: ("&", False), OP_OR: ("|", False),
+              OP_XOR: ("^", False), OP_NAND: ("&", True),
+              OP_NOR: ("|", True), OP_XNOR: ("^", True)}
+
+# Binary operator folding the operands of each gate type, and the types
+# whose result is complemented
+_FOLDS = {OP_AND: operator.and_, OP_OR: operator.or_, OP_XOR: operator.xor,
+          OP_NAND: operator.and_, OP_NOR: operator.or_,
+          OP_XNOR: operator.xor}
+_COMPLEMENTED = frozenset((OP_NAND, OP_NOR, OP_XNOR))
+
+
+class CompiledCircuit:
+    """An immutable, levelized instruction table built from a Circuit.
+
+    Signal slots are numbered with the primary inputs first (in the order
+    of the inputs property) followed by one slot per gate output, in
+    instruction order.  Instruction i therefore writes slot
+    len(inputs) + i, and only needs its opcode and operand slots.
+    """
+
+    def __init__(self, circuit):
+        if not isinstance(circuit, Circuit):
+            raise TypeError("CompiledCircuit needs a Circuit to compile")
+        circuit._require_acyclic("CompiledCircuit")
+        order = circuit.topological_order()
+        levels = circuit.levelize()
+        inputs = circuit.primary_inputs()
+        slots = {input_: slot for slot, input_ in enumerate(inputs)}
+        for index, gate in enumerate(order):
+            slots[gate.output] = len(inputs) + index
+        program = []
+        for gate in order:
+            operands = [slots[input_] if input_ in slots
+                        else slots[input_.driver] for input_ in gate.inputs]
+            program.append((levels[gate], gate.OPCODE, operands,
+                            gate.table if gate.OPCODE == OP_LUT else None))
+        outputs = circuit.primary_outputs()
+        self._fill(inputs, outputs, order, slots, program,
+                   [slots[output] for output in outputs])
+
+    @classmethod
+    def from_store(cls, store):
+        """Compile a CircuitStore, e.g. one mapped by CircuitStore.open.
+
+        inputs and outputs then hold the store's input node names and
+        output names, gates holds node indices, and slot() takes a node
+        index.
+        """
+        from logic_gate_store import INPUT
+
+        inputs = list(store.inputs)
+        # Level of every node (-1 for inputs), then the gates sorted by it;
+        # the store is already in topological order
+        levels = [-1] * len(store)
+        for index in range(len(store)):
+            if store.type(index) != INPUT:
+                levels[index] = 1 + max(levels[source]
+                                        for source in store.fanin(index))
+        order = sorted((index for index in range(len(store))
+                        if store.type(index) != INPUT), key=levels.__getitem__)
+        slots = {node: slot for slot, node in enumerate(inputs)}
+        for position, index in enumerate(order):
+            slots[index] = len(inputs) + position
+        program = [(levels[index], store.type(index),
+                    [slots[source] for source in store.fanin(index)],
+                    store.table(index)) for index in order]
+        compiled = cls.__new__(cls)
+        compiled._fill([store.name(index) for index in inputs],
+                       list(store.output_names), order, slots, program,
+                       [slots[index] for index in store.outputs])
+        return compiled
+
+    def _fill(self, inputs, outputs, sources, slots, program, output_slots):
+        # program holds (level, opcode, operand slots, LUT table or None)
+        # in level order
+        self._inputs = tuple(inputs)
+        self._outputs = tuple(outputs)
+        self._gates = tuple(sources)
+        self._slots = slots
+        self._opcodes = array("b")
+        # Every operand, grouped per instruction; plus the first two again
+        # (-1 if missing), for the loop that handles up to two inputs
+        self._operand_starts = array("l", [0])
+        self._operands = array("l")
+        self._operand0 = array("l")
+        self._operand1 = array("l")
+        self._level_starts = array("l")
+        # Instruction index -> truth table, for the OP_LUT instructions
+        self._tables = {}
+        previous = None
+        for index, (level, opcode, operands, table) in enumerate(program):
+            if level != previous:
+                previous = level
+                self._level_starts.append(index)
+            self._opcodes.append(opcode)
+            self._operands.extend(operands)
+            self._operand_starts.append(len(self._operands))
+            self._operand0.append(operands[0])
+            self._operand1.append(operands[1] if len(operands) > 1 else -1)
+            if opcode == OP_LUT:
+                self._tables[index] = table
+        self._level_starts.append(len(program))
+        self._output_slots = array("l", output_slots)
+        # Whether run_all needs its general loop
+        self._wide = bool(self._tables) or any(
+            len(operands) > 2 for _, _, operands, _ in program)
+
+    def __len__(self):
+        return len(self._opcodes)
+
+    def __str__(self):
+        return (f"CompiledCircuit: {len(self._inputs)} inputs, "
+                f"{len(self._opcodes)} gates, {self.depth} levels, "
+                f"{len(self._outputs)} outputs")
+
+    @property
+    def inputs(self):
+        """The primary Inputs, in the order run() expects their values"""
+        return self._inputs
+
+    @property
+    def outputs(self):
+        """The primary Outputs, in the order run() returns their values"""
+        return self._outputs
+
+    @property
+    def gates(self):
+        """The source gates, in instruction order"""
+        return self._gates
+
+    @property
+    def opcodes(self):
+        return memoryview(self._opcodes).toreadonly()
+
+    @property
+    def operands(self):
+        """The first two operand slots of every instruction (-1 if none)"""
+        return (memoryview(self._operand0).toreadonly(),
+                memoryview(self._operand1).toreadonly())
+
+    def table(self, index):
+        """Return the truth table of LUT instruction index, else None"""
+        return self._tables.get(index)
+
+    def fanin(self, index):
+        """Return all the operand slots of instruction index"""
+        return self._operands[self._operand_starts[index]:
+                              self._operand_starts[index + 1]]
+
+    @property
+    def level_starts(self):
+        """Instruction offsets where each level begins, plus the end"""
+        return memoryview(self._level_starts).toreadonly()
+
+    @property
+    def depth(self):
+        return len(self._level_starts) - 1
+
+    def slot(self, signal):
+        """Return the slot number of an Output or primary Input"""
+        return self._slots[signal]
+
+    def run(self, values, width=1):
+        """Evaluate the circuit and return the output values.
+
+        values holds one value per entry of inputs.  With width=1 they are
+        bools and bools are returned; otherwise they are ints packing width
+        test vectors (see logic_gate_part2.pack) and packed ints come back.
+        """
+        slots = self.run_all(values, width)
+        if width == 1:
+            return [bool(slots[slot]) for slot in self._output_slots]
+        return [slots[slot] for slot in self._output_slots]
+
+    def run_all(self, values, width=1):
+        """Like run, but return the list of every signal slot"""
+        if len(values) != len(self._inputs):
+            raise ValueError(f"Expected {len(self._inputs)} input values, "
+                             f"got {len(values)}")
+        mask = (1 << width) - 1
+        slots = [int(value) & mask for value in values]
+        append = slots.append
+        if self._wide:
+            return self._run_wide(slots, mask)
+        for opcode, a, b in zip(self._opcodes, self._operand0,
+                                self._operand1):
+            if opcode == OP_AND:
+                append(slots[a] & slots[b])
+            elif opcode == OP_XOR:
+                append(slots[a] ^ slots[b])
+            elif opcode == OP_OR:
+                append(slots[a] | slots[b])
+            elif opcode == OP_NOT:
+                append(slots[a] ^ mask)
+            elif opcode == OP_NAND:
+                append((slots[a] & slots[b]) ^ mask)
+            elif opcode == OP_NOR:
+                append((slots[a] | slots[b]) ^ mask)
+            else:
+                # OP_XNOR
+                append(slots[a] ^ slots[b] ^ mask)
+        return slots
+
+    def _run_wide(self, slots, mask):
+        # The loop for programs with LUTs or gates of more than two inputs:
+        # each gate's operands are folded by reduce and map, so the
+        # per-operand work stays in C
+        append = slots.append
+        fetch = slots.__getitem__
+        operands = self._operands
+        starts = self._operand_starts
+        tables = self._tables
+        start = 0
+        for index, (end, opcode) in enumerate(zip(starts[1:], self._opcodes)):
+            if opcode == OP_NOT:
+                append(slots[operands[start]] ^ mask)
+            elif opcode != OP_LUT:
+                value = reduce(_FOLDS[opcode],
+                               map(fetch, operands[start:end]))
+                append(value ^ mask if opcode in _COMPLEMENTED else value)
+            elif mask == 1:
+                # One vector: look the table up
+                lookup = 0
+                bit = 1
+                for position in range(start, end):
+                    if slots[operands[position]]:
+                        lookup |= bit
+                    bit <<= 1
+                append((tables[index] >> lookup) & 1)
+            else:
+                append(lut_packed(tables[index], mask,
+                                  list(map(fetch, operands[start:end]))))
+            start = end
+        return slots
+
+    def structure_key(self):
+        """Return a hashable key identifying this circuit's structure"""
+        return (len(self._inputs), self._opcodes.tobytes(),
+                self._operand_starts.tobytes(), self._operands.tobytes(),
+                self._output_slots.tobytes(),
+                tuple(sorted(self._tables.items())))
+
+    def to_function(self):
+        """Return a generated function evaluating this circuit.
+
+        The function takes one positional argument per entry of inputs and
+        returns a tuple with one value per entry of outputs.  Pass bools, or
+        ints packing several vectors together with mask=(1 << width) - 1.
+        Functions are cached by structure_key(), so generating the same
+        structure again is a dictionary lookup.
+        """
+        key = self.structure_key()
+        function = _FUNCTION_CACHE.get(key)
+        if function is None:
+            namespace = {"lut_packed": lut_packed}
+            exec(compile(self.to_source(), "<compiled circuit>", "exec"),
+                 namespace)
+            function = _FUNCTION_CACHE[key] = namespace["evaluate"]
+        return function
+
+    def to_source(self, name="evaluate"):
+        """Return the Python source that to_function() compiles
+
+        With LUTs there are two bodies: one for mask=True, where a LUT is a
+        table lookup, and one for packed values, calling lut_packed.
+        """
+        base = len(self._inputs)
+        arguments = [f"s{slot}" for slot in range(base)]
+        lines = [f"def {name}({', '.join(arguments + ['mask=True'])}):"]
+        if self._tables:
+            lines.append("    if mask is True:")
+            lines += self._source_lines("        ", scalar=True)
+        lines += self._source_lines("    ", scalar=False)
+        return "\n".join(lines) + "\n"
+
+    def _source_lines(self, indent, scalar, result=None):
+        # One assignment per instruction, then "return result" (the tuple
+        # of the output slots by default)
+        base = len(self._inputs)
+        lines = []
+        for index, opcode in enumerate(self._opcodes):
+            operands = [f"s{slot}" for slot in self.fanin(index)]
+            if opcode == OP_NOT:
+                expression = f"{operands[0]} ^ mask"
+            elif opcode == OP_LUT and scalar:
+                expression = _lut_expression(self._tables[index], operands,
+                                             len(operands))
+            elif opcode == OP_LUT:
+                values = "".join(f"{operand}, " for operand in operands)
+                expression = (f"lut_packed({self._tables[index]:#x}, mask, "
+                              f"({values}))")
+            else:
+                operator, complemented = _OPERATORS[opcode]
+                expression = f" {operator} ".join(operands)
+                if complemented:
+                    expression = f"({expression}) ^ mask"
+            lines.append(f"{indent}s{base + index} = {expression}")
+        if result is None:
+            result = "({})".format("".join(f"s{slot}, "
+                                           for slot in self._output_slots))
+        lines.append(f"{indent}return {result}")
+        return lines
+
+
+def _lut_expression(table, operands, count):
+    # A conditional expression choosing through table one input at a time,
+    # last input first; the same split as logic_gate_part2.lut_packed
+    if table == 0:
+        return "False"
+    if table == (1 << (1 << count)) - 1:
+        return "True"
+    half = 1 << (count - 1)
+    low = table & ((1 << half) - 1)
+    high = table >> half
+    select = operands[count - 1]
+    if low == high:
+        return _lut_expression(low, operands, count - 1)
+    if count == 1:
+        return select if high else f"not {select}"
+    return (f"({_lut_expression(high, operands, count - 1)} if {select} "
+            f"else {_lut_expression(low, operands, count - 1)})")
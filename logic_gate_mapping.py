@@ -0,0 +1,315 @@
+"""
+LUT technology mapping for logic gate circuits (see logic_gate_part2.py)
+
+map_luts() covers a circuit with k-input lookup tables (LutGate): each LUT
+replaces a cluster of gates whose combined function depends on at most k
+signals.  The mapped circuit has fewer, fatter nodes, so a change reaches
+the outputs in fewer hops and fewer Python calls, whichever way it is
+simulated.
+
+The mapper is a priority-cut mapper:
+
+- in topological order, every gate's k-feasible cuts (sets of at most k
+  signals that separate it from the primary inputs) are built by merging
+  the cuts of the signals it reads, and only the CUTS_PER_GATE best are
+  kept, ranked by depth and then by area flow;
+- from the outputs backwards, every gate that is needed becomes one LUT
+  over its best cut, and the signals of that cut are needed in turn;
+- a LUT's truth table is found by simulating its cluster once, on all
+  2 ** k combinations of the cut's signals, with the packed kernels.
+
+Gates with more than k inputs are copied as they are.
+"""
+
+from logic_gate_part2 import (Circuit, Input, LutGate, OP_LUT, Output, X,
+                              make_gate)
+
+# Cuts kept per gate; more finds slightly better mappings, more slowly
+CUTS_PER_GATE = 8
+
+
+def map_luts(circuit, k=6):
+    """Return a copy of circuit made of LUTs of at most k inputs.
+
+    The copy has the same mode, the same input and output ports (see
+    Circuit.input_ports and Circuit.output_ports), and the same input
+    values; gates no output port depends on are left out.  Returns
+    (mapped, outputs), where outputs maps each Output of circuit that
+    survives to its counterpart in mapped.  Only combinational circuits
+    fit: one with flip-flops raises ValueError.
+    """
+    if not isinstance(k, int):
+        raise TypeError("k must be an int")
+    if k < 2:
+        raise ValueError("LUTs need at least 2 inputs")
+    circuit._require_acyclic("LUT mapping")
+    if circuit.flip_flops():
+        raise ValueError("LUT mapping works on combinational logic only, "
+                         "not flip-flops")
+    order = circuit.topological_order()
+    input_ports = circuit.input_ports()
+    reads = circuit._signals()
+    # Every signal numbered in the order it is first seen
+    position = {}
+    for gate, signals in reads.items():
+        for leaf in signals:
+            if not isinstance(leaf, Output):
+                position.setdefault(leaf, len(position))
+        position[gate.output] = len(position)
+    roots = list(circuit.output_ports().values())
+    roots += [gate.output for gate in order
+              if any(connection.owner not in circuit
+                     for connection in gate.output.connections)]
+    best = _select_cuts(order, reads, roots, k, position)
+    chosen = _cover(roots, best, reads, position)
+    # Build the LUTs (and copied wide gates) in topological order
+    mapped = Circuit(circuit.mode)
+    outputs = {}
+    pins = {}
+    for gate in order:
+        leaves = chosen.get(gate.output)
+        if leaves is None:
+            continue
+        if gate in best:
+            new = LutGate(gate.name, mapped, len(leaves),
+                          _cluster_table(gate, leaves, reads))
+        else:
+            new = make_gate(gate.OPCODE, gate.name, mapped, len(leaves),
+                            gate.table if gate.OPCODE == OP_LUT else None)
+        outputs[gate.output] = new.output
+        for input_, leaf in zip(new.inputs, leaves):
+            if isinstance(leaf, Output):
+                outputs[leaf].connect(input_)
+            else:
+                pins.setdefault(leaf, []).append(input_)
+                if isinstance(leaf, Input) and leaf.driver is not None:
+                    leaf.driver.connect(input_)
+    for name in input_ports:
+        mapped.add_input_port(name, *pins.get(name, ()))
+    for name, output in circuit.output_ports().items():
+        mapped.add_output_port(name, outputs[output])
+    # Carry the input values over
+    for leaf, inputs in pins.items():
+        if isinstance(leaf, Input):
+            value = leaf.value if leaf.driver is None else X
+        else:
+            value = input_ports[leaf][0].value
+        if value is not X:
+            for input_ in inputs:
+                input_.value = value
+    return mapped, outputs
+
+
+def _select_cuts(order, reads, roots, k, position):
+    # The cut of every gate that fits in a LUT: first the best for depth,
+    # then, for the gates that cover needs, the best for area among the
+    # cuts that keep the depth of the mapping
+    fanout = {gate.output: max(1, len(gate.output.connections))
+              for gate in order}
+    cuts = {}
+    best = {}
+    depth = _choose_cuts(order, reads, k, position, fanout, cuts, best)
+    required = _required_depths(order, reads, roots, best, depth)
+    _choose_cuts(order, reads, k, position, fanout, cuts, best, required)
+    return best
+
+
+def _choose_cuts(order, reads, k, position, fanout, cuts, best,
+                 required=None):
+    # One pass of _select_cuts, filling in best; the first (without
+    # required) finds the cuts and picks for depth, the second for area
+    # within the required depths.  Returns the depth of every gate output
+    depth = {}
+    flow = {}
+
+    def cost(cut):
+        return (1 + max((depth.get(leaf, 0) for leaf in cut), default=0),
+                1 + sum(flow.get(leaf, 0) / fanout.get(leaf, 1)
+                        for leaf in cut),
+                len(cut), sorted(position[leaf] for leaf in cut))
+
+    for gate in order:
+        if required is None:
+            cuts[gate.output] = _priority_cuts(reads[gate], cuts, k, cost)
+        if not cuts[gate.output]:
+            # Too wide for a LUT: only ever a cut leaf
+            depth[gate.output], flow[gate.output], _, _ = cost(
+                set(reads[gate]))
+            continue
+        choice = cuts[gate.output][0]
+        limit = None if required is None else required.get(gate.output)
+        if limit is not None:
+            costs = [(cost(cut), cut) for cut in cuts[gate.output]]
+            feasible = [pair for pair in costs if pair[0][0] <= limit]
+            _, choice = min(feasible or costs, key=lambda pair: (
+                pair[0][1], pair[0][0], pair[0][3]))
+        best[gate] = choice
+        depth[gate.output], flow[gate.output], _, _ = cost(choice)
+    return depth
+
+
+def _priority_cuts(signals, cuts, k, cost):
+    # The best cuts of a gate reading signals, by cost, from the cuts of
+    # those signals; none if the gate has more than k different signals
+    signals = list(dict.fromkeys(signals))
+    if len(signals) > k:
+        return []
+    merged = [frozenset()]
+    for leaf in signals:
+        choices = cuts.get(leaf, []) + [frozenset((leaf,))]
+        merged = list({cut | choice for cut in merged for choice in choices
+                       if len(cut | choice) <= k})
+        merged.sort(key=len)
+        del merged[2 * CUTS_PER_GATE * CUTS_PER_GATE:]
+    # Drop the cuts that contain another cut
+    merged = [cut for cut in merged
+              if not any(other < cut for other in merged)]
+    merged.sort(key=cost)
+    return merged[:CUTS_PER_GATE]
+
+
+def _required_depths(order, reads, roots, best, depth):
+    # The latest depth every gate output the cover needs may have without
+    # making the mapping deeper
+    limit = max((depth[root] for root in roots), default=0)
+    required = dict.fromkeys(roots, limit)
+    for gate in reversed(order):
+        if gate.output not in required:
+            continue
+        for leaf in best.get(gate, reads[gate]):
+            if isinstance(leaf, Output):
+                required[leaf] = min(required.get(leaf, limit),
+                                     required[gate.output] - 1)
+    return required
+
+
+def _cover(roots, best, reads, position):
+    # The leaves each gate output the outputs need is built from, in
+    # signal order
+    chosen = {}
+    pending = list(roots)
+    while pending:
+        output = pending.pop()
+        if output in chosen:
+            continue
+        gate = output.owner
+        leaves = (sorted(best[gate], key=position.__getitem__)
+                  if gate in best else reads[gate])
+        chosen[output] = leaves
+        pending.extend(leaf for leaf in leaves if isinstance(leaf, Output))
+    return chosen
+
+
+def _cluster_table(gate, leaves, reads):
+    # Simulate the gates between leaves and gate on every combination of
+    # the leaves at once: leaf i is 1 in the vectors whose bit i is set
+    count = 1 << len(leaves)
+    mask = (1 << count) - 1
+    values = {}
+    for i, leaf in enumerate(leaves):
+        values[leaf] = sum(1 << vector for vector in range(count)
+                           if (vector >> i) & 1)
+    pending = [gate]
+    while pending:
+        current = pending[-1]
+        missing = [leaf for leaf in reads[current] if leaf not in values]
+        if missing:
+            pending.extend(leaf.owner for leaf in missing)
+            continue
+        pending.pop()
+        values[current.output] = current.evaluate_packed(
+            mask, *[values[leaf] for leaf in reads[current]])
+    return values[gate.output]
+
+
+def test():
+    """Umbrella test function"""
+    tests = [
+        test_map_luts,
+        test_mapped_state,
+    ]
+    for t in tests:
+        print("Running " + t.__name__ + " " + "-" * 20)
+        t()
+
+
+def _port_results(circuit, patterns, width):
+    stimulus = {input_: patterns[name]
+                for name, inputs in circuit.input_ports().items()
+                for input_ in inputs}
+    signals = circuit.simulate_packed(stimulus, width)
+    return {name: signals[output]
+            for name, output in circuit.output_ports().items()}
+
+
+def test_map_luts():
+    from logic_gate_part2 import build_random_logic, exhaustive_stimulus
+
+    circuit = Circuit()
+    build_random_logic(circuit, 12, 300, seed=21)
+    patterns, width = exhaustive_stimulus(list(circuit.input_ports()))
+    expected = _port_results(circuit, patterns, width)
+    print(f"Random logic: {len(circuit)} gates, depth {circuit.depth}")
+    for k in (4, 6):
+        mapped, outputs = map_luts(circuit, k)
+        print(f"LUT-{k}: {len(mapped)} LUTs, depth {mapped.depth}")
+        assert all(isinstance(gate, LutGate) and len(gate.inputs) <= k
+                   for gate in mapped)
+        assert len(mapped) < len(circuit) and mapped.depth < circuit.depth
+        assert list(mapped.output_ports()) == list(circuit.output_ports())
+        assert _port_results(mapped, patterns, width) == expected
+        assert set(outputs.values()) >= set(mapped.output_ports().values())
+
+
+def test_mapped_state():
+    import random
+
+    from logic_gate_part2 import NaryOrGate, build_counter, build_full_adder
+
+    # A full adder whose carry feeds an 8-input OR, too wide for a LUT-4
+    circuit = Circuit(Circuit.SCHEDULED)
+    (a_inputs, b_inputs, ci_inputs), (sum_output, co_output) = \
+        build_full_adder(circuit)
+    wide = NaryOrGate("wide", circuit, 8)
+    co_output.connect(wide.inputs[0])
+    circuit.add_input_port("a", *a_inputs)
+    circuit.add_input_port("b", *b_inputs)
+    circuit.add_input_port("ci", *ci_inputs)
+    for k in range(1, 8):
+        circuit.add_input_port(f"x{k}", wide.inputs[k])
+    circuit.add_output_port("sum", sum_output)
+    circuit.add_output_port("any", wide.output)
+    # A port nothing reads is kept, with no inputs
+    circuit.add_input_port("unused")
+    # The x inputs stay X, but a carry of 1 decides the OR anyway
+    circuit.set_inputs({"a": True, "b": True, "ci": False})
+    mapped, _ = map_luts(circuit, 4)
+    for gate in mapped:
+        print(gate)
+    assert [type(gate) for gate in mapped].count(NaryOrGate) == 1
+    assert list(mapped.input_ports()) == list(circuit.input_ports())
+    assert mapped.input_ports()["unused"] == ()
+    assert mapped.output_ports()["sum"].value is False
+    assert mapped.output_ports()["any"].value is True
+    random.seed(21)
+    for _ in range(30):
+        values = {name: random.random() < 0.3 for name in mapped.input_ports()}
+        results = []
+        for each in (circuit, mapped):
+            each.set_inputs(values)
+            results.append({name: output.value
+                            for name, output in each.output_ports().items()})
+        assert results[0] == results[1]
+    # The logic between flip-flops can't be copied without them
+    circuit = Circuit()
+    build_counter(circuit, 2)
+    try:
+        map_luts(circuit, 4)
+    except ValueError as error:
+        print(f"Caught: {error}")
+    else:
+        raise AssertionError("A circuit with flip-flops should not be mapped")
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,228 @@
+"""
+Reusable subcircuit templates (see logic_gate_part2.py)
+
+full_adder() builds a new Circuit and five gates on every call.  A Module
+is defined once instead: its gates are built a single time into a
+template, stored as a CircuitStore, and compiled into one generated
+function that every use shares.  A Module can then be used in two ways:
+
+- instantiate() flattens a copy of the template into a parent Circuit,
+  with prefixed gate names, for when the gates themselves are needed;
+- instance() returns a ModuleInstance holding nothing but that instance's
+  current port values, evaluated through the shared compiled body.
+"""
+
+from logic_gate_compiled import CompiledCircuit
+from logic_gate_part2 import Circuit, build_full_adder
+from logic_gate_store import CircuitStore
+
+
+class Module:
+    """A subcircuit defined once, with named ports, and used many times"""
+
+    def __init__(self, name, build):
+        """build(circuit) wires the gates into circuit and declares the
+        input and output ports (Circuit.add_input_port/add_output_port)."""
+        self._name = name
+        template = Circuit()
+        build(template)
+        self._store = CircuitStore.from_circuit(template)
+        self._compiled = CompiledCircuit.from_store(self._store)
+        self._function = self._compiled.to_function()
+        self._input_names = self._compiled.inputs
+        self._output_names = self._compiled.outputs
+        self._cost = template.cost
+        self._instances = 0
+
+    def __str__(self):
+        return (f"Module {self._name}: inputs={list(self._input_names)}, "
+                f"outputs={list(self._output_names)}")
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def input_names(self):
+        return self._input_names
+
+    @property
+    def output_names(self):
+        return self._output_names
+
+    @property
+    def cost(self):
+        """Cost of one flattened copy of the module"""
+        return self._cost
+
+    @property
+    def function(self):
+        """The shared generated function: positional input port values in,
+        tuple of output port values out (see CompiledCircuit.to_function)"""
+        return self._function
+
+    def evaluate(self, values, width=1):
+        """Return {output name: value} for {input name: value}
+
+        With width > 1 the values are ints packing width vectors.
+        """
+        mask = True if width == 1 else (1 << width) - 1
+        results = self._function(*(values[name] for name in self._input_names),
+                                 mask=mask)
+        return dict(zip(self._output_names, results))
+
+    def instance(self):
+        """Return a new ModuleInstance sharing this module's body"""
+        return ModuleInstance(self)
+
+    def instantiate(self, parent, prefix=None):
+        """Flatten a copy of the module's gates into parent.
+
+        Gate names are prefixed with prefix (by default the module name and
+        a running number).  Returns (input_ports, output_ports): dicts of
+        port name -> tuple of gate Inputs, and port name -> Output, for
+        wiring the copy into the rest of parent.
+        """
+        if prefix is None:
+            prefix = f"{self._name}{self._instances}."
+        self._instances += 1
+        groups, outputs = self._store.build_into(parent, prefix)
+        return (dict(zip(self._input_names, groups)),
+                dict(zip(self._output_names, outputs)))
+
+
+class ModuleInstance:
+    """Per-instance state of a Module: only its current port values"""
+
+    __slots__ = ("_module", "_inputs", "_outputs")
+
+    def __init__(self, module):
+        self._module = module
+        self._inputs = dict.fromkeys(module.input_names, False)
+        self._outputs = None
+
+    def __str__(self):
+        return (f"Instance of {self._module.name}: inputs={self._inputs}, "
+                f"outputs={self.outputs}")
+
+    @property
+    def module(self):
+        return self._module
+
+    def set(self, **values):
+        """Change some input port values"""
+        for name, value in values.items():
+            if name not in self._inputs:
+                raise KeyError(f"Module {self._module.name} has no input "
+                               f"{name!r}")
+            self._inputs[name] = bool(value)
+        self._outputs = None
+
+    @property
+    def outputs(self):
+        """{output name: value}, evaluated when inputs have changed"""
+        if self._outputs is None:
+            self._outputs = self._module.evaluate(self._inputs)
+        return self._outputs
+
+
+def _build_full_adder_module(circuit):
+    (a_inputs, b_inputs, ci_inputs), (sum_output, co_output) = \
+        build_full_adder(circuit)
+    circuit.add_input_port("a", *a_inputs)
+    circuit.add_input_port("b", *b_inputs)
+    circuit.add_input_port("ci", *ci_inputs)
+    circuit.add_output_port("sum", sum_output)
+    circuit.add_output_port("co", co_output)
+
+
+FULL_ADDER = Module("full_adder", _build_full_adder_module)
+
+
+def ripple_add(a, b, ci, bits, width=1):
+    """Add two bits-wide numbers with FULL_ADDER, one bit at a time.
+
+    a and b are lists of bits, least significant first: bools, or ints
+    packing width vectors.  Returns (sum bits, carry out).  The full adder
+    body is shared, so nothing is allocated per bit beyond the results.
+    """
+    add = FULL_ADDER.function
+    mask = True if width == 1 else (1 << width) - 1
+    # FULL_ADDER.input_names is ('a', 'b', 'ci'); outputs ('sum', 'co')
+    sums = []
+    carry = ci
+    for i in range(bits):
+        total, carry = add(a[i], b[i], carry, mask=mask)
+        sums.append(total)
+    return sums, carry
+
+
+def test():
+    """Umbrella test function"""
+    tests = [
+        test_full_adder_module,
+        test_instantiate,
+        test_ripple_add,
+    ]
+    for t in tests:
+        print("Running " + t.__name__ + " " + "-" * 20)
+        t()
+
+
+def test_full_adder_module():
+    print(FULL_ADDER)
+    instance = FULL_ADDER.instance()
+    for a in (False, True):
+        for b in (False, True):
+            for ci in (False, True):
+                instance.set(a=a, b=b, ci=ci)
+                total = a + b + ci
+                print(instance)
+                assert instance.outputs == {"sum": bool(total & 1),
+                                            "co": total >= 2}
+
+
+def test_instantiate():
+    parent = Circuit()
+    first_inputs, first_outputs = FULL_ADDER.instantiate(parent)
+    second_inputs, second_outputs = FULL_ADDER.instantiate(parent)
+    # Chain the carry of the first copy into the second one
+    for input_ in second_inputs["ci"]:
+        first_outputs["co"].connect(input_)
+    print(f"Parent has {len(parent)} gates, cost {parent.cost}: "
+          f"{[gate.name for gate in parent][:3]} ...")
+    for name, value in (("a", True), ("b", True), ("ci", True)):
+        for input_ in first_inputs[name]:
+            input_.value = value
+    for name, value in (("a", False), ("b", True)):
+        for input_ in second_inputs[name]:
+            input_.value = value
+    # 0b01 + 0b11 + 1 = 0b101
+    print(f"sum bits {first_outputs['sum']} {second_outputs['sum']}, "
+          f"carry {second_outputs['co']}")
+    assert first_outputs["sum"].value is True
+    assert second_outputs["sum"].value is False
+    assert second_outputs["co"].value is True
+    assert parent.cost == 2 * FULL_ADDER.cost
+
+
+def test_ripple_add():
+    import random
+
+    from logic_gate_part2 import pack, unpack
+
+    random.seed(13)
+    bits, width = 16, 256
+    numbers = [(random.getrandbits(bits), random.getrandbits(bits))
+               for _ in range(width)]
+    a = [pack([(x >> i) & 1 for x, _ in numbers]) for i in range(bits)]
+    b = [pack([(y >> i) & 1 for _, y in numbers]) for i in range(bits)]
+    sums, carry = ripple_add(a, b, 0, bits, width)
+    columns = [unpack(packed, width) for packed in sums + [carry]]
+    for k, (x, y) in enumerate(numbers):
+        assert sum(columns[i][k] << i for i in range(bits + 1)) == x + y
+    print(f"{width} additions of {bits}-bit numbers checked in one pass")
+
+
+if __name__ == '__main__':
+    test()
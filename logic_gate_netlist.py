@@ -0,0 +1,670 @@
+"""
+Netlist reading and writing for logic gate circuits (see logic_gate_part2.py)
+
+Supports the subset of BLIF (Berkeley Logic Interchange Format) with one
+clock: .model, .inputs, .outputs, .names, .latch and .end.  Each .names block
+becomes one gate (AND, OR, XOR, their complements, with any number of
+inputs, or NOT), chosen by the truth table of its cover, or a LutGate
+holding that table if it is none of those:
+
+    .names a b y        .names a y
+    11 1                0 1
+    (AND gate)          (NOT gate)
+
+Each .latch becomes a DFlipFlop; its type and control are ignored, as
+every flip-flop is on the circuit's clock, and an initial value of 2 or 3
+(don't care, unknown) becomes X.
+
+The reader is a streaming, line-at-a-time tokenizer: gates and
+Output.connect links are created as soon as each .names block ends, and
+references to nets that are not driven yet are remembered and wired up
+when their driver shows up.  The file is never held in memory as a whole.
+"""
+
+import re
+
+from logic_gate_part2 import (Circuit, DFlipFlop, LutGate, OP_AND, OP_LUT,
+                              OP_NAND, OP_NOR, OP_NOT, OP_OR, OP_XNOR, OP_XOR,
+                              X, make_gate)
+
+# Blocks with up to this many inputs are matched by truth table (which has
+# 2 ** inputs bits); wider ones only by the shape of their cover
+_TABLE_INPUTS = 8
+
+_BUFFER_TABLE = 0b10
+
+# .latch initial value -> DFlipFlop init
+_LATCH_INITS = {"0": False, "1": True, "2": X, "3": X}
+
+# Truth table -> opcode, per number of gate inputs, filled in on demand
+_TABLE_OPCODES = {1: {0b01: OP_NOT}}
+
+
+def _truth_table(opcode, inputs):
+    # Bit i of a table is the output for the input combination whose bit k
+    # is input k
+    table = 0
+    for index in range(1 << inputs):
+        ones = bin(index).count("1")
+        if opcode in (OP_AND, OP_NAND):
+            value = ones == inputs
+        elif opcode in (OP_OR, OP_NOR):
+            value = ones > 0
+        else:
+            value = ones % 2 == 1
+        if value != (opcode in (OP_NAND, OP_NOR, OP_XNOR)):
+            table |= 1 << index
+    return table
+
+
+def _table_opcode(table, inputs):
+    if inputs not in _TABLE_OPCODES:
+        _TABLE_OPCODES[inputs] = {
+            _truth_table(opcode, inputs): opcode
+            for opcode in (OP_AND, OP_OR, OP_XOR, OP_NAND, OP_NOR, OP_XNOR)}
+    return _TABLE_OPCODES[inputs].get(table)
+
+
+def _cover_opcode(cover, inputs):
+    # Recognize the covers _cover writes for wide gates: the single row of
+    # an AND, OR, NAND or NOR, or the minterms of an XOR or XNOR
+    if not cover or any(len(row) != 2 for row in cover):
+        return None
+    if len(cover) == 1:
+        shapes = {("1" * inputs, "1"): OP_AND, ("1" * inputs, "0"): OP_NAND,
+                  ("0" * inputs, "1"): OP_NOR, ("0" * inputs, "0"): OP_OR}
+        return shapes.get(tuple(cover[0]))
+    if len(cover) != 1 << (inputs - 1):
+        return None
+    patterns = {pattern for pattern, _ in cover}
+    parities = {pattern.count("1") % 2 for pattern in patterns}
+    if (len(patterns) != len(cover) or len(parities) != 1
+            or {row[1] for row in cover} != {"1"}
+            or any(len(pattern) != inputs or pattern.strip("01")
+                   for pattern in patterns)):
+        return None
+    return OP_XOR if parities == {1} else OP_XNOR
+
+
+def _cover(opcode, inputs):
+    """Return the cover lines of a gate, with input 0 in the leftmost column
+
+    Two-input OR and XOR use on-set rows; wide OR, NAND and NOR use their
+    single-row off-set or on-set cover, and XOR and XNOR list their
+    minterms.
+    """
+    if opcode == OP_NOT:
+        return ["0 1"]
+    if opcode == OP_AND:
+        return ["1" * inputs + " 1"]
+    if opcode == OP_NAND:
+        return ["1" * inputs + " 0"]
+    if opcode == OP_NOR:
+        return ["0" * inputs + " 1"]
+    if opcode == OP_OR:
+        if inputs == 2:
+            return ["1- 1", "-1 1"]
+        return ["0" * inputs + " 0"]
+    parity = 1 if opcode == OP_XOR else 0
+    return ["".join("1" if (index >> k) & 1 else "0" for k in range(inputs))
+            + " 1" for index in range(1 << inputs)
+            if bin(index).count("1") % 2 == parity]
+
+
+def _table_cover(table, inputs):
+    """Return the cover lines of a truth table: one row per minterm"""
+    return ["".join("1" if (index >> k) & 1 else "0" for k in range(inputs))
+            + " 1" for index in range(1 << inputs) if (table >> index) & 1]
+
+
+def _open(path_or_file, mode):
+    # Accept both paths and already open file objects
+    if hasattr(path_or_file, "read" if mode == "r" else "write"):
+        return path_or_file, False
+    return open(path_or_file, mode), True
+
+
+def _logical_lines(fp):
+    """Yield (line_number, tokens) per logical line, lazily.
+
+    Strips comments and joins lines continued with a trailing backslash.
+    """
+    pending = []
+    start = None
+    for number, line in enumerate(fp, 1):
+        line = line.split("#", 1)[0].rstrip()
+        if start is None:
+            start = number
+        if line.endswith("\\"):
+            pending.append(line[:-1])
+            continue
+        pending.append(line)
+        tokens = " ".join(pending).split()
+        pending = []
+        if tokens:
+            yield start, tokens
+        start = None
+    if pending:
+        tokens = " ".join(pending).split()
+        if tokens:
+            yield start, tokens
+
+
+def cover_to_table(cover, inputs, line=None):
+    """Return the truth table (an int) of a BLIF single-output cover"""
+    where = f" (line {line})" if line is not None else ""
+    if not cover:
+        # An empty cover is the constant 0
+        return 0
+    polarities = {row[-1] for row in cover}
+    if len(polarities) != 1 or not polarities <= {"0", "1"}:
+        raise ValueError(f"Cover mixes on-set and off-set rows{where}")
+    table = 0
+    for row in cover:
+        pattern = row[0] if inputs else ""
+        if len(row) != (2 if inputs else 1) or len(pattern) != inputs:
+            raise ValueError(f"Malformed cover row {' '.join(row)!r}{where}")
+        # Expand the don't-cares into every matching combination
+        free = [k for k, bit in enumerate(pattern) if bit == "-"]
+        base = 0
+        for k, bit in enumerate(pattern):
+            if bit == "1":
+                base |= 1 << k
+            elif bit not in "0-":
+                raise ValueError(f"Bad cover character {bit!r}{where}")
+        for combination in range(1 << len(free)):
+            index = base
+            for position, k in enumerate(free):
+                if (combination >> position) & 1:
+                    index |= 1 << k
+            table |= 1 << index
+    if polarities == {"0"}:
+        table ^= (1 << (1 << inputs)) - 1
+    return table
+
+
+class _BlifReader:
+    """State of one streaming read; see read_blif"""
+
+    def __init__(self, circuit):
+        self.circuit = circuit
+        # Primary input nets, in declaration order
+        self.primary = {}
+        self.outputs = []
+        # net -> Output driving it, and net -> constant value
+        self.drivers = {}
+        self.constants = {}
+        # net -> nets defined as buffers of it
+        self.aliases = {}
+        # net -> gate Inputs waiting for that net to be defined
+        self.waiting = {}
+
+    def read_net(self, net, input_):
+        """Connect input_ to net now, or once net is defined"""
+        if net in self.drivers:
+            self.drivers[net].connect(input_)
+        elif net in self.constants:
+            input_.value = self.constants[net]
+        else:
+            self.waiting.setdefault(net, []).append(input_)
+
+    def define(self, net, line, driver=None, constant=None, source=None):
+        if net in self.drivers or net in self.constants or net in self.primary:
+            raise ValueError(f"Net {net!r} is defined twice (line {line})")
+        if source is not None:
+            # A buffer: net is another name for source
+            self.aliases.setdefault(source, []).append(net)
+            if source in self.drivers:
+                self.define(net, line, driver=self.drivers[source])
+            elif source in self.constants:
+                self.define(net, line, constant=self.constants[source])
+            return
+        if driver is not None:
+            self.drivers[net] = driver
+        else:
+            self.constants[net] = constant
+        for input_ in self.waiting.pop(net, ()):
+            self.read_net(net, input_)
+        for alias in self.aliases.get(net, ()):
+            self.define(alias, line, driver=driver, constant=constant)
+
+    def names(self, nets, cover, line):
+        *inputs, output = nets
+        if len(inputs) > _TABLE_INPUTS:
+            opcode = _cover_opcode(cover, len(inputs))
+        else:
+            table = cover_to_table(cover, len(inputs), line)
+            if not inputs:
+                self.define(output, line, constant=bool(table))
+                return
+            if len(inputs) == 1 and table == _BUFFER_TABLE:
+                self.define(output, line, source=inputs[0])
+                return
+            opcode = _table_opcode(table, len(inputs))
+        if opcode is None and len(inputs) <= _TABLE_INPUTS:
+            gate = LutGate(output, self.circuit, len(inputs), table)
+        elif opcode is None:
+            raise ValueError(f"Unsupported function for net {output!r} "
+                             f"(line {line})")
+        else:
+            gate = make_gate(opcode, output, self.circuit, len(inputs))
+        for input_, net in zip(gate.inputs, inputs):
+            self.read_net(net, input_)
+        self.define(output, line, driver=gate.output)
+
+    def latch(self, tokens, line):
+        # .latch input output [type control] [init]
+        if len(tokens) not in (2, 3, 4, 5):
+            raise ValueError(f"Malformed .latch (line {line})")
+        init = tokens[-1] if len(tokens) in (3, 5) else "3"
+        if init not in _LATCH_INITS:
+            raise ValueError(f"Bad .latch initial value {init!r} "
+                             f"(line {line})")
+        data, output = tokens[:2]
+        flip_flop = DFlipFlop(output, self.circuit, _LATCH_INITS[init])
+        self.read_net(data, flip_flop.d)
+        self.define(output, line, driver=flip_flop.q)
+
+    def finish(self):
+        # Output ports are gate outputs, so an output that is a primary
+        # input (possibly by alias) or a constant gets a buffer
+        buffers = {}
+        for net in self.outputs:
+            if net not in self.drivers and net not in buffers:
+                buffers[net] = LutGate(net, self.circuit, 1, _BUFFER_TABLE)
+                if net in self.constants:
+                    buffers[net].inputs[0].value = self.constants[net]
+                else:
+                    self.waiting.setdefault(net, []).append(
+                        buffers[net].inputs[0])
+        # Whatever still waits must be a primary input (possibly by alias)
+        for net in self.primary:
+            names = [net]
+            for name in names:
+                self.circuit.add_input_port(net, *self.waiting.pop(name, ()))
+                names.extend(self.aliases.get(name, ()))
+        if self.waiting:
+            net = next(iter(self.waiting))
+            raise ValueError(f"Net {net!r} is used but never defined")
+        for net in self.outputs:
+            if net in buffers:
+                self.circuit.add_output_port(net, buffers[net].output)
+                continue
+            driver = self.drivers[net]
+            if isinstance(driver.owner, DFlipFlop):
+                # Buffer the flip-flop too
+                buffer = LutGate(net, self.circuit, 1, _BUFFER_TABLE)
+                driver.connect(buffer.inputs[0])
+                driver = buffer.output
+            self.circuit.add_output_port(net, driver)
+        return self.circuit
+
+
+def read_blif(path_or_file, circuit=None):
+    """Read a BLIF netlist into circuit (a new Circuit by default)
+
+    The model's .inputs and .outputs become the circuit's named ports.
+    """
+    reader = _BlifReader(Circuit() if circuit is None else circuit)
+    fp, close = _open(path_or_file, "r")
+    try:
+        block = None
+        for line, tokens in _logical_lines(fp):
+            keyword = tokens[0]
+            if not keyword.startswith("."):
+                if block is None:
+                    raise ValueError(f"Cover row outside .names (line {line})")
+                block[1].append(tokens)
+                continue
+            if block is not None:
+                reader.names(*block)
+                block = None
+            if keyword == ".names":
+                if len(tokens) < 2:
+                    raise ValueError(f".names without nets (line {line})")
+                block = (tokens[1:], [], line)
+            elif keyword == ".inputs":
+                reader.primary.update(dict.fromkeys(tokens[1:]))
+            elif keyword == ".outputs":
+                reader.outputs.extend(tokens[1:])
+            elif keyword == ".latch":
+                reader.latch(tokens[1:], line)
+            elif keyword == ".end":
+                break
+            elif keyword != ".model":
+                raise ValueError(f"Unsupported BLIF construct {keyword} "
+                                 f"(line {line})")
+        if block is not None:
+            reader.names(*block)
+    finally:
+        if close:
+            fp.close()
+    return reader.finish()
+
+
+def _net_name(name, used):
+    # BLIF nets are whitespace-separated tokens and '#' starts a comment
+    net = re.sub(r"[\s#\\]+", "_", name) or "n"
+    if net in used:
+        suffix = 1
+        while f"{net}_{suffix}" in used:
+            suffix += 1
+        net = f"{net}_{suffix}"
+    used.add(net)
+    return net
+
+
+def write_blif(circuit, path_or_file, model="circuit"):
+    """Write circuit as a BLIF model, one gate at a time
+
+    Input and output ports keep their names; other nets are named after
+    the gate or flip-flop driving them.  Unported inputs that have a value
+    are written as constants.  Flip-flops become .latch lines.
+    """
+    input_ports = circuit.input_ports()
+    output_ports = circuit.output_ports()
+    used = set()
+    nets = {}
+    input_nets = []
+    for name, inputs in input_ports.items():
+        input_nets.append(_net_name(name, used))
+        for input_ in inputs:
+            nets[input_] = input_nets[-1]
+    output_nets = []
+    # (net, net it copies) for the ports that share an Output with an
+    # earlier port: the Output drives that one's net, a buffer the others
+    copies = []
+    for name, output in output_ports.items():
+        output_nets.append(_net_name(name, used))
+        if output in nets:
+            copies.append((output_nets[-1], nets[output]))
+        else:
+            nets[output] = output_nets[-1]
+    fp, close = _open(path_or_file, "w")
+    try:
+        fp.write(f".model {_net_name(model, set())}\n")
+        fp.write(".inputs " + " ".join(input_nets) + "\n")
+        fp.write(".outputs " + " ".join(output_nets) + "\n")
+        constants = {}
+        # Name every net first: a gate on a combinational loop, or a
+        # flip-flop, reads a net written further down
+        flip_flops = circuit.flip_flops()
+        for element in flip_flops + tuple(circuit.topological_order()):
+            if element.output not in nets:
+                nets[element.output] = _net_name(element.name, used)
+
+        def operand(input_):
+            if input_ in nets:
+                return nets[input_]
+            if input_.driver is not None and input_.driver in nets:
+                return nets[input_.driver]
+            value = input_.value
+            if value is X:
+                raise ValueError(f"An input of {input_.owner.name} is "
+                                 f"neither driven, part of a port, nor set")
+            if value not in constants:
+                constants[value] = _net_name(f"const{int(value)}", used)
+                fp.write(f".names {constants[value]}\n"
+                         + ("1\n" if value else ""))
+            return constants[value]
+
+        for flip_flop in flip_flops:
+            init = 3 if flip_flop.init is X else int(flip_flop.init)
+            fp.write(f".latch {operand(flip_flop.d)} "
+                     f"{nets[flip_flop.q]} {init}\n")
+        for gate in circuit.topological_order():
+            operands = [operand(input_) for input_ in gate.inputs]
+            fp.write(f".names {' '.join(operands)} {nets[gate.output]}\n")
+            if gate.OPCODE == OP_LUT:
+                cover = _table_cover(gate.table, len(operands))
+            else:
+                cover = _cover(gate.OPCODE, len(operands))
+            fp.write("".join(line + "\n" for line in cover))
+        for net, source in copies:
+            fp.write(f".names {source} {net}\n1 1\n")
+        fp.write(".end\n")
+    finally:
+        if close:
+            fp.close()
+
+
+def test():
+    """Umbrella test function"""
+    tests = [
+        test_read,
+        test_round_trip,
+        test_wide_gates,
+        test_lut_gates,
+        test_latches,
+        test_buffered_outputs,
+    ]
+    for t in tests:
+        print("Running " + t.__name__ + " " + "-" * 20)
+        t()
+
+
+def test_read():
+    import io
+
+    # Gates appear before the nets they read are defined, on purpose
+    text = io.StringIO("""\
+# 1-bit full adder
+.model full_adder
+.inputs a b \\
+        ci
+.outputs sum co
+.names p ci sum
+10 1
+01 1
+.names g t co
+00 0
+.names a b p
+10 1
+01 1
+.names p ci t
+11 1
+.names a b g
+11 1
+.end
+""")
+    circuit = read_blif(text)
+    print(circuit)
+    for a in (False, True):
+        for b in (False, True):
+            for ci in (False, True):
+                circuit.set_inputs({"a": a, "b": b, "ci": ci})
+                outputs = circuit.output_ports()
+                total = a + b + ci
+                print(f"a={a} b={b} ci={ci}: sum={outputs['sum']} "
+                      f"co={outputs['co']}")
+                assert outputs["sum"].value == bool(total & 1)
+                assert outputs["co"].value == (total >= 2)
+
+
+def test_round_trip():
+    import io
+
+    from logic_gate_part2 import build_full_adder, exhaustive_stimulus
+
+    circuit = Circuit()
+    build_full_adder(circuit)
+    text = io.StringIO()
+    write_blif(circuit, text, model="full adder")
+    print(text.getvalue(), end="")
+    text.seek(0)
+    loaded = read_blif(text)
+    patterns, width = exhaustive_stimulus(list(circuit.input_ports()))
+    results = []
+    for each in (circuit, loaded):
+        stimulus = {input_: patterns[name] for name, inputs
+                    in each.input_ports().items() for input_ in inputs}
+        signals = each.simulate_packed(stimulus, width)
+        results.append({name: signals[output]
+                        for name, output in each.output_ports().items()})
+    print(results)
+    assert results[0] == results[1]
+    # Two ports on one Output: the second is written as a buffer
+    circuit = Circuit()
+    gate = make_gate(OP_AND, "and", circuit)
+    circuit.add_input_port("p", gate.input0)
+    circuit.add_input_port("q", gate.input1)
+    circuit.add_output_port("y", gate.output)
+    circuit.add_output_port("z", gate.output)
+    text = io.StringIO()
+    write_blif(circuit, text)
+    text.seek(0)
+    loaded = read_blif(text)
+    assert len(loaded) == 1
+    outputs = loaded.output_ports()
+    assert list(outputs) == ["y", "z"] and outputs["y"] is outputs["z"]
+
+
+def test_wide_gates():
+    import io
+    import random
+
+    from logic_gate_part2 import NARY_CLASSES
+
+    # One gate of every N-ary type, with 3 and with 12 inputs, reading a
+    # shared set of primary inputs
+    circuit = Circuit()
+    gates = []
+    for fan_in in (3, 12):
+        for opcode in sorted(NARY_CLASSES):
+            gates.append(make_gate(opcode, f"g{len(gates)}", circuit, fan_in))
+    for k in range(12):
+        circuit.add_input_port(f"x{k}", *[gate.inputs[k] for gate in gates
+                                          if k < len(gate.inputs)])
+    text = io.StringIO()
+    write_blif(circuit, text)
+    lines = text.getvalue().splitlines()
+    print("\n".join(line for line in lines if line.startswith(".names")))
+    print(f"{len(lines)} lines in all")
+    text.seek(0)
+    loaded = read_blif(text)
+    assert ([type(gate) for gate in loaded.topological_order()]
+            == [type(gate) for gate in circuit.topological_order()])
+    random.seed(20)
+    for _ in range(50):
+        values = {f"x{k}": random.random() < 0.5 for k in range(12)}
+        results = []
+        for each in (circuit, loaded):
+            each.set_inputs(values)
+            results.append({name: output.value
+                            for name, output in each.output_ports().items()})
+        assert results[0] == results[1]
+
+
+def test_lut_gates():
+    import io
+
+    from logic_gate_part2 import LutGate
+
+    # A 3-input majority is not one of the gate types, so it is read as a
+    # LutGate, and written back as its minterms
+    text = io.StringIO(""".model majority
+.inputs a b c
+.outputs m
+.names a b c m
+11- 1
+1-1 1
+-11 1
+.end
+""")
+    circuit = read_blif(text)
+    gate, = circuit
+    print(gate)
+    assert isinstance(gate, LutGate) and gate.table == 0xE8
+    text = io.StringIO()
+    write_blif(circuit, text)
+    print(text.getvalue(), end="")
+    text.seek(0)
+    assert [gate.table for gate in read_blif(text)] == [0xE8]
+
+
+def test_latches():
+    import io
+
+    # A 2-bit counter with an enable, and its carry-out as an output
+    text = io.StringIO(""".model counter
+.inputs en
+.outputs q0 q1 co
+.latch d0 q0 0
+.latch d1 q1 re clk 1
+.names en q0 d0
+01 1
+10 1
+.names en q0 c0
+11 1
+.names c0 q1 d1
+01 1
+10 1
+.names c0 q1 co
+11 1
+.end
+""")
+    circuit = read_blif(text)
+    assert [flip_flop.init for flip_flop in circuit.flip_flops()] == [
+        False, True]
+    assert not circuit.loops()
+
+    def count(each):
+        # q1 q0 starts at 2 and counts up while en is 1
+        each.set_inputs({"en": True})
+        values = []
+        for _ in range(5):
+            outputs = each.output_ports()
+            values.append(outputs["q0"].value + 2 * outputs["q1"].value)
+            each.clock()
+        return values
+
+    assert count(circuit) == [2, 3, 0, 1, 2]
+    text = io.StringIO()
+    write_blif(circuit, text)
+    print(text.getvalue(), end="")
+    text.seek(0)
+    assert count(read_blif(text)) == [2, 3, 0, 1, 2]
+
+
+def test_buffered_outputs():
+    import io
+
+    from logic_gate_mapping import map_luts
+    from logic_gate_optimize import optimize
+
+    # An output that is an input, another by way of a buffer, and a constant
+    text = io.StringIO("""\
+.model buffers
+.inputs a b
+.outputs a c one
+.names b c
+1 1
+.names one
+1
+.end
+""")
+    circuit = read_blif(text)
+    assert list(circuit.output_ports()) == ["a", "c", "one"]
+    circuit.set_inputs({"a": True, "b": False})
+    assert [output.value for output in circuit.output_ports().values()] == [
+        True, False, True]
+    # NOT NOT a optimizes and maps to a buffer, which reads back
+    circuit = Circuit()
+    first = make_gate(OP_NOT, "not0", circuit)
+    second = make_gate(OP_NOT, "not1", circuit)
+    first.output.connect(second.input)
+    circuit.add_input_port("a", first.input)
+    circuit.add_output_port("y", second.output)
+    for copy, _ in (optimize(circuit), map_luts(circuit)):
+        text = io.StringIO()
+        write_blif(copy, text)
+        print(text.getvalue(), end="")
+        text.seek(0)
+        loaded = read_blif(text)
+        for value in (False, True):
+            loaded.set_inputs({"a": value})
+            assert loaded.output_ports()["y"].value is value
+
+
+if __name__ == '__main__':
+    test()
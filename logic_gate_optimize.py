@@ -0,0 +1,634 @@
+"""
+Logic optimization for logic gate circuits (see logic_gate_part2.py)
+
+optimize() rebuilds a circuit through a structurally hashed network, which
+does three things at once:
+
+- constant propagation: undriven inputs that are not part of an input
+  port but have a value are constants (as in write_blif), and every gate
+  they reach is simplified (an AND with a 0 input is 0, an XOR with a 1
+  input is inverted, a LUT is cut down to the rest of its table, ...);
+- structural hashing: every gate is normalized (NOT gates folded into
+  complemented edges, inputs sorted) and looked up in a hash table, so
+  identical gates with identical fan-in become one node;
+- dead-logic elimination: only the nodes the output ports read are
+  turned back into gates.
+
+The network has AND and XOR nodes with complemented edges, and LUT nodes
+for LutGates; with aig=True, XOR and wide ANDs are broken down further
+into two-input AND nodes, giving an and-inverter graph, whose hashing
+finds more shared logic.  Before the gates are built, the XORs and the
+unshared AND trees of that graph are turned back into XOR and wide AND
+nodes.  Complemented edges are absorbed into OR, NAND, NOR and XNOR gates
+where possible, and become shared NOT gates otherwise.
+"""
+
+from logic_gate_part2 import (Circuit, Input, LutGate, OP_AND, OP_LUT,
+                              OP_NAND, OP_NOR, OP_NOT, OP_OR, OP_XNOR, OP_XOR,
+                              Output, X, make_gate)
+
+# Literals are 2 * node + complemented; node 0 is the constant 0
+FALSE = 0
+TRUE = 1
+
+# Node kind of the primary inputs of the network
+_INPUT = -1
+
+
+def optimize(circuit, aig=False):
+    """Return (optimized, report): an equivalent, optimized copy of circuit
+
+    The copy has the same mode and the same input and output ports (see
+    Circuit.input_ports and Circuit.output_ports), with the same input
+    values; only what the output ports depend on is kept.  report holds
+    the "gates" count and "cost" of "before" and "after", and under
+    "removed" the names of the gates that were folded to a "constant",
+    merged into an identical gate ("duplicate"), reduced to one of their
+    inputs ("simplified") or found to drive no output ("dead").  Only
+    combinational circuits fit: one with flip-flops raises ValueError.
+    """
+    circuit._require_acyclic("Optimization")
+    if circuit.flip_flops():
+        raise ValueError("Optimization works on combinational logic only, "
+                         "not flip-flops")
+    network = _Network(aig)
+    literals = {}
+    names = {}
+    removed = {"constant": [], "duplicate": [], "simplified": [], "dead": []}
+    owners = {}
+    for gate, signals in circuit._signals().items():
+        inputs = []
+        for signal in signals:
+            if isinstance(signal, Output):
+                inputs.append(literals[signal])
+            elif (isinstance(signal, Input) and signal.driver is None
+                  and signal.value is not X):
+                inputs.append(TRUE if signal.value else FALSE)
+            else:
+                inputs.append(network.input(signal))
+        first = len(network.nodes)
+        literal = network.gate(gate, inputs)
+        literals[gate.output] = literal
+        node = literal >> 1
+        for index, created in enumerate(range(first, len(network.nodes))):
+            names[created] = (gate.name if created == node
+                              else f"{gate.name}.{index}")
+        if node >= first:
+            owners[node] = gate
+        elif node == 0:
+            removed["constant"].append(gate.name)
+        elif (node in {input_ >> 1 for input_ in inputs}
+              or network.kinds[node] == _INPUT):
+            removed["simplified"].append(gate.name)
+        else:
+            removed["duplicate"].append(gate.name)
+    roots = {name: literals[output]
+             for name, output in circuit.output_ports().items()}
+    needed = _needed(network, roots)
+    removed["dead"] = [gate.name for node, gate in owners.items()
+                       if node not in needed]
+    if aig:
+        network, roots, names = _compact(network, roots, names, needed)
+    optimized = _Builder(circuit, network, names).build(roots)
+    report = {
+        "before": {"gates": len(circuit), "cost": circuit.cost},
+        "after": {"gates": len(optimized.circuit),
+                  "cost": optimized.circuit.cost},
+        "removed": removed,
+    }
+    return optimized.circuit, report
+
+
+class _Network:
+    """A structurally hashed network of AND, XOR and LUT nodes"""
+
+    def __init__(self, aig):
+        self.aig = aig
+        # Per node: kind (_INPUT or an OP_* code), fan-in literals, and
+        # the table of a LUT node (the key of an input node)
+        self.kinds = [None]
+        self.fanins = [()]
+        self.tables = [None]
+        self.hashed = {}
+
+    @property
+    def nodes(self):
+        return self.kinds
+
+    def _node(self, kind, fanins, table=None):
+        key = (kind, fanins, table)
+        node = self.hashed.get(key)
+        if node is None:
+            node = self.hashed[key] = len(self.kinds)
+            self.kinds.append(kind)
+            self.fanins.append(fanins)
+            self.tables.append(table)
+        return 2 * node
+
+    def input(self, key):
+        return self._node(_INPUT, (), key)
+
+    def gate(self, gate, inputs):
+        """Return the literal of gate's output, given its input literals"""
+        opcode = gate.OPCODE
+        if opcode == OP_NOT:
+            return inputs[0] ^ 1
+        if opcode in (OP_AND, OP_NAND):
+            return self.and_(inputs) ^ (opcode == OP_NAND)
+        if opcode in (OP_OR, OP_NOR):
+            return self.and_([input_ ^ 1 for input_ in inputs]) ^ (
+                opcode == OP_OR)
+        if opcode in (OP_XOR, OP_XNOR):
+            return self.xor(inputs) ^ (opcode == OP_XNOR)
+        return self.lut(gate.table, inputs)
+
+    def and_(self, inputs):
+        literals = set()
+        for literal in inputs:
+            if literal == FALSE or literal ^ 1 in literals:
+                return FALSE
+            if literal != TRUE:
+                literals.add(literal)
+        if not literals:
+            return TRUE
+        literals = sorted(literals)
+        if len(literals) == 1:
+            return literals[0]
+        if self.aig and len(literals) > 2:
+            half = len(literals) // 2
+            return self.and_([self.and_(literals[:half]),
+                              self.and_(literals[half:])])
+        return self._node(OP_AND, tuple(literals))
+
+    def xor(self, inputs):
+        parity = 0
+        nodes = set()
+        for literal in inputs:
+            parity ^= literal & 1
+            # x ^ x is 0
+            nodes ^= {literal & ~1} - {FALSE}
+        if not nodes:
+            return parity
+        literals = sorted(nodes)
+        if len(literals) == 1:
+            return literals[0] ^ parity
+        if self.aig:
+            literal = literals[0]
+            for other in literals[1:]:
+                # a ^ b is the NOR of a & b and ~a & ~b
+                literal = self.and_([self.and_([literal, other]) ^ 1,
+                                     self.and_([literal ^ 1, other ^ 1]) ^ 1])
+            return literal ^ parity
+        return self._node(OP_XOR, tuple(literals)) ^ parity
+
+    def lut(self, table, inputs):
+        literals = list(inputs)
+        # Constant inputs select half of the table
+        for position in reversed(range(len(literals))):
+            if literals[position] in (FALSE, TRUE):
+                table = _restrict(table, len(literals), position,
+                                  literals.pop(position))
+        # Complemented inputs flip the table around that input
+        for position, literal in enumerate(literals):
+            if literal & 1:
+                table = _flip(table, len(literals), position)
+                literals[position] ^= 1
+        # An input read twice keeps only the rows where both agree
+        for position in reversed(range(len(literals))):
+            first = literals.index(literals[position])
+            if first != position:
+                table = _merge(table, len(literals), first, position)
+                del literals[position]
+        # Inputs the table doesn't depend on
+        for position in reversed(range(len(literals))):
+            low = _restrict(table, len(literals), position, 0)
+            if low == _restrict(table, len(literals), position, 1):
+                table = low
+                del literals[position]
+        count = len(literals)
+        if not count:
+            return table & 1
+        order = sorted(range(count), key=literals.__getitem__)
+        table = _permute(table, count, order)
+        literals = [literals[position] for position in order]
+        # Keep the complement of a table whose row 0 is 1, so a table and
+        # its complement share a node
+        complemented = table & 1
+        if complemented:
+            table ^= (1 << (1 << count)) - 1
+        if count == 1:
+            return literals[0] ^ complemented
+        ones = [index for index in range(1 << count) if (table >> index) & 1]
+        if len(ones) == 1:
+            # A single row: an AND of the inputs, some complemented
+            return self.and_([literal ^ (1 - ((ones[0] >> position) & 1))
+                              for position, literal in enumerate(literals)]
+                             ) ^ complemented
+        if table == (1 << (1 << count)) - 2:
+            # Every row but row 0: an OR
+            return self.and_([literal ^ 1 for literal in literals]) ^ (
+                1 ^ complemented)
+        if table == _parity(count):
+            return self.xor(literals) ^ complemented
+        return self._node(OP_LUT, tuple(literals), table) ^ complemented
+
+
+def _needed(network, roots):
+    # The nodes the roots depend on
+    needed = set()
+    pending = [literal >> 1 for literal in roots.values()]
+    while pending:
+        node = pending.pop()
+        if node not in needed:
+            needed.add(node)
+            pending.extend(literal >> 1 for literal in network.fanins[node])
+    needed.discard(0)
+    return needed
+
+
+def _compact(network, roots, names, needed):
+    # Rebuild the needed part of an and-inverter graph with XOR nodes for
+    # the AND triples that make one, and one wide AND for every AND node
+    # that only feeds another AND uncomplemented; returns the new network,
+    # roots and node names
+    fanout = {}
+    for node in needed:
+        for literal in network.fanins[node]:
+            fanout[literal >> 1] = fanout.get(literal >> 1, 0) + 1
+    for literal in roots.values():
+        fanout[literal >> 1] = fanout.get(literal >> 1, 0) + 1
+    compact = _Network(False)
+    literals = {0: FALSE}
+    compact_names = {}
+
+    def mapped(literal):
+        return literals[literal >> 1] ^ (literal & 1)
+
+    # Fan-ins come before the nodes reading them, so node order will do
+    for node in sorted(needed):
+        kind = network.kinds[node]
+        fanins = network.fanins[node]
+        first = len(compact.kinds)
+        if kind == _INPUT:
+            literal = compact.input(network.tables[node])
+        elif kind == OP_LUT:
+            literal = compact.lut(network.tables[node],
+                                  [mapped(fanin) for fanin in fanins])
+        elif kind == OP_XOR:
+            literal = compact.xor([mapped(fanin) for fanin in fanins])
+        elif _xor_pair(network, fanins) is not None:
+            # Both ANDs read each side, so a side read by nothing else
+            # has a fan-out of 2, and an XOR there joins this one
+            inputs = []
+            alone = all(fanout[fanin >> 1] == 1 for fanin in fanins)
+            for side in _xor_pair(network, fanins):
+                new = mapped(side)
+                if (alone and fanout[side >> 1] == 2
+                        and compact.kinds[new >> 1] == OP_XOR):
+                    inputs.extend(compact.fanins[new >> 1])
+                    inputs.append(new & 1)
+                else:
+                    inputs.append(new)
+            literal = compact.xor(inputs)
+        else:
+            inputs = []
+            for fanin in fanins:
+                new = mapped(fanin)
+                if (fanout[fanin >> 1] == 1 and not new & 1
+                        and compact.kinds[new >> 1] == OP_AND):
+                    inputs.extend(compact.fanins[new >> 1])
+                else:
+                    inputs.append(new)
+            literal = compact.and_(inputs)
+        literals[node] = literal
+        if kind != _INPUT:
+            for index, created in enumerate(range(first,
+                                                  len(compact.kinds))):
+                compact_names[created] = (names[node] if index == 0
+                                          else f"{names[node]}.{index}")
+    return (compact, {name: mapped(literal)
+                      for name, literal in roots.items()}, compact_names)
+
+
+def _xor_pair(network, fanins):
+    # The two literals whose XOR an AND node with fanins is, if it is the
+    # NOR of their AND and the AND of their complements, or None
+    if len(fanins) != 2 or not fanins[0] & fanins[1] & 1:
+        return None
+    first, second = (network.fanins[literal >> 1] for literal in fanins)
+    if (network.kinds[fanins[0] >> 1] != OP_AND
+            or network.kinds[fanins[1] >> 1] != OP_AND
+            or len(first) != 2
+            or sorted(literal ^ 1 for literal in first) != list(second)):
+        return None
+    return first
+
+
+class _Builder:
+    """Turns the needed part of a _Network back into gates"""
+
+    def __init__(self, circuit, network, names):
+        self.original = circuit
+        self.network = network
+        self.names = names
+        self.circuit = Circuit(circuit.mode)
+        # Literal -> what reads it: an Output, or the port name or Input
+        # key of a network input
+        self.sources = {}
+        # Network input key -> the new gate inputs that read it
+        self.pins = {}
+
+    def build(self, roots):
+        network = self.network
+        # Polarities each needed node is read with (1 plain, 2 inverted),
+        # consumers first
+        uses = {}
+        for literal in roots.values():
+            if literal > TRUE:
+                uses[literal >> 1] = uses.get(literal >> 1, 0) | (
+                    1 << (literal & 1))
+        for node in range(len(network.kinds) - 1, 0, -1):
+            if node in uses:
+                for literal in self._reads(node):
+                    uses[literal >> 1] = uses.get(literal >> 1, 0) | (
+                        1 << (literal & 1))
+        for node in sorted(uses):
+            self._build_node(node, uses[node])
+        for name, literal in roots.items():
+            self.circuit.add_output_port(name, self._output(name, literal))
+        original_ports = self.original.input_ports()
+        for name in original_ports:
+            self.circuit.add_input_port(name, *self.pins.get(name, ()))
+        # Carry the input values over
+        for key, inputs in self.pins.items():
+            if isinstance(key, Input):
+                value = key.value if key.driver is None else X
+            else:
+                value = original_ports[key][0].value
+            if value is not X:
+                for input_ in inputs:
+                    input_.value = value
+        return self
+
+    def _reads(self, node):
+        # The literals node's gate reads
+        kind = self.network.kinds[node]
+        fanins = self.network.fanins[node]
+        if kind == OP_AND and all(literal & 1 for literal in fanins):
+            # Built as a NOR or an OR of the plain inputs
+            return [literal ^ 1 for literal in fanins]
+        return fanins
+
+    def _build_node(self, node, uses):
+        network = self.network
+        kind = network.kinds[node]
+        if kind == _INPUT:
+            self.sources[2 * node] = network.tables[node]
+            if uses & 2:
+                name = _key_name(network.tables[node])
+                self.sources[2 * node + 1] = self._gate(
+                    OP_NOT, f"not_{name}", [2 * node]).output
+            return
+        fanins = network.fanins[node]
+        table = network.tables[node]
+        if kind == OP_AND and all(literal & 1 for literal in fanins):
+            plain, inverted = OP_NOR, OP_OR
+        elif kind == OP_AND:
+            plain, inverted = OP_AND, OP_NAND
+        elif kind == OP_XOR:
+            plain, inverted = OP_XOR, OP_XNOR
+        else:
+            plain = inverted = OP_LUT
+        # Build the polarity that is read, or the plain one and a NOT
+        polarity = 1 if uses == 2 else 0
+        if kind == OP_LUT and polarity:
+            table ^= (1 << (1 << len(fanins))) - 1
+        gate = self._gate(inverted if polarity else plain, self.names[node],
+                          self._reads(node), table)
+        self.sources[2 * node + polarity] = gate.output
+        if uses == 3:
+            self.sources[2 * node + 1] = self._gate(
+                OP_NOT, f"not_{self.names[node]}", [2 * node]).output
+
+    def _gate(self, opcode, name, literals, table=None):
+        gate = make_gate(opcode, name, self.circuit, len(literals), table)
+        for input_, literal in zip(gate.inputs, literals):
+            source = self.sources[literal]
+            if isinstance(source, Output):
+                source.connect(input_)
+            else:
+                self.pins.setdefault(source, []).append(input_)
+                if isinstance(source, Input) and source.driver is not None:
+                    source.driver.connect(input_)
+        return gate
+
+    def _output(self, name, literal):
+        # An Output for an output port; constants and inputs need a gate
+        if literal in (FALSE, TRUE):
+            gate = LutGate(name, self.circuit, 1, 0b11 if literal else 0)
+            gate.inputs[0].value = False
+            return gate.output
+        source = self.sources[literal]
+        if isinstance(source, Output):
+            return source
+        # An input (or its negation, if that has no NOT gate) needs a buffer
+        return self._gate(OP_LUT, name, [literal], 0b10).output
+
+
+def _key_name(key):
+    if isinstance(key, Input):
+        return f"{key.owner.name}.in{key.owner.inputs.index(key)}"
+    return str(key)
+
+
+# Truth table surgery for LUT nodes; bit i of a table of count inputs is
+# the output for the inputs whose bit k is input k
+
+def _restrict(table, count, position, value):
+    # The table of the other inputs, with input position fixed to value
+    result = 0
+    low = (1 << position) - 1
+    for index in range(1 << count):
+        if (index >> position) & 1 == value and (table >> index) & 1:
+            result |= 1 << ((index & low) | (index >> (position + 1)
+                                             << position))
+    return result
+
+
+def _flip(table, count, position):
+    # The table with input position complemented
+    result = 0
+    for index in range(1 << count):
+        if (table >> index) & 1:
+            result |= 1 << (index ^ (1 << position))
+    return result
+
+
+def _merge(table, count, first, second):
+    # The table without input second, which always equals input first
+    result = 0
+    low = (1 << second) - 1
+    for index in range(1 << (count - 1)):
+        bit = (index >> first) & 1 if first < second else 0
+        expanded = (index & low) | (bit << second) | (index >> second
+                                                      << (second + 1))
+        if (table >> expanded) & 1:
+            result |= 1 << index
+    return result
+
+
+def _permute(table, count, order):
+    # The table whose input k is input order[k] of table
+    result = 0
+    for index in range(1 << count):
+        original = 0
+        for position, source in enumerate(order):
+            if (index >> position) & 1:
+                original |= 1 << source
+        if (table >> original) & 1:
+            result |= 1 << index
+    return result
+
+
+def _parity(count):
+    return sum(1 << index for index in range(1 << count)
+               if bin(index).count("1") % 2)
+
+
+def test():
+    """Umbrella test function"""
+    tests = [
+        test_optimize,
+        test_aig,
+        test_lut_folding,
+    ]
+    for t in tests:
+        print("Running " + t.__name__ + " " + "-" * 20)
+        t()
+
+
+def _equivalent(circuit, optimized):
+    from logic_gate_part2 import exhaustive_stimulus
+
+    patterns, width = exhaustive_stimulus(list(circuit.input_ports()))
+    results = []
+    for each in (circuit, optimized):
+        stimulus = {input_: patterns[name]
+                    for name, inputs in each.input_ports().items()
+                    for input_ in inputs}
+        signals = each.simulate_packed(stimulus, width)
+        results.append({name: signals[output]
+                        for name, output in each.output_ports().items()})
+    return results[0] == results[1]
+
+
+def test_optimize():
+    from logic_gate_part2 import (AndGate, OrGate, build_counter,
+                                  build_full_adder)
+
+    # Two full adders over the same operands, a carry-in tied to 0, and a
+    # gate that drives nothing
+    circuit = Circuit()
+    ports = {"a": [], "b": [], "ci": []}
+    outputs = []
+    for _ in range(2):
+        (a_inputs, b_inputs, ci_inputs), (sum_output, co_output) = \
+            build_full_adder(circuit)
+        ports["a"] += a_inputs
+        ports["b"] += b_inputs
+        ports["ci"] += ci_inputs
+        outputs += [sum_output, co_output]
+    for input_ in ports.pop("ci"):
+        input_.value = False
+    for name, inputs in ports.items():
+        circuit.add_input_port(name, *inputs)
+    for name, output in zip(("s0", "c0", "s1", "c1"), outputs):
+        circuit.add_output_port(name, output)
+    unused = OrGate("unused", circuit)
+    outputs[0].connect(unused.input0)
+    outputs[1].connect(unused.input1)
+    optimized, report = optimize(circuit)
+    print(report)
+    for gate in optimized:
+        print(gate)
+    assert _equivalent(circuit, optimized)
+    assert report["after"]["gates"] == len(optimized) == 2
+    assert report["after"]["cost"] < report["before"]["cost"]
+    assert report["removed"]["dead"] == ["unused"]
+    assert list(optimized.output_ports()) == ["s0", "c0", "s1", "c1"]
+    # NOT gates fold into the gate types that absorb them
+    circuit = Circuit()
+    gate = AndGate("and", circuit)
+    inverters = [make_gate(OP_NOT, f"not{i}", circuit) for i in range(3)]
+    inverters[0].output.connect(gate.input0)
+    inverters[1].output.connect(gate.input1)
+    gate.output.connect(inverters[2].input)
+    optimized, report = optimize(circuit)
+    print(report["before"], "->", report["after"], [
+        type(gate).__name__ for gate in optimized])
+    assert [type(gate) for gate in optimized] == [OrGate]
+    assert _equivalent(circuit, optimized)
+    # The logic between flip-flops can't be copied without them
+    circuit = Circuit()
+    build_counter(circuit, 2)
+    try:
+        optimize(circuit)
+    except ValueError as error:
+        print(f"Caught: {error}")
+    else:
+        raise AssertionError("A circuit with flip-flops should not optimize")
+
+
+def test_aig():
+    from logic_gate_part2 import build_random_logic
+
+    circuit = Circuit()
+    build_random_logic(circuit, 10, 200, seed=23)
+    costs = []
+    for aig in (False, True):
+        optimized, report = optimize(circuit, aig)
+        print(f"aig={aig}: {report['before']} -> {report['after']}, "
+              f"removed {sum(map(len, report['removed'].values()))}")
+        assert _equivalent(circuit, optimized)
+        assert report["after"]["gates"] <= report["before"]["gates"]
+        assert optimized.cost == report["after"]["cost"] < circuit.cost
+        costs.append(optimized.cost)
+    # The graph's extra sharing pays once its XORs and AND trees are back
+    assert costs[1] <= costs[0]
+    # a ^ b ^ c comes back as one XOR gate
+    circuit = Circuit()
+    gate = make_gate(OP_XOR, "xor", circuit, 3)
+    for name, input_ in zip("abc", gate.inputs):
+        circuit.add_input_port(name, input_)
+    optimized, _ = optimize(circuit, aig=True)
+    assert [gate.OPCODE for gate in optimized] == [OP_XOR]
+    assert _equivalent(circuit, optimized)
+
+
+def test_lut_folding():
+    # A 3-input majority with one input tied to 1 is an OR of the others;
+    # with an inverted input it is still one LUT
+    circuit = Circuit()
+    majority = LutGate("majority", circuit, 3, 0xE8)
+    majority.inputs[2].value = True
+    circuit.add_input_port("a", majority.inputs[0])
+    circuit.add_input_port("b", majority.inputs[1])
+    optimized, report = optimize(circuit)
+    print([str(gate) for gate in optimized])
+    assert [gate.OPCODE for gate in optimized] == [OP_OR]
+    assert report["removed"] == {"constant": [], "duplicate": [],
+                                 "simplified": [], "dead": []}
+    circuit = Circuit()
+    inverter = make_gate(OP_NOT, "not", circuit)
+    majority = LutGate("majority", circuit, 3, 0xE8)
+    inverter.output.connect(majority.inputs[1])
+    circuit.add_input_port("a", majority.inputs[0])
+    circuit.add_input_port("b", inverter.input)
+    circuit.add_input_port("c", majority.inputs[2])
+    optimized, _ = optimize(circuit)
+    print([str(gate) for gate in optimized])
+    assert len(optimized) == 1 and _equivalent(circuit, optimized)
+
+
+if __name__ == '__main__':
+    test()
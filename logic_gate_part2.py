@@ -3,56 +3,95 @@ CS3B, Assignment #5, Logic gate simulation (Part 2)
 Yingshi Liu
 """
 
+import collections
+import functools
+import heapq
+import io
+import operator
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is only needed by Circuit.evaluate_batch
+    np = None
+
 
 # Classes that have "has-a" relationship with logic gates(AndGate, OrGate...)
 # E.g. AndGate has Input, Output and CostMixin
 
 
+# Shared, immutable fanout of every output that is not connected yet, so
+# unconnected outputs don't each own an empty list
+_NO_CONNECTIONS = ()
+
+# The unknown value of three-valued logic: the value of an input that was
+# never set, and of any output that depends on one
+X = None
+
+
 class Input:
     """A class representing an input"""
 
+    # No per-instance __dict__; big circuits have millions of these
+    __slots__ = ("_owner", "_driver", "_value")
+
     def __init__(self, owner):
         if not isinstance(owner, LogicGate):
             raise TypeError("Owner should be a type of LogicGate")
         self._owner = owner
+        # The Output this input is connected to, if any
+        self._driver = None
+        self._value = X
 
     def __str__(self):
-        try:
-            return str(self.value)
-        except AttributeError:
-            # It's possible to not have a value at the beginning, so
-            # handle the exception properly.
-            return "(no value)"
+        # It's possible to not have a value at the beginning
+        return "(no value)" if self._value is X else str(self._value)
 
     @property
     def owner(self):
         return self._owner
 
+    @property
+    def driver(self):
+        return self._driver
+
     @property
     def value(self):
         return self._value
 
     @value.setter
     def value(self, value):
-        # Normalize the value to bool
-        self._value = bool(value)
+        # Normalize the value to bool, keeping X
+        self._value = X if value is X else bool(value)
         # Now that the input value has changed, tell to owner logic gate
-        # to re-evaluate
-        self.owner.evaluate()
+        # to re-evaluate (either right away or through its circuit's queue)
+        self.owner.input_changed()
 
 
 class Output:
     """A class representing an output"""
 
-    def __init__(self):
-        self._connections = []
+    __slots__ = ("_owner", "_connections", "_value", "_evaluations",
+                 "_changes", "_stale")
+
+    def __init__(self, owner=None):
+        # The gate driving this output; None for a free-standing output
+        self._owner = owner
+        self._connections = _NO_CONNECTIONS
+        self._value = X
+        # Activity counters: how often the value was assigned, and how
+        # often that actually changed it
+        self._evaluations = 0
+        self._changes = 0
+        # Set in LAZY circuits when an input upstream changed since the
+        # value was last computed
+        self._stale = False
 
     def __str__(self):
-        try:
-            return str(self.value)
-        except AttributeError:
-            # It's possible not to have a value at the beginning
-            return "(no value)"
+        if self._stale:
+            self._owner.circuit.pull(self._owner)
+        # It's possible not to have a value at the beginning
+        return "(no value)" if self._value is X else str(self._value)
 
     def connect(self, input_):
         if not isinstance(input_, Input):
@@ -60,38 +99,98 @@ class Output:
         # If the input is not already in the list, add it; alternative is to
         # use a set.
         # connect can trigger value change both direction
-        if input_ not in self.connections:
-            self.connections.append(input_)
-        try:
-            # Set the input's value to this output's value upon connection
+        if self._connections is _NO_CONNECTIONS:
+            self._connections = []
+        if input_ not in self._connections:
+            self._connections.append(input_)
+        input_._driver = self
+        # The wiring changed: update the levels of the circuit the wire is
+        # in, or drop what the circuits at either end cached
+        circuit = getattr(input_.owner, "circuit", None)
+        if getattr(self._owner, "circuit", None) is circuit:
+            if circuit is not None:
+                circuit._connected(self._owner, input_.owner)
+        else:
+            for gate in (self._owner, input_.owner):
+                circuit = getattr(gate, "circuit", None)
+                if circuit is not None:
+                    circuit._wiring_changed()
+        # Set the input's value to this output's value upon connection,
+        # unless both are still unknown.  A stale output's value is yet to
+        # be worked out, so a gate it feeds in a LAZY circuit is stale too
+        # (flip-flops read through the driver anyway).
+        owner = input_.owner
+        circuit = getattr(owner, "circuit", None)
+        if self._stale and isinstance(owner, DFlipFlop):
+            return
+        if (self._stale and circuit is not None
+                and circuit.mode == Circuit.LAZY):
+            Circuit._mark_stale(owner)
+        elif self.value is not X or input_._value is not X:
             input_.value = self._value
-        except AttributeError:
-            # If self.value is not there, skip it
-            pass
+
+    def disconnect(self, input_):
+        if input_ not in self.connections:
+            raise ValueError("Output is not connected to that input")
+        self._connections.remove(input_)
+        input_._driver = None
+        for gate in (self._owner, input_.owner):
+            circuit = getattr(gate, "circuit", None)
+            if circuit is not None:
+                circuit.invalidate()
+
+    @property
+    def owner(self):
+        return self._owner
 
     @property
     def value(self):
+        if self._stale:
+            # LAZY mode: work out the value on demand
+            self._owner.circuit.pull(self._owner)
         return self._value
 
     @value.setter
     def value(self, value):
-        # Normalize the value to bool
-        self._value = bool(value)
+        # Normalize the value to bool, keeping X
+        value = X if value is X else bool(value)
+        self._evaluations += 1
+        if self._value is value:
+            # Nothing changed, so nothing downstream needs re-evaluating
+            return
+        self._changes += 1
+        self._value = value
         # After the output value changes, set all the connected inputs
         # to the same value.
-        for connection in self.connections:
-            connection.value = self.value
+        for connection in self._connections:
+            connection.value = value
 
     @property
     def connections(self):
         return self._connections
 
+    @property
+    def evaluations(self):
+        """Number of times the value was assigned"""
+        return self._evaluations
+
+    @property
+    def changes(self):
+        """Number of assignments that changed the value"""
+        return self._changes
+
+    def reset_activity(self):
+        self._evaluations = 0
+        self._changes = 0
+
 
 class CostMixin:
     """ A class expands logic gates capacity like querying the cost """
 
     COST_MULTIPLIER = 10
-    
+
+    __slots__ = ("_number_of_components", "_cost")
+
     def __init__(self, number_of_components):
         self._number_of_components = number_of_components
         self._cost = 0
@@ -105,6 +204,16 @@ class CostMixin:
         self._cost = CostMixin.COST_MULTIPLIER * (self._number_of_components ** 2)
         return self._cost
 
+    @staticmethod
+    def wide_cost(number_of_components):
+        """Cost of a variable fan-in gate.
+
+        Squaring would make one wide gate dearer than the tree of two-input
+        gates it replaces, so wide gates are priced per component at the
+        rate of a two-input gate instead.
+        """
+        return CostMixin(3).cost * number_of_components // 3
+
 # Classes that have "is-a" relationship with logic gates(AndGate, OrGate...)
 # E.g. AndGate is a LogicGate(), is a NodeMixin()
 
@@ -112,8 +221,24 @@ class NodeMixin:
     """ A class that can link multiple logic gates together in the Circuit class """
     """ Similar with the dataStack class in the lecture """
 
+    # A mixin declares no slots of its own; the concrete gate classes list
+    # _next, _prev, _id and _rank in theirs (two bases with non-empty slots can't
+    # be combined)
+    __slots__ = ()
+
     def __init__(self):
         self._next = None
+        # The node added after this one, so a circuit can unlink a node
+        # without walking the list
+        self._prev = None
+        # Stable integer id, assigned when the node is added to a circuit
+        self._id = None
+        # Position in the circuit's running topological order
+        self._rank = None
+
+    @property
+    def id(self):
+        return self._id
 
     @property
     def next(self):
@@ -121,6 +246,10 @@ class NodeMixin:
             return self._next
         return None
 
+    @property
+    def prev(self):
+        return self._prev
+
     @next.setter
     def next(self, node):
         if not isinstance(node, LogicGate):
@@ -135,6 +264,8 @@ class NodeMixin:
 class LogicGate:
     """Base class for all logic gates."""
 
+    __slots__ = ("_name",)
+
     def __init__(self, name):
         self._name = name
 
@@ -142,33 +273,60 @@ class LogicGate:
     def name(self):
         return self._name
 
+    def input_changed(self):
+        """Called by one of this gate's inputs after its value changed"""
+        self.evaluate()
+
 
 class UnaryGate(LogicGate, NodeMixin):
     """A class representing logic gate with a single input."""
 
+    __slots__ = ("_next", "_prev", "_id", "_rank", "_input", "_output",
+                 "_circuit")
+
+    ARITY = 1
+
+    # The cost only depends on the number of components, so work it out
+    # once per class instead of once per gate
+    _cost = CostMixin(2).cost
+
     def __init__(self, name, circuit=None):
         super().__init__(name)
         NodeMixin.__init__(self)
         self._input = Input(self)
-        self._output = Output()
-        self._cost = CostMixin(2).cost
+        self._output = Output(self)
         # test circuit is the right type
         if not isinstance(circuit, Circuit):
             raise TypeError(f"input circuit is not the right type")
+        self._circuit = circuit
         circuit.add(self)
 
     def __str__(self):
-        return (f"LogicGate {self.name}: input={self.input}, "
-                f"output={self.output}")
+        return (f"LogicGate {self._name}: input={self._input}, "
+                f"output={self._output}")
+
+    def input_changed(self):
+        self._circuit.input_changed(self)
+
+    def evaluate(self):
+        self.output.value = self.evaluate_ternary(self.input.value)
 
     @property
     def input(self):
         return self._input
 
+    @property
+    def inputs(self):
+        return (self._input,)
+
     @property
     def output(self):
         return self._output
 
+    @property
+    def circuit(self):
+        return self._circuit
+
     @property
     def cost(self):
         return self._cost
@@ -177,21 +335,35 @@ class UnaryGate(LogicGate, NodeMixin):
 class BinaryGate(LogicGate, NodeMixin):
     """A class representing logic gate with two inputs."""
 
+    __slots__ = ("_next", "_prev", "_id", "_rank", "_input0", "_input1",
+                 "_output", "_circuit")
+
+    ARITY = 2
+
+    _cost = CostMixin(3).cost
+
     def __init__(self, name,  circuit=None):
         super().__init__(name)
         NodeMixin.__init__(self)
         self._input0 = Input(self)
         self._input1 = Input(self)
-        self._output = Output()
-        self._cost = CostMixin(3).cost
+        self._output = Output(self)
         # test circuit is the right type
         if not isinstance(circuit, Circuit):
             raise TypeError(f"input circuit is not the right type")
+        self._circuit = circuit
         circuit.add(self)
 
     def __str__(self):
-        return (f"LogicGate {self.name}: input0={self.input0}, "
-                f"input1={self.input1}, output={self.output}")
+        return (f"LogicGate {self._name}: input0={self._input0}, "
+                f"input1={self._input1}, output={self._output}")
+
+    def input_changed(self):
+        self._circuit.input_changed(self)
+
+    def evaluate(self):
+        self.output.value = self.evaluate_ternary(self.input0.value,
+                                                  self.input1.value)
 
     @property
     def input0(self):
@@ -201,88 +373,1794 @@ class BinaryGate(LogicGate, NodeMixin):
     def input1(self):
         return self._input1
 
+    @property
+    def inputs(self):
+        return (self._input0, self._input1)
+
     @property
     def output(self):
         return self._output
 
+    @property
+    def circuit(self):
+        return self._circuit
+
     @property
     def cost(self):
         return self._cost
 
+
+class NaryGate(LogicGate, NodeMixin):
+    """A class representing logic gate with any number of inputs."""
+
+    __slots__ = ("_next", "_prev", "_id", "_rank", "_inputs", "_output",
+                 "_circuit")
+
+    # Set by each instance's fan_in instead
+    ARITY = None
+
+    MIN_FAN_IN = 2
+
+    # Fan-in -> cost, shared by all N-ary gates
+    _costs = {}
+
+    def __init__(self, name, circuit=None, fan_in=2):
+        super().__init__(name)
+        NodeMixin.__init__(self)
+        if not isinstance(fan_in, int):
+            raise TypeError("fan_in must be an int")
+        if fan_in < self.MIN_FAN_IN:
+            raise ValueError(f"A {type(self).__name__} needs at least "
+                             f"{self.MIN_FAN_IN} inputs")
+        self._inputs = tuple(Input(self) for _ in range(fan_in))
+        self._output = Output(self)
+        # test circuit is the right type
+        if not isinstance(circuit, Circuit):
+            raise TypeError(f"input circuit is not the right type")
+        self._circuit = circuit
+        circuit.add(self)
+
+    def __str__(self):
+        inputs = ", ".join(str(input_) for input_ in self._inputs)
+        return (f"LogicGate {self._name}: inputs=[{inputs}], "
+                f"output={self._output}")
+
+    def input_changed(self):
+        self._circuit.input_changed(self)
+
+    def evaluate(self):
+        # Reads _value directly: with many inputs the property calls would
+        # cost more than the kernel
+        self._output.value = self.evaluate_ternary(
+            *[input_._value for input_ in self._inputs])
+
+    @property
+    def inputs(self):
+        return self._inputs
+
+    @property
+    def output(self):
+        return self._output
+
+    @property
+    def circuit(self):
+        return self._circuit
+
+    @property
+    def cost(self):
+        # An input per fan-in plus the output
+        fan_in = len(self._inputs)
+        cost = NaryGate._costs.get(fan_in)
+        if cost is None:
+            cost = NaryGate._costs[fan_in] = CostMixin.wide_cost(fan_in + 1)
+        return cost
+
 # Classes that are a specific gate
 
+# Operation codes used by the compiled forms of a circuit
+OP_NOT = 0
+OP_AND = 1
+OP_OR = 2
+OP_XOR = 3
+OP_NAND = 4
+OP_NOR = 5
+OP_XNOR = 6
+OP_LUT = 7
+
+
+# Each gate class has three static kernels:
+#   evaluate_ternary  one value each of True, False or X (evaluate uses it)
+#   evaluate_packed   two-valued, on ints (or NumPy words) packing one bit
+#                     per test vector; mask has a 1 for every vector
+#   evaluate_planes   three-valued, on (ones, zeros) pairs of such words: a
+#                     bit set in ones is a 1, in zeros a 0, in neither an X
+# (LutGate's kernels are ordinary methods instead, as they need its table.)
+
 
 class NotGate(UnaryGate):
+    __slots__ = ()
+    OPCODE = OP_NOT
 
-    def evaluate(self):
-        try:
-            self.output.value = not self.input.value
-        except AttributeError:
-            pass
+    @staticmethod
+    def evaluate_ternary(a):
+        return X if a is X else not a
+
+    @staticmethod
+    def evaluate_packed(mask, a):
+        # Flip only the bits that belong to the vectors being simulated
+        return a ^ mask
+
+    @staticmethod
+    def evaluate_planes(a):
+        ones, zeros = a
+        return zeros, ones
 
 
 class AndGate(BinaryGate):
-    def evaluate(self):
-        try:
-            # This may throw an exception, if one of the input is not yet set,
-            # which is possible in the normal course of evaluation, because
-            # setting the first input will kick off the evaluation.  So just
-            # don't set the output.
-            self.output.value = self.input0.value and self.input1.value
-        except AttributeError:
-            pass
+    __slots__ = ()
+    OPCODE = OP_AND
+
+    @staticmethod
+    def evaluate_ternary(a, b):
+        # A 0 decides the output even when the other input is unknown
+        if a is False or b is False:
+            return False
+        return X if a is X or b is X else True
+
+    @staticmethod
+    def evaluate_packed(mask, a, b):
+        return a & b
+
+    @staticmethod
+    def evaluate_planes(a, b):
+        return a[0] & b[0], a[1] | b[1]
 
 
 class OrGate(BinaryGate):
-    def evaluate(self):
-        try:
-            self.output.value = self.input0.value or self.input1.value
-        except AttributeError:
-            pass
+    __slots__ = ()
+    OPCODE = OP_OR
+
+    @staticmethod
+    def evaluate_ternary(a, b):
+        if a is True or b is True:
+            return True
+        return X if a is X or b is X else False
+
+    @staticmethod
+    def evaluate_packed(mask, a, b):
+        return a | b
+
+    @staticmethod
+    def evaluate_planes(a, b):
+        return a[0] | b[0], a[1] & b[1]
 
 
 class XorGate(BinaryGate):
+    __slots__ = ()
+    OPCODE = OP_XOR
+
+    @staticmethod
+    def evaluate_ternary(a, b):
+        # Nothing dominates: any X makes the output X
+        if a is X or b is X:
+            return X
+        return a != b
+
+    @staticmethod
+    def evaluate_packed(mask, a, b):
+        return a ^ b
+
+    @staticmethod
+    def evaluate_planes(a, b):
+        return ((a[0] & b[1]) | (a[1] & b[0]),
+                (a[0] & b[0]) | (a[1] & b[1]))
+
+
+class NaryAndGate(NaryGate):
+    __slots__ = ()
+    OPCODE = OP_AND
+
+    @staticmethod
+    def evaluate_ternary(*values):
+        # Values are True, False or X, so "in" can't confuse them
+        if False in values:
+            return False
+        return X if X in values else True
+
+    @staticmethod
+    def evaluate_packed(mask, *values):
+        return functools.reduce(operator.and_, values)
+
+    @staticmethod
+    def evaluate_planes(*values):
+        return (functools.reduce(operator.and_, [ones for ones, _ in values]),
+                functools.reduce(operator.or_, [zeros for _, zeros in values]))
+
+
+class NaryOrGate(NaryGate):
+    __slots__ = ()
+    OPCODE = OP_OR
+
+    @staticmethod
+    def evaluate_ternary(*values):
+        if True in values:
+            return True
+        return X if X in values else False
+
+    @staticmethod
+    def evaluate_packed(mask, *values):
+        return functools.reduce(operator.or_, values)
+
+    @staticmethod
+    def evaluate_planes(*values):
+        return (functools.reduce(operator.or_, [ones for ones, _ in values]),
+                functools.reduce(operator.and_, [zeros for _, zeros in values]))
+
+
+class NaryXorGate(NaryGate):
+    __slots__ = ()
+    OPCODE = OP_XOR
+
+    @staticmethod
+    def evaluate_ternary(*values):
+        if X in values:
+            return X
+        return values.count(True) % 2 == 1
+
+    @staticmethod
+    def evaluate_packed(mask, *values):
+        return functools.reduce(operator.xor, values)
+
+    @staticmethod
+    def evaluate_planes(*values):
+        return functools.reduce(XorGate.evaluate_planes, values)
+
+
+# The complemented gates are N-ary too, two inputs by default.  Each one is
+# the NOT of the gate above it.
+
+class NandGate(NaryGate):
+    __slots__ = ()
+    OPCODE = OP_NAND
+
+    @staticmethod
+    def evaluate_ternary(*values):
+        return NotGate.evaluate_ternary(NaryAndGate.evaluate_ternary(*values))
+
+    @staticmethod
+    def evaluate_packed(mask, *values):
+        return functools.reduce(operator.and_, values) ^ mask
+
+    @staticmethod
+    def evaluate_planes(*values):
+        return NotGate.evaluate_planes(NaryAndGate.evaluate_planes(*values))
+
+
+class NorGate(NaryGate):
+    __slots__ = ()
+    OPCODE = OP_NOR
+
+    @staticmethod
+    def evaluate_ternary(*values):
+        return NotGate.evaluate_ternary(NaryOrGate.evaluate_ternary(*values))
+
+    @staticmethod
+    def evaluate_packed(mask, *values):
+        return functools.reduce(operator.or_, values) ^ mask
+
+    @staticmethod
+    def evaluate_planes(*values):
+        return NotGate.evaluate_planes(NaryOrGate.evaluate_planes(*values))
+
+
+class XnorGate(NaryGate):
+    __slots__ = ()
+    OPCODE = OP_XNOR
+
+    @staticmethod
+    def evaluate_ternary(*values):
+        return NotGate.evaluate_ternary(NaryXorGate.evaluate_ternary(*values))
+
+    @staticmethod
+    def evaluate_packed(mask, *values):
+        return functools.reduce(operator.xor, values) ^ mask
+
+    @staticmethod
+    def evaluate_planes(*values):
+        return NotGate.evaluate_planes(NaryXorGate.evaluate_planes(*values))
+
+
+def lut_packed(table, mask, values):
+    """Evaluate the truth table table of len(values) inputs on packed words
+
+    With a mask of 1 (single vector) this is one table lookup.  Otherwise
+    the table is split on its last input into the halves where that input
+    is 0 and 1 (Shannon expansion), each evaluated the same way and joined
+    by a multiplexer; halves that are constant or equal stop the split.
+    """
+    if mask is True or (type(mask) is int and mask == 1):
+        index = 0
+        for position, value in enumerate(values):
+            if value:
+                index |= 1 << position
+        bit = (table >> index) & 1
+        return bool(bit) if mask is True else bit
+    return _lut_split(table, mask, values, len(values))
+
+
+def _lut_split(table, mask, values, count):
+    # table is over values[:count]
+    if table == 0:
+        return 0
+    if table == (1 << (1 << count)) - 1:
+        return mask
+    half = 1 << (count - 1)
+    low = table & ((1 << half) - 1)
+    high = table >> half
+    select = values[count - 1]
+    if low == high:
+        return _lut_split(low, mask, values, count - 1)
+    if count == 1:
+        # low and high are 0 and 1: a buffer or an inverter
+        return select if high else select ^ mask
+    low = _lut_split(low, mask, values, count - 1)
+    high = _lut_split(high, mask, values, count - 1)
+    return low ^ ((low ^ high) & select)
+
+
+def lut_planes(table, values):
+    """Evaluate the truth table table on (ones, zeros) planes, exactly
+
+    A vector's result is 1 (or 0) only if it is 1 (or 0) for every value
+    of its X inputs.  Constant results set every bit, so callers mask the
+    planes to their width.
+    """
+    return _lut_planes(table, values, len(values))
+
+
+def _lut_planes(table, values, count):
+    if table == 0:
+        return 0, -1
+    if table == (1 << (1 << count)) - 1:
+        return -1, 0
+    half = 1 << (count - 1)
+    low = table & ((1 << half) - 1)
+    high = table >> half
+    if low == high:
+        return _lut_planes(low, values, count - 1)
+    ones, zeros = values[count - 1]
+    low_ones, low_zeros = _lut_planes(low, values, count - 1)
+    high_ones, high_zeros = _lut_planes(high, values, count - 1)
+    # Known when the select picks a known half, or when both halves agree
+    return ((ones & high_ones) | (zeros & low_ones) | (low_ones & high_ones),
+            (ones & high_zeros) | (zeros & low_zeros)
+            | (low_zeros & high_zeros))
+
+
+class LutGate(NaryGate):
+    """A gate computing any function of its inputs, given by a truth table
+
+    Bit i of table is the output for the input values whose bit k is the
+    value of input k, the layout of BLIF covers (see logic_gate_netlist).
+    """
+
+    __slots__ = ("_table",)
+    OPCODE = OP_LUT
+    MIN_FAN_IN = 1
+
+    def __init__(self, name, circuit=None, fan_in=2, table=0):
+        if not isinstance(table, int):
+            raise TypeError("table must be an int")
+        if (isinstance(fan_in, int) and fan_in >= 1
+                and not 0 <= table < 1 << (1 << fan_in)):
+            raise ValueError(f"table must have {1 << fan_in} bits for "
+                             f"{fan_in} inputs")
+        self._table = table
+        super().__init__(name, circuit, fan_in)
+
+    def __str__(self):
+        return f"{super().__str__()}, table={self._table:#x}"
+
+    @property
+    def table(self):
+        return self._table
+
     def evaluate(self):
-        try:
-            # Assume the value is bool, != is same as xor
-            self.output.value = (self.input0.value != self.input1.value)
-        except AttributeError:
-            pass
+        # The table lookup, straight from the input values
+        index = 0
+        bit = 1
+        for input_ in self._inputs:
+            value = input_._value
+            if value:
+                index |= bit
+            elif value is X:
+                super().evaluate()
+                return
+            bit <<= 1
+        self._output.value = (self._table >> index) & 1 == 1
+
+    def evaluate_ternary(self, *values):
+        if X not in values:
+            return lut_packed(self._table, True, values)
+        ones, zeros = lut_planes(self._table, [
+            (0, 0) if value is X else (1, 0) if value else (0, 1)
+            for value in values])
+        return True if ones & 1 else False if zeros & 1 else X
+
+    def evaluate_packed(self, mask, *values):
+        return lut_packed(self._table, mask, values)
+
+    def evaluate_planes(self, *values):
+        return lut_planes(self._table, values)
+
+
+# Gate class for each operation code, used to turn compiled or stored forms
+# back into gate objects; and the class for any fan-in, where it differs
+GATE_CLASSES = {gate_class.OPCODE: gate_class
+                for gate_class in (NotGate, AndGate, OrGate, XorGate,
+                                   NandGate, NorGate, XnorGate)}
+NARY_CLASSES = {gate_class.OPCODE: gate_class
+                for gate_class in (NaryAndGate, NaryOrGate, NaryXorGate,
+                                   NandGate, NorGate, XnorGate)}
+
+
+def make_gate(opcode, name, circuit, fan_in=None, table=None):
+    """Create a gate for opcode with fan_in inputs in circuit.
+
+    The plain class (e.g. AndGate) is used when fan_in fits it, and the
+    N-ary one (e.g. NaryAndGate) otherwise.  OP_LUT makes a LutGate with
+    the truth table table.
+    """
+    if opcode == OP_LUT:
+        return LutGate(name, circuit, fan_in, table)
+    gate_class = GATE_CLASSES.get(opcode)
+    if gate_class is None:
+        raise ValueError(f"Unknown gate opcode {opcode!r}")
+    if fan_in is None or fan_in == gate_class.ARITY:
+        return gate_class(name, circuit)
+    if opcode not in NARY_CLASSES:
+        raise ValueError(f"{gate_class.__name__} can't have {fan_in} inputs")
+    return NARY_CLASSES[opcode](name, circuit, fan_in)
+
+
+# Sequential elements.  They belong to a circuit but are not among its
+# gates: a Q output is a primary input of the combinational logic and a D
+# input just samples it, so wires through a flip-flop never form a
+# combinational loop and never change logic levels.
+
+class DFlipFlop(LogicGate):
+    """An edge-triggered D flip-flop, on the clock of its circuit
+
+    Q keeps its value until Circuit.clock() copies D to it.  init is the
+    value Q starts with and goes back to on reset().
+    """
+
+    __slots__ = ("_d", "_q", "_init", "_circuit")
+
+    # Not one of the circuit's gates, so it has no id (see Circuit.add)
+    _id = None
+
+    _cost = CostMixin(3).cost
+
+    def __init__(self, name, circuit=None, init=False):
+        super().__init__(name)
+        if not isinstance(circuit, Circuit):
+            raise TypeError(f"input circuit is not the right type")
+        self._init = X if init is X else bool(init)
+        self._d = Input(self)
+        self._q = Output(self)
+        self._q.value = self._init
+        self._circuit = circuit
+        circuit._add_flip_flop(self)
+
+    def __str__(self):
+        return f"DFlipFlop {self._name}: d={self._d}, q={self._q}"
+
+    def input_changed(self):
+        # A new D only reaches Q on the next clock
+        pass
+
+    def sample(self):
+        """Return the value D has now, the one the next clock latches"""
+        driver = self._d.driver
+        # Through the driver, which brings a LAZY circuit up to date
+        return self._d.value if driver is None else driver.value
+
+    def reset(self):
+        self._q.value = self._init
+
+    @property
+    def d(self):
+        return self._d
+
+    @property
+    def q(self):
+        return self._q
+
+    @property
+    def inputs(self):
+        return (self._d,)
+
+    @property
+    def output(self):
+        return self._q
+
+    @property
+    def init(self):
+        return self._init
+
+    @property
+    def circuit(self):
+        return self._circuit
+
+    @property
+    def cost(self):
+        return self._cost
+
+
+class Register:
+    """width DFlipFlops named name0, name1, ..., holding an unsigned int
+
+    Flip-flop i holds bit i (least significant first) of value, and init
+    gives their initial values the same way.
+    """
+
+    def __init__(self, name, circuit, width, init=0):
+        if not isinstance(width, int):
+            raise TypeError("width must be an int")
+        if width < 1:
+            raise ValueError("A Register needs at least one bit")
+        if not 0 <= init < 1 << width:
+            raise ValueError(f"init must fit in {width} bits")
+        self._name = name
+        self._flip_flops = tuple(
+            DFlipFlop(f"{name}{i}", circuit, (init >> i) & 1)
+            for i in range(width))
+
+    def __len__(self):
+        return len(self._flip_flops)
+
+    def __str__(self):
+        value = self.value
+        return (f"Register {self._name}: width={len(self)}, value="
+                f"{'(no value)' if value is X else value}")
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def flip_flops(self):
+        return self._flip_flops
+
+    @property
+    def d(self):
+        """The D inputs, least significant bit first"""
+        return tuple(flip_flop.d for flip_flop in self._flip_flops)
+
+    @property
+    def q(self):
+        """The Q outputs, least significant bit first"""
+        return tuple(flip_flop.q for flip_flop in self._flip_flops)
+
+    @property
+    def value(self):
+        """The unsigned int on the Q outputs, or X if any of them is X"""
+        value = 0
+        for i, flip_flop in enumerate(self._flip_flops):
+            bit = flip_flop.q.value
+            if bit is X:
+                return X
+            value |= bit << i
+        return value
+
+
+class OscillationError(RuntimeError):
+    """A combinational loop kept changing instead of settling"""
+
+    def __init__(self, gates):
+        names = ", ".join(gate.name for gate in gates)
+        super().__init__(f"Combinational loop through {names} does not "
+                         f"settle")
+        self.gates = gates
 
 # Class that keeps track of all logic gates belonging to a specific  circuit.
 
 class Circuit:
     """ A class that keeps track of all logic gates belonging to a specific circuit """
 
-    def __init__(self):
+    # Evaluation modes.  In IMMEDIATE mode every input change re-evaluates
+    # the owner gate right away, cascading depth first through the setters.
+    # In SCHEDULED mode input changes only enqueue the owner gate, and the
+    # queue is drained in level order so that each gate is evaluated at most
+    # once per stimulus, without recursion.  In LAZY mode input changes only
+    # mark the outputs downstream as stale; reading a stale output evaluates
+    # just its fan-in cone, and the result is kept until an input changes.
+    IMMEDIATE = "immediate"
+    SCHEDULED = "scheduled"
+    LAZY = "lazy"
+
+    # A combinational loop is given this many evaluations per gate to
+    # settle before it is reported as oscillating.  Can be changed per
+    # circuit.
+    LOOP_LIMIT = 64
+
+    def __init__(self, mode=IMMEDIATE, name=None, parent=None):
+        if mode not in (Circuit.IMMEDIATE, Circuit.SCHEDULED, Circuit.LAZY):
+            raise ValueError(f"Unknown evaluation mode {mode!r}")
+        if parent is not None and not isinstance(parent, Circuit):
+            raise TypeError("parent must be a Circuit")
+        self._mode = mode
+        # Gates are kept both in the NodeMixin list (newest first, starting
+        # at _top) and in insertion-ordered indexes by id and by name
+        self._top = None
+        self._gates = {}
+        # name -> first gate added with that name, and name -> list of the
+        # later ones for the (rare) names that are shared
+        self._names = {}
+        self._duplicates = {}
+        # Named ports: name -> list of the gate inputs fed by that primary
+        # input, and name -> output
+        self._input_ports = {}
+        self._output_ports = {}
+        # name -> DFlipFlop, in the order they were added
+        self._flip_flops = {}
+        self._next_id = 0
+        # Running cost totals, including those of all sub-modules:
+        # total cost, and gate type name -> [gate count, cost]
         self._cost = 0
-        # self._top = None
+        self._cost_by_type = {}
+        self._children = {}
+        self._parent = parent
+        if parent is not None:
+            if name is None:
+                name = f"module{len(parent._children)}"
+            if name in parent._children:
+                raise ValueError(f"Duplicate sub-module name {name!r}")
+            parent._children[name] = self
+        self._name = name
+        # gate -> logic level, and per level a dict of gate id -> gate.  Kept
+        # up to date as gates are added and wired, and rebuilt lazily when
+        # they are removed or unwired (which can lower levels).
+        self._levels = None
+        self._by_level = None
+        self._level_view = None
+        # The gates sorted by level, rebuilt lazily after any change
+        self._order = None
+        self._compiled = None
+        # primary Input -> its fanout cone, as gates in topological order
+        self._cones = {}
+        # Set as soon as a connection closes a combinational loop; then
+        # levelize() finds the loops (gate -> tuple of the loop's gates)
+        self._has_loops = False
+        self._loops = {}
+        # id(loop) -> (pending gates, their set) while a loop is settling
+        self._settling = {}
+        # Event queue of (level, sequence, gate) used in SCHEDULED mode
+        self._queue = []
+        self._queued = set()
+        self._sequence = 0
+        self._draining = False
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def parent(self):
+        return self._parent
 
     @property
     def cost(self):
-        start = self._top
-        while start is not None:
-            self._cost += start.cost
-            start = start.next
+        """Total cost of the gates in this circuit and its sub-modules"""
         return self._cost
 
+    def cost_report(self):
+        """Break the cost down by gate type and by sub-module.
+
+        Built from the running totals, so it never rescans the gates.
+        Each sub-module appears with its own nested report.
+        """
+        return {
+            "name": self._name,
+            "cost": self._cost,
+            "by_type": {type_name: {"gates": count, "cost": cost}
+                        for type_name, (count, cost)
+                        in self._cost_by_type.items()},
+            "by_module": {name: child.cost_report()
+                          for name, child in self._children.items()},
+        }
+
+    def _account(self, gate, sign):
+        # Update the running totals of this circuit and all its ancestors;
+        # sign is +1 when gate is added and -1 when it is removed.
+        type_name = type(gate).__name__
+        cost = sign * gate.cost
+        circuit = self
+        while circuit is not None:
+            circuit._cost += cost
+            totals = circuit._cost_by_type.setdefault(type_name, [0, 0])
+            totals[0] += sign
+            totals[1] += cost
+            if totals[0] == 0:
+                del circuit._cost_by_type[type_name]
+            circuit = circuit._parent
+
+    def activity(self):
+        """Sum the activity counters of every gate output.
+
+        Returns a dict with the number of evaluations, how many of them
+        changed a value, and how many were skipped downstream of
+        evaluations that didn't.
+        """
+        evaluations = changes = 0
+        for gate in self._gates.values():
+            evaluations += gate.output.evaluations
+            changes += gate.output.changes
+        return {"evaluations": evaluations, "changes": changes,
+                "unchanged": evaluations - changes}
+
+    def reset_activity(self):
+        for gate in self._gates.values():
+            gate.output.reset_activity()
+
     def add(self, gate):
-        try:
-            if not isinstance(gate, NodeMixin):
-                raise TypeError(f"The input node is not the right type of NodeMixin")
+        if not isinstance(gate, NodeMixin):
+            raise TypeError(f"The input node is not the right type of NodeMixin")
+        if gate.id is not None:
+            raise ValueError(f"Gate {gate.name} already belongs to a circuit")
+        if self._top is not None:
             gate.next = self._top
-            self._top = gate
-        except AttributeError:
-            self._top = gate
+            self._top._prev = gate
+        self._top = gate
+        gate._id = gate._rank = self._next_id
+        self._next_id += 1
+        self._gates[gate.id] = gate
+        if gate.name in self._names:
+            self._duplicates.setdefault(gate.name, []).append(gate)
+        else:
+            self._names[gate.name] = gate
+        self._account(gate, 1)
+        # Start the output at the gate's value for its inputs as they are,
+        # which a gate of constant value needs, since unknown inputs that
+        # stay unknown never make it evaluate; nothing reads it yet
+        gate.output._value = gate.evaluate_ternary(
+            *[input_._value for input_ in gate.inputs])
+        if self._levels is not None:
+            # Not wired yet, so on level 0
+            self._levels[gate] = 0
+            if not self._by_level:
+                self._by_level.append({})
+            self._by_level[0][gate.id] = gate
+        self._wiring_changed()
+
+    def _add_flip_flop(self, flip_flop):
+        # Called by DFlipFlop.__init__
+        if flip_flop.name in self._flip_flops:
+            raise ValueError(f"Duplicate flip-flop name {flip_flop.name!r}")
+        self._flip_flops[flip_flop.name] = flip_flop
+        self._account(flip_flop, 1)
+
+    def flip_flops(self):
+        """Return the circuit's DFlipFlops, oldest first"""
+        return tuple(self._flip_flops.values())
+
+    def clock(self, cycles=1):
+        """Latch every flip-flop, cycles times, through the object model
+
+        Each time, every D is sampled before any Q changes, so the
+        flip-flops switch together; the logic they feed is then evaluated
+        the way the circuit's mode says.  For many cycles, simulator() is
+        much faster.
+        """
+        flip_flops = self.flip_flops()
+        for _ in range(cycles):
+            values = [flip_flop.sample() for flip_flop in flip_flops]
+            for flip_flop, value in zip(flip_flops, values):
+                flip_flop.q.value = value
+
+    def reset(self):
+        """Put every flip-flop back to its initial value"""
+        for flip_flop in self._flip_flops.values():
+            flip_flop.reset()
+
+    def remove(self, key):
+        """Remove a gate (given itself, its id or its name) and its wiring"""
+        gate = self._resolve(key)
+        if gate is None:
+            raise KeyError(key)
+        for input_ in gate.inputs:
+            if input_.driver is not None:
+                input_.driver.disconnect(input_)
+        for connection in list(gate.output.connections):
+            gate.output.disconnect(connection)
+        if self._input_ports or self._output_ports:
+            self._drop_ports(gate)
+        # Unlink it from the NodeMixin list
+        if gate._prev is None:
+            self._top = gate._next
+        else:
+            gate._prev._next = gate._next
+        if gate._next is not None:
+            gate._next._prev = gate._prev
+        gate._next = gate._prev = None
+        del self._gates[gate.id]
+        if self._names[gate.name] is gate:
+            later = self._duplicates.get(gate.name)
+            if later:
+                self._names[gate.name] = later.pop(0)
+            else:
+                del self._names[gate.name]
+        else:
+            later = self._duplicates[gate.name]
+            later.remove(gate)
+        if not later and gate.name in self._duplicates:
+            del self._duplicates[gate.name]
+        gate._id = None
+        self._account(gate, -1)
+        self.invalidate()
+        return gate
+
+    def get(self, key, default=None):
+        """Return the gate with the given id or name, or default.
+
+        If several gates share a name, the first one added is returned.
+        """
+        gate = self._resolve(key)
+        return default if gate is None else gate
+
+    def get_all(self, name):
+        """Return every gate with the given name, oldest first"""
+        if name not in self._names:
+            return []
+        return [self._names[name]] + self._duplicates.get(name, [])
+
+    def _resolve(self, key):
+        if isinstance(key, NodeMixin):
+            return key if self._gates.get(key.id) is key else None
+        if isinstance(key, int):
+            return self._gates.get(key)
+        return self._names.get(key)
+
+    def __contains__(self, key):
+        return self._resolve(key) is not None
+
+    def __len__(self):
+        return len(self._gates)
+
+    def invalidate(self):
+        """Forget the cached levels; called when gates or wires are removed"""
+        self._levels = None
+        self._by_level = None
+        self._wiring_changed()
+
+    def _wiring_changed(self):
+        # Forget what is derived from the levels and the wiring
+        self._level_view = None
+        self._order = None
+        self._compiled = None
+        self._cones = {}
+
+    def _connected(self, source, target):
+        # Called after source's output was connected to target, two gates
+        # of this circuit.  A new wire can only raise levels, so the
+        # target and whatever it drives are moved up as far as needed.
+        # The gates of a loop share a level and move up together.
+        self._wiring_changed()
+        if source._id is None or target._id is None:
+            return
+        had_loops = self._has_loops
+        self._order_edge(source, target)
+        if self._levels is None:
+            return
+        levels = self._levels
+        if had_loops:
+            # Without ranks to go by, only a wire that doesn't go up a
+            # level can close a loop, and then only if target, through
+            # gates no higher than source, reaches back to source; only
+            # then are the loops found again, on the next query
+            loops = self._loops
+            if levels[target] > levels[source]:
+                return
+            loop = loops.get(source)
+            if loop is not None and loop is loops.get(target):
+                return
+            if self._reaches(target, source, levels[source]):
+                self.invalidate()
+                return
+        elif self._has_loops:
+            # This wire closed the first loop
+            self.invalidate()
+            return
+        else:
+            loops = self._loops
+        by_level = self._by_level
+        pending = [(target, levels[source] + 1)]
+        while pending:
+            gate, level = pending.pop()
+            if levels[gate] >= level:
+                continue
+            loop = loops.get(gate)
+            members = (gate,) if loop is None else loop
+            while len(by_level) <= level:
+                by_level.append({})
+            for member in members:
+                del by_level[levels[member]][member.id]
+                by_level[level][member.id] = member
+                levels[member] = level
+            for member in members:
+                for connection in member.output.connections:
+                    owner = connection.owner
+                    if owner in levels and (loop is None
+                                            or loops.get(owner) is not loop):
+                        pending.append((owner, level + 1))
+
+    def _reaches(self, start, goal, level):
+        # Whether goal is downstream of start through gates on or below
+        # level; every wire out of a gate goes up a level, or stays on
+        # it within a loop, so nothing above level can lead back down
+        levels = self._levels
+        pending = [start]
+        seen = {start}
+        while pending:
+            gate = pending.pop()
+            if gate is goal:
+                return True
+            for connection in gate.output.connections:
+                owner = connection.owner
+                if (owner not in seen and owner in levels
+                        and levels[owner] <= level):
+                    seen.add(owner)
+                    pending.append(owner)
+        return False
+
+    def levelize(self):
+        """Return a dict mapping each gate to its logic level.
+
+        Gates driven only by primary inputs are on level 0, and every other
+        gate is one level above its deepest driver.  All the gates of a
+        combinational loop share one level, above the loop's drivers.  The
+        result is cached until the circuit changes.
+        """
+        if self._levels is None:
+            gates = list(self._gates.values())
+            # Kahn's algorithm, counting only the wires between our own gates
+            indegree = dict.fromkeys(gates, 0)
+            for gate in gates:
+                for connection in gate.output.connections:
+                    if connection.owner in indegree:
+                        indegree[connection.owner] += 1
+            levels = {}
+            ready = [gate for gate in gates if indegree[gate] == 0]
+            for gate in ready:
+                levels[gate] = 0
+            while ready:
+                gate = ready.pop()
+                level = levels[gate] + 1
+                for connection in gate.output.connections:
+                    successor = connection.owner
+                    if successor not in indegree:
+                        continue
+                    if levels.get(successor, 0) < level:
+                        levels[successor] = level
+                    indegree[successor] -= 1
+                    if indegree[successor] == 0:
+                        ready.append(successor)
+            # Gates that never became ready are on a loop or downstream of
+            # one; only then is the slower SCC pass needed
+            stuck = [gate for gate in gates if indegree[gate]]
+            self._loops = self._level_loops(stuck, levels) if stuck else {}
+            self._levels = levels
+            if self._has_loops and not stuck:
+                # The loops are gone; restart the running order from here
+                ranks = sorted(gate._rank for gate in gates)
+                order = sorted(gates, key=levels.get)
+                for gate, rank in zip(order, ranks):
+                    gate._rank = rank
+            self._has_loops = bool(stuck)
+            self._by_level = [{} for _ in range(max(levels.values(),
+                                                    default=-1) + 1)]
+            for gate in gates:
+                self._by_level[levels[gate]][gate.id] = gate
+        return self._levels
+
+    def levels(self):
+        """Return the gate ids grouped by logic level, from level 0 up
+
+        A tuple of tuples.  Cached, and kept up to date incrementally as
+        gates are added and connected.
+        """
+        if self._level_view is None or self._levels is None:
+            self.levelize()
+            self._level_view = tuple(tuple(group)
+                                     for group in self._by_level)
+        return self._level_view
 
-
-    def __str__(self):
+    @property
+    def depth(self):
+        """Number of logic levels (the deepest level is depth - 1)"""
+        self.levelize()
+        return len(self._by_level)
+
+    def level_widths(self):
+        """Return the number of gates on each level, from level 0 up"""
+        self.levelize()
+        return [len(group) for group in self._by_level]
+
+    @staticmethod
+    def _level_loops(gates, levels):
+        # Level the gates Kahn's algorithm couldn't, one strongly connected
+        # component at a time, and return gate -> loop for those on a loop
+        for gate in gates:
+            levels.pop(gate, None)
+        loops = {}
+        for component in reversed(strongly_connected(gates)):
+            members = set(component)
+            level = 0
+            for gate in component:
+                for input_ in gate.inputs:
+                    driver = input_.driver
+                    if (driver is not None and driver.owner in levels
+                            and driver.owner not in members):
+                        level = max(level, levels[driver.owner] + 1)
+            for gate in component:
+                levels[gate] = level
+            gate = component[0]
+            if len(component) > 1 or any(connection.owner is gate for
+                                         connection in gate.output.connections):
+                loop = tuple(sorted(component, key=lambda gate: gate.id))
+                for gate in loop:
+                    loops[gate] = loop
+        return loops
+
+    def _order_edge(self, source, target):
+        # Called when source's output is connected to target.  Keeps the
+        # gates' _rank a topological order as wires are added (Pearce and
+        # Kelly), which is how a wire closing a loop is noticed right away.
+        # Only gates ranked between target and source are ever visited, and
+        # none at all for the usual wire from an older gate to a newer one.
+        if self._has_loops or source._id is None or target._id is None:
+            return
+        lower, upper = target._rank, source._rank
+        if lower > upper:
+            return
+        forward = []
+        pending = [target]
+        seen = {target}
+        while pending:
+            gate = pending.pop()
+            forward.append(gate)
+            for connection in gate.output.connections:
+                successor = connection.owner
+                if successor is source:
+                    self._has_loops = True
+                    return
+                if (successor not in seen and successor in self
+                        and successor._rank < upper):
+                    seen.add(successor)
+                    pending.append(successor)
+        backward = []
+        pending = [source]
+        seen = {source}
+        while pending:
+            gate = pending.pop()
+            backward.append(gate)
+            for input_ in gate.inputs:
+                driver = input_.driver
+                predecessor = None if driver is None else driver.owner
+                if (predecessor is not None and predecessor not in seen
+                        and predecessor in self
+                        and predecessor._rank > lower):
+                    seen.add(predecessor)
+                    pending.append(predecessor)
+        # Everything that reaches source now goes before everything target
+        # reaches, reusing the same ranks
+        backward.sort(key=lambda gate: gate._rank)
+        forward.sort(key=lambda gate: gate._rank)
+        moved = backward + forward
+        ranks = sorted(gate._rank for gate in moved)
+        for gate, rank in zip(moved, ranks):
+            gate._rank = rank
+
+    def loops(self):
+        """Return the combinational loops, each as a tuple of its gates
+
+        A loop is a strongly connected component of the wiring (or a gate
+        feeding itself).  Circuits that were never wired into a loop answer
+        without levelizing.
+        """
+        if not self._has_loops:
+            return []
+        self.levelize()
+        return list({id(loop): loop for loop in self._loops.values()}
+                    .values())
+
+    def _loop_of(self, gate):
+        # The loop gate is on, or None; only called when _has_loops is set
+        self.levelize()
+        return self._loops.get(gate)
+
+    def _require_acyclic(self, what):
+        if self.loops():
+            raise ValueError(f"{what} needs a circuit without combinational "
+                             f"loops")
+
+    def topological_order(self):
+        """Return the gates as a list sorted by logic level"""
+        if self._order is None:
+            self.levelize()
+            self._order = [gate for group in self._by_level
+                           for gate in group.values()]
+        return self._order
+
+    def simulate_packed(self, stimulus, width):
+        """Simulate width test vectors at once.
+
+        stimulus maps primary Inputs to ints holding one bit per vector
+        (bit k is the value of that input in vector k).  Every gate is
+        evaluated exactly once with bitwise operations, and the result maps
+        each gate's Output to its packed value.  Inputs missing from
+        stimulus keep their current value in every vector.  The circuit's
+        own signal values are left untouched.
+        """
+        if width < 1:
+            raise ValueError("width must be at least 1")
+        mask = (1 << width) - 1
+        return self._simulate_words(
+            {input_: value & mask for input_, value in stimulus.items()}, mask)
+
+    def _simulate_words(self, stimulus, mask):
+        # Shared by simulate_packed (Python ints) and evaluate_batch (NumPy
+        # uint64 arrays): both support the same bitwise operators.
+        self._require_acyclic("Packed simulation")
+        signals = {}
+        for gate in self.topological_order():
+            values = []
+            for input_ in gate.inputs:
+                if input_ in stimulus:
+                    values.append(stimulus[input_])
+                elif input_.driver in signals:
+                    values.append(signals[input_.driver])
+                elif input_.value is X:
+                    raise ValueError(
+                        f"An input of gate {gate.name} has no value and no "
+                        f"stimulus (simulate_planes handles X)")
+                else:
+                    values.append(mask if input_.value else 0)
+            signals[gate.output] = gate.evaluate_packed(mask, *values)
+        return signals
+
+    def simulate_planes(self, stimulus, width):
+        """Simulate width test vectors at once in three-valued logic.
+
+        Like simulate_packed, but every signal is a (ones, zeros) pair of
+        bit-planes (see pack_planes): bit k of ones is set if the signal is
+        1 in vector k, bit k of zeros if it is 0, and neither if it is X.
+        Inputs missing from stimulus keep their current value, X included,
+        in every vector.  Returns Output -> (ones, zeros).
+        """
+        if width < 1:
+            raise ValueError("width must be at least 1")
+        self._require_acyclic("Packed simulation")
+        mask = (1 << width) - 1
+        constants = {True: (mask, 0), False: (0, mask), X: (0, 0)}
+        signals = {}
+        for gate in self.topological_order():
+            values = []
+            for input_ in gate.inputs:
+                if input_ in stimulus:
+                    ones, zeros = stimulus[input_]
+                    values.append((ones & mask, zeros & mask))
+                elif input_.driver in signals:
+                    values.append(signals[input_.driver])
+                else:
+                    values.append(constants[input_.value])
+            ones, zeros = gate.evaluate_planes(*values)
+            signals[gate.output] = (ones & mask, zeros & mask)
+        return signals
+
+    def primary_inputs(self):
+        """Return the gate inputs that are not driven by one of our gates"""
+        levels = self.levelize()
+        return [input_ for gate in self.topological_order()
+                for input_ in gate.inputs
+                if input_.driver is None or input_.driver.owner not in levels]
+
+    def _signals(self):
+        """Return {gate: [the signal each of its inputs reads]}
+
+        Gates come in topological order.  A signal is the Output of one of
+        our gates, the name of the input port an undriven input is part of,
+        the name of the flip-flop whose Q drives it, or else the Input
+        itself (unported, or driven from outside).
+        """
+        ports = {input_: name for name, inputs in self.input_ports().items()
+                 for input_ in inputs if input_.driver is None}
+        states = {flip_flop.q: flip_flop.name
+                  for flip_flop in self._flip_flops.values()}
+        signals = {}
+        for gate in self.topological_order():
+            reads = []
+            for input_ in gate.inputs:
+                driver = input_.driver
+                if driver is not None and driver.owner in self:
+                    reads.append(driver)
+                elif driver in states:
+                    reads.append(states[driver])
+                else:
+                    reads.append(ports.get(input_, input_))
+            signals[gate] = reads
+        return signals
+
+    def primary_outputs(self):
+        """Return the gate outputs that are not connected to any input"""
+        return [gate.output for gate in self.topological_order()
+                if not gate.output.connections]
+
+    def add_input_port(self, name, *inputs):
+        """Name a primary input of the circuit and the gate inputs it feeds
+
+        The D inputs of the circuit's flip-flops can be part of a port too.
+        Adding the same name again adds more inputs to that port.
+        """
+        for input_ in inputs:
+            if not isinstance(input_, Input):
+                raise TypeError("Input ports are made of Inputs")
+            owner = input_.owner
+            if (owner not in self
+                    and self._flip_flops.get(owner.name) is not owner):
+                raise ValueError(f"Gate {owner.name} is not part of this "
+                                 f"circuit")
+            if input_.driver is not None:
+                raise ValueError(f"An input of gate {input_.owner.name} is "
+                                 f"already driven by an output")
+        self._input_ports.setdefault(name, []).extend(inputs)
+
+    def add_output_port(self, name, output):
+        """Name an output of one of the circuit's gates"""
+        if not isinstance(output, Output):
+            raise TypeError("Output ports are Outputs")
+        if output.owner not in self:
+            raise ValueError("The output's gate is not part of this circuit")
+        if name in self._output_ports:
+            raise ValueError(f"Duplicate output port {name!r}")
+        self._output_ports[name] = output
+
+    def input_ports(self):
+        """Return a dict of port name -> tuple of the gate inputs it feeds.
+
+        Without declared ports every primary input is its own port, named
+        in0, in1, ... in primary_inputs() order.
+        """
+        if self._input_ports:
+            return {name: tuple(inputs)
+                    for name, inputs in self._input_ports.items()}
+        return {f"in{i}": (input_,)
+                for i, input_ in enumerate(self.primary_inputs())}
+
+    def output_ports(self):
+        """Return a dict of port name -> Output.
+
+        Without declared ports every primary output is its own port, named
+        out0, out1, ... in primary_outputs() order.
+        """
+        if self._output_ports:
+            return dict(self._output_ports)
+        return {f"out{i}": output
+                for i, output in enumerate(self.primary_outputs())}
+
+    def set_inputs(self, values):
+        """Assign each input port in the dict values (name -> value)"""
+        ports = self.input_ports()
+        for name, value in values.items():
+            for input_ in ports[name]:
+                input_.value = value
+
+    def _drop_ports(self, gate):
+        for name, inputs in list(self._input_ports.items()):
+            inputs[:] = [input_ for input_ in inputs
+                         if input_.owner is not gate]
+            if not inputs:
+                del self._input_ports[name]
+        for name, output in list(self._output_ports.items()):
+            if output.owner is gate:
+                del self._output_ports[name]
+
+    @classmethod
+    def load(cls, path, mode=IMMEDIATE):
+        """Read a netlist file into a new Circuit
+
+        Binary CircuitStore files (see Circuit.save) are recognized by
+        their header; anything else is read as BLIF.
+        """
+        from logic_gate_store import CircuitStore
+        if CircuitStore.is_store_file(path):
+            circuit, _ = CircuitStore.open(path).to_circuit(mode)
+            return circuit
+        from logic_gate_netlist import read_blif
+        return read_blif(path, cls(mode))
+
+    def save(self, path, binary=False):
+        """Write the circuit to a netlist file
+
+        BLIF text by default; with binary=True, the memory-mappable
+        CircuitStore format.
+        """
+        if binary:
+            self.to_store().save(path)
+        else:
+            from logic_gate_netlist import write_blif
+            write_blif(self, path)
+
+    def evaluate_batch(self, inputs, input_order, output_order=None):
+        """Evaluate many input rows at once with NumPy.
+
+        inputs is a (rows, len(input_order)) array of bool or uint8.  Each
+        entry of input_order is an Input, or a sequence of Inputs that all
+        receive that column.  output_order defaults to primary_outputs().
+        Returns a (rows, len(output_order)) bool array.
+
+        The rows are bit-packed into uint64 words, so every gate costs one
+        vectorized bitwise operation per 64 rows.  If inputs is not an
+        ndarray it is treated as an iterable of chunks, and a generator of
+        result chunks is returned so memory stays bounded.
+        """
+        if np is None:
+            raise ImportError("Circuit.evaluate_batch requires NumPy")
+        groups = [(entry,) if isinstance(entry, Input) else tuple(entry)
+                  for entry in input_order]
+        if output_order is None:
+            output_order = self.primary_outputs()
+        if isinstance(inputs, np.ndarray):
+            return self._evaluate_chunk(inputs, groups, output_order)
+        return (self._evaluate_chunk(np.asarray(chunk), groups, output_order)
+                for chunk in inputs)
+
+    def _evaluate_chunk(self, chunk, groups, output_order):
+        if chunk.ndim != 2 or chunk.shape[1] != len(groups):
+            raise ValueError(f"Expected a (rows, {len(groups)}) input array, "
+                             f"got shape {chunk.shape}")
+        rows = chunk.shape[0]
+        # One row of bits per input column, padded to whole uint64 words
+        bits = np.packbits(chunk.T.astype(bool), axis=1, bitorder="little")
+        padding = -bits.shape[1] % 8
+        if padding:
+            bits = np.pad(bits, ((0, 0), (0, padding)))
+        words = np.ascontiguousarray(bits).view("<u8")
+        stimulus = {}
+        for column, group in enumerate(groups):
+            for input_ in group:
+                stimulus[input_] = words[column]
+        mask = np.uint64(0xFFFFFFFFFFFFFFFF)
+        signals = self._simulate_words(stimulus, mask)
+        result = np.empty((rows, len(output_order)), dtype=bool)
+        for column, output in enumerate(output_order):
+            packed = np.broadcast_to(np.asarray(signals[output], dtype="<u8"),
+                                     words.shape[1:])
+            result[:, column] = np.unpackbits(
+                np.ascontiguousarray(packed).view(np.uint8),
+                bitorder="little")[:rows].astype(bool)
+        return result
+
+    def compile(self):
+        """Return a CompiledCircuit for the current structure (cached)"""
+        if self._compiled is None:
+            from logic_gate_compiled import CompiledCircuit
+            self._compiled = CompiledCircuit(self)
+        return self._compiled
+
+    def to_store(self):
+        """Return a CircuitStore (struct-of-arrays copy) of this circuit"""
+        from logic_gate_store import CircuitStore
+        return CircuitStore.from_circuit(self)
+
+    def to_function(self):
+        """Return a generated straight-line function evaluating the circuit
+
+        See CompiledCircuit.to_function for the calling convention.
+        """
+        return self.compile().to_function()
+
+    def map_luts(self, k=6):
+        """Return (mapped, outputs): a copy made of LUTs of up to k inputs
+
+        See logic_gate_mapping.map_luts.
+        """
+        from logic_gate_mapping import map_luts
+        return map_luts(self, k)
+
+    def optimize(self, aig=False):
+        """Return (optimized, report): an equivalent, smaller copy
+
+        See logic_gate_optimize.optimize.
+        """
+        from logic_gate_optimize import optimize
+        return optimize(self, aig)
+
+    def simulator(self, width=1):
+        """Return a CycleSimulator for the current structure
+
+        See logic_gate_sequential.CycleSimulator.
+        """
+        from logic_gate_sequential import CycleSimulator
+        return CycleSimulator(self, width)
+
+    def cone(self, input_):
+        """Return the gates input_ can influence, in topological order
+
+        Cached per input until the circuit changes.
+        """
+        cone = self._cones.get(input_)
+        if cone is None:
+            levels = self.levelize()
+            seen = set()
+            pending = [input_.owner] if input_.owner in levels else []
+            while pending:
+                gate = pending.pop()
+                if gate in seen:
+                    continue
+                seen.add(gate)
+                for connection in gate.output.connections:
+                    if connection.owner in levels:
+                        pending.append(connection.owner)
+            cone = sorted(seen, key=lambda gate: (levels[gate], gate.id))
+            self._cones[input_] = cone
+        return cone
+
+    def apply(self, values):
+        """Set several inputs at once and re-evaluate only what they affect.
+
+        values maps Inputs (or input port names) to values.  Only gates
+        with an input that actually changed are evaluated, each once, from
+        a worklist ordered by level and seeded by the changed inputs; so
+        the work follows the changes, not the size of the inputs' cones.
+        Returns the number of gates evaluated.  In LAZY mode the inputs are
+        just set, and nothing is evaluated until an output is read.  In a
+        circuit with combinational loops the inputs are set one at a time,
+        through the circuit's mode, and 0 is returned.
+        """
+        if self._mode == Circuit.LAZY or self.loops():
+            ports = self.input_ports() if not all(
+                isinstance(key, Input) for key in values) else None
+            for key, value in values.items():
+                for input_ in ((key,) if isinstance(key, Input)
+                               else ports[key]):
+                    input_.value = value
+            return 0
+        levels = self.levelize()
+        ports = None
+        # (level, id, gate) heap of the gates to evaluate, as in _drain
+        queue = []
+        queued = set()
+        for key, value in values.items():
+            if isinstance(key, Input):
+                inputs = (key,)
+            else:
+                if ports is None:
+                    ports = self.input_ports()
+                inputs = ports[key]
+            value = X if value is X else bool(value)
+            for input_ in inputs:
+                if input_._value is value:
+                    continue
+                input_._value = value
+                owner = input_.owner
+                if owner in levels:
+                    if owner not in queued:
+                        queued.add(owner)
+                        heapq.heappush(queue, (levels[owner], owner._id,
+                                               owner))
+                else:
+                    owner.input_changed()
+        evaluated = 0
+        while queue:
+            _, _, gate = heapq.heappop(queue)
+            evaluated += 1
+            value = gate.evaluate_ternary(*[input_._value
+                                            for input_ in gate.inputs])
+            output = gate.output
+            output._evaluations += 1
+            if output._value is value:
+                continue
+            output._changes += 1
+            output._value = value
+            for connection in output.connections:
+                owner = connection.owner
+                if owner in levels:
+                    # On a higher level, so evaluated later in this pass
+                    connection._value = value
+                    if owner not in queued:
+                        queued.add(owner)
+                        heapq.heappush(queue, (levels[owner], owner._id,
+                                               owner))
+                else:
+                    connection.value = value
+        return evaluated
+
+    def input_changed(self, gate):
+        """Called when one of the inputs of gate (a member) changed"""
+        loop = self._loop_of(gate) if self._has_loops else None
+        if loop is not None and id(loop) in self._settling:
+            # Part of the loop being settled; queue it there instead of
+            # recursing
+            pending, queued = self._settling[id(loop)]
+            if gate not in queued:
+                queued.add(gate)
+                pending.append(gate)
+        elif self._mode == Circuit.SCHEDULED:
+            self.schedule(gate)
+        elif self._mode == Circuit.LAZY:
+            self._mark_stale(gate)
+        elif loop is not None:
+            self._settle((gate,), loop)
+        else:
+            gate.evaluate()
+
+    def _settle(self, gates, loop):
+        """Evaluate a combinational loop until its outputs stop changing.
+
+        Starts with gates, and re-evaluates every gate of the loop whose
+        input changes meanwhile, first come first served.  Raises
+        OscillationError after LOOP_LIMIT evaluations per gate of the loop.
+        Gates outside the loop are notified as usual.
+        """
+        pending = collections.deque(gates)
+        queued = set(gates)
+        self._settling[id(loop)] = (pending, queued)
+        try:
+            budget = self.LOOP_LIMIT * len(loop)
+            while pending:
+                if budget == 0:
+                    raise OscillationError(loop)
+                budget -= 1
+                gate = pending.popleft()
+                queued.discard(gate)
+                gate.evaluate()
+        finally:
+            del self._settling[id(loop)]
+
+    @staticmethod
+    def _mark_stale(gate):
+        # Everything downstream of a stale output is already stale, so the
+        # walk stops there, and at flip-flops, which only change on a clock
+        pending = [gate]
+        while pending:
+            output = pending.pop().output
+            if output._stale:
+                continue
+            output._stale = True
+            for connection in output.connections:
+                if not isinstance(connection.owner, DFlipFlop):
+                    pending.append(connection.owner)
+
+    def pull(self, gate):
+        """Bring gate's output up to date, evaluating only its stale fan-in
+
+        Used by Output.value in LAZY mode.  The walk uses an explicit stack,
+        so deep cones don't hit the recursion limit.  A gate on a
+        combinational loop brings in the fan-in of the whole loop, which is
+        then settled at once.
+        """
+        # Depth-first, one driver at a time, so the stack is the current
+        # path and every gate is visited once
+        visited = set(self._loop_of(gate) or (gate,) if self._has_loops
+                      else (gate,))
+        stack = [(gate, iter(self._fan_in(gate)))]
+        while stack:
+            top, inputs = stack[-1]
+            for input_ in inputs:
+                driver = input_.driver
+                if (driver is not None and driver._stale
+                        and driver.owner not in visited):
+                    owner = driver.owner
+                    visited.update(self._loop_of(owner) or (owner,)
+                                   if self._has_loops else (owner,))
+                    stack.append((owner, iter(self._fan_in(owner))))
+                    break
+            else:
+                stack.pop()
+                self._refresh(top)
+
+    def _fan_in(self, gate):
+        # The inputs gate's value depends on; for a gate on a loop, those
+        # of every gate of the loop
+        loop = self._loop_of(gate) if self._has_loops else None
+        if loop is None:
+            return gate.inputs
+        return [input_ for member in loop for input_ in member.inputs]
+
+    def _refresh(self, gate):
+        # Recompute a stale output from its (up to date) drivers
+        output = gate.output
+        if not output._stale:
+            return
+        loop = self._loop_of(gate) if self._has_loops else None
+        if loop is not None:
+            for member in loop:
+                member.output._stale = False
+                for input_ in member.inputs:
+                    if input_.driver is not None:
+                        input_._value = input_.driver._value
+            self._settle(loop, loop)
+            return
+        output._stale = False
+        for input_ in gate.inputs:
+            if input_.driver is not None:
+                input_._value = input_.driver._value
+        value = gate.evaluate_ternary(*[input_._value
+                                        for input_ in gate.inputs])
+        output._evaluations += 1
+        if output._value is not value:
+            output._changes += 1
+            output._value = value
+
+    def schedule(self, gate):
+        """Enqueue gate for evaluation and drain the queue if not already"""
+        if gate not in self._queued:
+            self._queued.add(gate)
+            heapq.heappush(self._queue,
+                           (self.levelize()[gate], self._sequence, gate))
+            self._sequence += 1
+        if not self._draining:
+            self._drain()
+
+    def _drain(self):
+        # Evaluating a gate sets its output, which sets the connected inputs,
+        # which only enqueue their owners while we are draining.  So the
+        # stack depth stays constant however deep the circuit is.
+        self._draining = True
+        try:
+            while self._queue:
+                _, _, gate = heapq.heappop(self._queue)
+                self._queued.discard(gate)
+                loop = self._loop_of(gate) if self._has_loops else None
+                if loop is None:
+                    gate.evaluate()
+                else:
+                    self._settle((gate,), loop)
+        finally:
+            if self._queue:
+                # An evaluation raised; don't leave stale events behind
+                self._queue.clear()
+                self._queued.clear()
+            self._draining = False
+
+    def iter_gates(self):
+        """Yield the gates lazily, newest first"""
         start = self._top
-        returned_str = ""
         while start is not None:
-            returned_str += "(" + str(start) + ")"
+            yield start
             start = start.next
-        return returned_str
+
+    __iter__ = iter_gates
+
+    def dump(self, fp, separator="\n", chunk_size=1024):
+        """Write "(gate description)" for every gate to the file-like fp.
+
+        Descriptions are buffered and written chunk_size gates at a time,
+        so memory stays flat however big the circuit is.
+        """
+        chunk = []
+        for gate in self.iter_gates():
+            chunk.append("(" + str(gate) + ")")
+            if len(chunk) == chunk_size:
+                chunk.append("")
+                fp.write(separator.join(chunk))
+                chunk.clear()
+        if chunk:
+            chunk.append("")
+            fp.write(separator.join(chunk))
+
+    def __str__(self):
+        buffer = io.StringIO()
+        self.dump(buffer, separator="")
+        return buffer.getvalue()
+
+
+def strongly_connected(gates):
+    """Return the strongly connected components among gates (Tarjan)
+
+    Only wires between the given gates count.  The components come as
+    lists of gates, in reverse topological order.  Iterative, so long
+    chains don't hit the recursion limit.
+    """
+    members = set(gates)
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for root in gates:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(root.output.connections))]
+        while work:
+            gate, connections = work[-1]
+            for connection in connections:
+                successor = connection.owner
+                if successor not in members:
+                    continue
+                if successor not in index:
+                    index[successor] = low[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor,
+                                 iter(successor.output.connections)))
+                    break
+                if successor in on_stack:
+                    low[gate] = min(low[gate], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[gate])
+                if low[gate] == index[gate]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member is gate:
+                            break
+                    components.append(component)
+    return components
+
+
+def pack_planes(values):
+    """Pack a list of True, False and X into (ones, zeros) bit-planes"""
+    ones = zeros = 0
+    for k, value in enumerate(values):
+        if value is True:
+            ones |= 1 << k
+        elif value is False:
+            zeros |= 1 << k
+    return ones, zeros
+
+
+def unpack_planes(planes, width):
+    """Inverse of pack_planes"""
+    ones, zeros = planes
+    return [True if (ones >> k) & 1 else False if (zeros >> k) & 1 else X
+            for k in range(width)]
+
+
+def pack(values):
+    """Pack a sequence of bools into an int, vector k in bit k"""
+    packed = 0
+    for bit, value in enumerate(values):
+        if value:
+            packed |= 1 << bit
+    return packed
+
+
+def unpack(packed, width):
+    """Unpack an int produced by Circuit.simulate_packed into width bools"""
+    return [bool((packed >> bit) & 1) for bit in range(width)]
+
+
+def exhaustive_stimulus(inputs):
+    """Return (stimulus, width) covering every combination of inputs.
+
+    Vector k assigns bit i of k to inputs[i], so a single simulate_packed
+    call sweeps the whole truth table.
+    """
+    width = 1 << len(inputs)
+    stimulus = {}
+    for i, input_ in enumerate(inputs):
+        # Runs of 2**i zeros followed by 2**i ones, repeated
+        block = ((1 << (1 << i)) - 1) << (1 << i)
+        pattern = 0
+        for start in range(0, width, 2 << i):
+            pattern |= block << start
+        stimulus[input_] = pattern
+    return stimulus, width
 
 
 def test():
@@ -296,6 +2174,23 @@ def test():
         test_xor,
         test_not_not,
         test_and_not,
+        test_scheduled_full_adder,
+        test_scheduled_deep_chain,
+        test_simulate_packed,
+        test_evaluate_batch,
+        test_compiled,
+        test_cost_report,
+        test_circuit_index,
+        test_dump,
+        test_activity,
+        test_apply,
+        test_lazy,
+        test_loops,
+        test_levels,
+        test_three_valued,
+        test_nary_gates,
+        test_lut_gate,
+        test_flip_flops,
     ]
     for t in tests:
         print("Running " + t.__name__ + " " + "-" * 20)
@@ -306,11 +2201,8 @@ def test_input():
     circuit = Circuit()
     input_ = Input(NotGate("test", circuit))
     print("Initially, input_ is:", input_)
-    try:
-        print(input_.value)
-        print("Failed: input_.value exists before it's set, which should not happen!")
-    except AttributeError:
-        print("Succeeded: input_.value doesn't exist before it's set.")
+    # Before it's set, the value is the unknown X rather than missing
+    assert input_.value is X
     input_.value = True
     print("After set to True, input_ is:", input_)
 
@@ -318,11 +2210,7 @@ def test_input():
 def test_output():
     output = Output()
     print("Initially, output is:", output)
-    try:
-        print(output.value)
-        print("Failed: output.value exists before it's set, which should not happen!")
-    except AttributeError:
-        print("Succeeded: output.value doesn't exist before it's set.")
+    assert output.value is X
     output.value = True
     print("After set to True, output is:", output)
 
@@ -407,6 +2295,679 @@ def test_and_not():
     print(f"Cost of NOT-NOT circuit is {circuit.cost}")
 
 
+def test_scheduled_full_adder():
+    for a in (False, True):
+        for b in (False, True):
+            for ci in (False, True):
+                results = []
+                for mode in (Circuit.IMMEDIATE, Circuit.SCHEDULED):
+                    circuit = Circuit(mode)
+                    (a_in, b_in, ci_in), (sum_out, co_out) = \
+                        build_full_adder(circuit)
+                    for input_ in a_in:
+                        input_.value = a
+                    for input_ in b_in:
+                        input_.value = b
+                    for input_ in ci_in:
+                        input_.value = ci
+                    results.append((sum_out.value, co_out.value))
+                print(f"a={a} b={b} ci={ci}: immediate={results[0]} "
+                      f"scheduled={results[1]}")
+                assert results[0] == results[1]
+
+
+def test_scheduled_deep_chain():
+    import sys
+    length = 3 * sys.getrecursionlimit()
+    circuit = Circuit(Circuit.SCHEDULED)
+    first = previous = NotGate("not0", circuit)
+    for i in range(1, length):
+        gate = NotGate(f"not{i}", circuit)
+        previous.output.connect(gate.input)
+        previous = gate
+    first.input.value = False
+    print(f"Chain of {length} NOT gates, last output: {previous.output}")
+    assert previous.output.value == (length % 2 == 1)
+
+
+def test_simulate_packed():
+    circuit = Circuit()
+    ports, (sum_out, co_out) = build_full_adder(circuit)
+    # a, b and ci each feed two gate inputs
+    patterns, width = exhaustive_stimulus(ports)
+    stimulus = {input_: patterns[port] for port in ports for input_ in port}
+    signals = circuit.simulate_packed(stimulus, width)
+    sums = unpack(signals[sum_out], width)
+    carries = unpack(signals[co_out], width)
+    for k in range(width):
+        a, b, ci = k & 1, (k >> 1) & 1, (k >> 2) & 1
+        print(f"a={a} b={b} ci={ci}: sum={sums[k]} co={carries[k]}")
+        assert sums[k] == bool((a + b + ci) & 1)
+        assert carries[k] == (a + b + ci >= 2)
+
+
+def test_evaluate_batch():
+    if np is None:
+        print("Skipped: NumPy is not installed")
+        return
+    circuit = Circuit()
+    ports, outputs = build_full_adder(circuit)
+    rows = np.random.default_rng(3).integers(0, 2, size=(1000, 3),
+                                             dtype=np.uint8)
+    expected = np.stack([rows.sum(axis=1) & 1, rows.sum(axis=1) >= 2], axis=1)
+    result = circuit.evaluate_batch(rows, ports, outputs)
+    print(f"{len(rows)} rows, all match: {bool((result == expected).all())}")
+    assert (result == expected).all()
+    chunks = circuit.evaluate_batch(iter(np.array_split(rows, 7)), ports,
+                                    outputs)
+    assert (np.concatenate(list(chunks)) == expected).all()
+    print("Chunked evaluation matches too")
+
+
+def test_compiled():
+    circuit = Circuit()
+    ports, _ = build_full_adder(circuit)
+    compiled = circuit.compile()
+    print(compiled)
+    evaluate = circuit.to_function()
+    # Map each compiled input back to its operand position
+    operand = {input_: i for i, port in enumerate(ports) for input_ in port}
+    for k in range(8):
+        bits = [bool((k >> operand[input_]) & 1) for input_ in compiled.inputs]
+        run = compiled.run(bits)
+        generated = list(evaluate(*bits))
+        total = sum((k >> i) & 1 for i in range(3))
+        print(f"a={k & 1} b={(k >> 1) & 1} ci={k >> 2}: run={run} "
+              f"generated={generated}")
+        assert run == generated == [bool(total & 1), total >= 2]
+    other = Circuit()
+    build_full_adder(other)
+    assert other.to_function() is evaluate
+    print("Structurally identical circuits share the generated function")
+
+
+def test_cost_report():
+    top = Circuit(name="top")
+    NotGate("not", top)
+    for _ in range(2):
+        build_full_adder(Circuit(parent=top))
+    print(f"Cost of two full adders and a NOT gate is {top.cost}")
+    print(f"Asking again gives the same answer: {top.cost}")
+    report = top.cost_report()
+    print(report["by_type"])
+    print({name: module["cost"] for name, module in report["by_module"].items()})
+    assert top.cost == top.cost == 40 + 2 * 5 * 90
+    assert report["by_type"]["XorGate"] == {"gates": 4, "cost": 360}
+
+
+def test_circuit_index():
+    circuit = Circuit()
+    and_gate = AndGate("and", circuit)
+    not_gate = NotGate("not", circuit)
+    or_gate = OrGate("or", circuit)
+    and_gate.output.connect(not_gate.input)
+    not_gate.output.connect(or_gate.input0)
+    print(f"{len(circuit)} gates; 'not' in circuit: {'not' in circuit}; "
+          f"id {not_gate.id} is {circuit.get(not_gate.id).name}")
+    assert circuit.get("not") is not_gate and not_gate in circuit
+    circuit.remove("not")
+    print(f"After removing 'not': {circuit}")
+    print(f"Cost is now {circuit.cost}")
+    assert len(circuit) == 2 and "not" not in circuit
+    assert not and_gate.output.connections and or_gate.input0.driver is None
+    assert circuit.cost == 180 and and_gate.next is None
+
+
+def test_dump():
+    circuit = Circuit()
+    build_full_adder(circuit)
+    buffer = io.StringIO()
+    circuit.dump(buffer, chunk_size=2)
+    print(buffer.getvalue(), end="")
+    print(f"Gate names, newest first: "
+          f"{[gate.name for gate in circuit.iter_gates()]}")
+    assert buffer.getvalue().replace("\n", "") == str(circuit)
+
+
+def test_activity():
+    circuit = Circuit()
+    first = previous = AndGate("and0", circuit)
+    for i in range(1, 100):
+        gate = AndGate(f"and{i}", circuit)
+        previous.output.connect(gate.input0)
+        gate.input1.value = True
+        previous = gate
+    first.input0.value = first.input1.value = True
+    print(f"First stimulus: {circuit.activity()}")
+    circuit.reset_activity()
+    # Forcing an already-true input to true changes nothing downstream
+    first.input1.value = True
+    print(f"Repeated stimulus: {circuit.activity()}")
+    assert circuit.activity() == {"evaluations": 1, "changes": 0,
+                                  "unchanged": 1}
+    first.input1.value = False
+    print(f"Changing stimulus: {circuit.activity()}, last output "
+          f"{previous.output}")
+    assert circuit.activity()["changes"] == 100
+
+
+def test_apply():
+    circuit = Circuit()
+    a_ports, b_ports, ci_inputs, sums, carry = build_ripple_adder(circuit, 32)
+    stimulus = {}
+    for i in range(32):
+        for input_ in a_ports[i]:
+            stimulus[input_] = (0x89ABCDEF >> i) & 1
+        for input_ in b_ports[i]:
+            stimulus[input_] = (0x12345678 >> i) & 1
+    for input_ in ci_inputs:
+        stimulus[input_] = False
+    print(f"Initial apply evaluated {circuit.apply(stimulus)} of "
+          f"{len(circuit)} gates")
+    total = sum(output.value << i for i, output in enumerate(sums))
+    total += carry.value << 32
+    assert total == 0x89ABCDEF + 0x12345678
+    # Flip the top bit of a: only the last full adder changes
+    evaluated = circuit.apply({input_: False for input_ in a_ports[31]})
+    print(f"Flipping a31 evaluated {evaluated} gates")
+    total = sum(output.value << i for i, output in enumerate(sums))
+    total += carry.value << 32
+    assert total == 0x09ABCDEF + 0x12345678 and evaluated <= 5
+    # Flip a0: b0 and the carry-in are 0, so the carry out of bit 0 stays
+    # 0 and the change stops there; a0's whole cone is never walked
+    evaluated = circuit.apply({input_: False for input_ in a_ports[0]})
+    print(f"Flipping a0 evaluated {evaluated} gates")
+    assert evaluated <= 5 and not circuit._cones
+    # A gate whose value doesn't depend on its inputs has it even while
+    # they are unknown and never change
+    for mode in (Circuit.IMMEDIATE, Circuit.SCHEDULED, Circuit.LAZY):
+        circuit = Circuit(mode)
+        and_ = AndGate("and", circuit)
+        zero = LutGate("zero", circuit, 1, 0x0)
+        and_.output.connect(zero.inputs[0])
+        circuit.add_input_port("p", and_.input0)
+        circuit.add_input_port("q", and_.input1)
+        circuit.set_inputs({"p": X, "q": X})
+        assert zero.output.value is False
+        circuit.apply({"p": True})
+        assert and_.output.value is X and zero.output.value is False
+
+
+def test_lazy():
+    import sys
+    circuit = Circuit(Circuit.LAZY)
+    a_ports, b_ports, ci_inputs, sums, carry = build_ripple_adder(circuit, 64)
+    for i in range(64):
+        for input_ in a_ports[i] + b_ports[i]:
+            input_.value = True
+    for input_ in ci_inputs:
+        input_.value = False
+    print(f"After setting every input: {circuit.activity()}")
+    assert circuit.activity()["evaluations"] == 0
+    print(f"Lowest sum bit is {sums[0]}: {circuit.activity()}")
+    assert circuit.activity()["evaluations"] == 2
+    print(f"Carry out is {carry.value}: {circuit.activity()}")
+    assert carry.value is True
+    circuit.reset_activity()
+    print(f"Reading it again: {carry}, {circuit.activity()}")
+    assert circuit.activity()["evaluations"] == 0
+    # Deeper than the recursion limit
+    chain = Circuit(Circuit.LAZY)
+    first = previous = NotGate("not0", chain)
+    for i in range(1, 2 * sys.getrecursionlimit()):
+        gate = NotGate(f"not{i}", chain)
+        previous.output.connect(gate.input)
+        previous = gate
+    first.input.value = True
+    print(f"End of a {len(chain)}-gate lazy chain: {previous.output}")
+    assert previous.output.value is True
+    # Gates wired after the inputs are set, to outputs not yet worked out
+    circuit = Circuit(Circuit.LAZY)
+    first = NotGate("first", circuit)
+    first.input.value = True
+    second = NotGate("second", circuit)
+    first.output.connect(second.input)
+    assert first.output.value is False and second.output.value is True
+    zero = LutGate("zero", circuit, 1, 0x0)
+    zero.inputs[0].value = True
+    third = NotGate("third", circuit)
+    zero.output.connect(third.input)
+    assert third.output.value is True
+
+
+def test_loops():
+    # An SR latch: two NOR gates (OR + NOT) feeding each other
+    for mode in (Circuit.IMMEDIATE, Circuit.SCHEDULED, Circuit.LAZY):
+        circuit = Circuit(mode)
+        or_s = OrGate("or_s", circuit)
+        or_r = OrGate("or_r", circuit)
+        q_bar = NotGate("q_bar", circuit)
+        q = NotGate("q", circuit)
+        or_s.output.connect(q_bar.input)
+        or_r.output.connect(q.input)
+        assert circuit.loops() == []
+        q_bar.output.connect(or_r.input1)
+        q.output.connect(or_s.input1)
+        names = [[gate.name for gate in loop] for loop in circuit.loops()]
+        print(f"{mode}: loops {names}")
+        assert len(circuit.loops()) == 1 and len(circuit.loops()[0]) == 4
+        or_r.input0.value = False
+        or_s.input0.value = True
+        print(f"  set:   q={q.output}")
+        assert q.output.value is True
+        or_s.input0.value = False
+        print(f"  hold:  q={q.output}")
+        assert q.output.value is True
+        or_r.input0.value = True
+        print(f"  reset: q={q.output}")
+        assert q.output.value is False
+        or_r.input0.value = False
+        assert q.output.value is False
+    # Breaking the loop puts the circuit back on the acyclic path
+    q.output.disconnect(or_s.input1)
+    assert circuit.loops() == [] and circuit.compile().depth == 4
+    # A ring of three inverters, started from a known state by an enable
+    # input, never settles
+    for mode in (Circuit.IMMEDIATE, Circuit.SCHEDULED, Circuit.LAZY):
+        ring = Circuit(mode)
+        enable = AndGate("enable", ring)
+        gates = [enable] + [NotGate(f"not{i}", ring) for i in range(3)]
+        for gate, following in zip(gates, gates[1:]):
+            gate.output.connect(following.inputs[0])
+        gates[-1].output.connect(enable.input1)
+        enable.input0.value = False
+        assert gates[-1].output.value is True
+        try:
+            enable.input0.value = True
+            gates[-1].output.value
+        except OscillationError as error:
+            print(f"{mode}: {error}")
+        else:
+            raise AssertionError("The ring should oscillate")
+    try:
+        ring.compile()
+    except ValueError as error:
+        print(error)
+    else:
+        raise AssertionError("A ring can't be compiled")
+    # Wires from newer to older gates are reordered, not mistaken for loops
+    circuit = Circuit()
+    gates = [NotGate(f"not{i}", circuit) for i in range(100)]
+    for gate, previous in zip(gates, gates[1:]):
+        previous.output.connect(gate.input)
+    assert not circuit._has_loops
+    gates[0].output.connect(gates[-1].input)
+    assert circuit._has_loops and len(circuit.loops()[0]) == 100
+    # With a loop in the circuit, wires that close no new loop still keep
+    # the levels up to date instead of dropping them
+    circuit = Circuit()
+    or_a = OrGate("or_a", circuit)
+    or_b = OrGate("or_b", circuit)
+    or_a.output.connect(or_b.input0)
+    or_b.output.connect(or_a.input0)
+    levels = circuit.levelize()
+    tail = [NotGate(f"tail{i}", circuit) for i in range(2)]
+    or_b.output.connect(tail[0].input)
+    tail[0].output.connect(tail[1].input)
+    entry = NotGate("entry", circuit)
+    first = NotGate("first", circuit)
+    entry.output.connect(or_a.input1)
+    first.output.connect(entry.input)
+    assert circuit._levels is levels
+    order = [first, entry, or_a, or_b] + tail
+    assert [levels[gate] for gate in order] == [0, 1, 2, 2, 3, 4]
+    # ... and a wire that closes one finds the loops again
+    tail[1].output.connect(or_b.input1)
+    assert circuit._levels is None
+    assert len(circuit.loops()) == 1 and len(circuit.loops()[0]) == 4
+
+
+def test_levels():
+    import random
+
+    circuit = Circuit()
+    build_full_adder(circuit)
+    print(f"Full adder levels: {circuit.levels()}, depth {circuit.depth}, "
+          f"widths {circuit.level_widths()}")
+    assert circuit.depth == 3 and circuit.level_widths() == [2, 2, 1]
+    # Wire a random circuit, checking the incrementally updated levels
+    # against a rebuild from scratch along the way
+    random.seed(18)
+    circuit = Circuit()
+    gates = []
+    for i in range(300):
+        gate = random.choice((NotGate, AndGate, OrGate))(f"g{i}", circuit)
+        for input_ in gate.inputs:
+            if gates and random.random() < 0.8:
+                random.choice(gates).output.connect(input_)
+        gates.append(gate)
+        if i % 50 == 49:
+            incremental = [set(group) for group in circuit.levels()]
+            circuit.invalidate()
+            assert incremental == [set(group) for group in circuit.levels()]
+    # Feeding the deepest gate into an older, undriven one moves it (and
+    # what it drives) up
+    last = gates[-1]
+    depth = circuit.depth
+    target = next(gate for gate in gates if gate.inputs[0].driver is None
+                  and not gate.output.connections)
+    last.output.connect(target.inputs[0])
+    incremental = [set(group) for group in circuit.levels()]
+    circuit.invalidate()
+    assert incremental == [set(group) for group in circuit.levels()]
+    print(f"{len(circuit)} gates: depth {depth} -> {circuit.depth}, "
+          f"widest level {max(circuit.level_widths())}")
+    assert circuit.loops() == []
+    assert circuit.levelize()[target] == circuit.levelize()[last] + 1
+
+
+def test_three_valued():
+    values = (False, True, X)
+    # Every kernel agrees with the scalar truth tables, vector by vector
+    for gate_class in (AndGate, OrGate, XorGate):
+        pairs = [(a, b) for a in values for b in values]
+        expected = [gate_class.evaluate_ternary(a, b) for a, b in pairs]
+        planes = gate_class.evaluate_planes(
+            pack_planes([a for a, _ in pairs]),
+            pack_planes([b for _, b in pairs]))
+        assert unpack_planes(planes, len(pairs)) == expected
+        print(f"{gate_class.__name__}: " + ", ".join(
+            f"{a} {b} -> {value}" for (a, b), value in zip(pairs, expected)
+            if X in (a, b)))
+    assert AndGate.evaluate_ternary(False, X) is False
+    assert OrGate.evaluate_ternary(X, True) is True
+    assert unpack_planes(NotGate.evaluate_planes(pack_planes(values)),
+                         3) == [True, False, X]
+    # 1 + 1 + X carries out 1 whatever X is, but the sum is unknown
+    circuit = Circuit()
+    (a_inputs, b_inputs, ci_inputs), (sum_output, co_output) = \
+        build_full_adder(circuit)
+    for input_ in a_inputs + b_inputs:
+        input_.value = True
+    print(f"Object model: sum={sum_output}, co={co_output}")
+    assert sum_output.value is X and co_output.value is True
+    stimulus = {input_: pack_planes([True, False, X])
+                for input_ in a_inputs + b_inputs}
+    signals = circuit.simulate_planes(stimulus, 3)
+    print(f"Planes, a = b = [1, 0, X], ci = X: "
+          f"sum={unpack_planes(signals[sum_output], 3)}, "
+          f"co={unpack_planes(signals[co_output], 3)}")
+    assert unpack_planes(signals[co_output], 3) == [True, False, X]
+    assert unpack_planes(signals[sum_output], 3) == [X, X, X]
+
+
+def test_nary_gates():
+    import itertools
+    import random
+
+    functions = {
+        NaryAndGate: all, NaryOrGate: any,
+        NaryXorGate: lambda values: sum(values) % 2 == 1,
+        NandGate: lambda values: not all(values),
+        NorGate: lambda values: not any(values),
+        XnorGate: lambda values: sum(values) % 2 == 0,
+    }
+    for gate_class, function in functions.items():
+        circuit = Circuit()
+        gate = gate_class(gate_class.__name__, circuit, 3)
+        for values in itertools.product((False, True), repeat=3):
+            for input_, value in zip(gate.inputs, values):
+                input_.value = value
+            assert gate.output.value is function(values)
+        # The packed and plane kernels agree with evaluate, X included
+        combinations = list(itertools.product((False, True, X), repeat=3))
+        expected = [gate_class.evaluate_ternary(*values)
+                    for values in combinations]
+        planes = gate_class.evaluate_planes(
+            *[pack_planes(column) for column in zip(*combinations)])
+        assert unpack_planes(planes, len(combinations)) == expected
+        print(f"{gate}, cost {gate.cost}")
+    # A 32-input AND against the tree of 31 AndGates it replaces
+    circuit = Circuit()
+    wide = NaryAndGate("and32", circuit, 32)
+    tree = Circuit()
+    level = [AndGate(f"and{i}", tree) for i in range(16)]
+    while len(level) > 1:
+        following = []
+        for a, b in zip(level[::2], level[1::2]):
+            gate = AndGate(f"and{len(tree)}", tree)
+            a.output.connect(gate.input0)
+            b.output.connect(gate.input1)
+            following.append(gate)
+        level = following
+    print(f"32-input AND: 1 gate, cost {circuit.cost}, depth "
+          f"{circuit.depth}; as a tree: {len(tree)} gates, cost "
+          f"{tree.cost}, depth {tree.depth}")
+    assert circuit.cost < tree.cost
+    random.seed(20)
+    for _ in range(20):
+        values = [random.random() < 0.95 for _ in range(32)]
+        assert (circuit.compile().run(values) == tree.compile().run(values)
+                == [all(values)])
+        for input_, value in zip(wide.inputs, values):
+            input_.value = value
+        assert wide.output.value is all(values)
+    assert circuit.to_function()(*[True] * 32) == (True,)
+    # make_gate picks the plain class when the fan-in fits it
+    assert type(make_gate(OP_AND, "and", circuit, 2)) is AndGate
+    assert type(make_gate(OP_AND, "and", circuit, 5)) is NaryAndGate
+    assert type(make_gate(OP_NAND, "nand", circuit, 2)) is NandGate
+
+
+def test_lut_gate():
+    import itertools
+
+    # A multiplexer: input 2 selects input 1 (when set) or input 0
+    table = sum(1 << index for index in range(8)
+                if (index >> ((index >> 2) & 1)) & 1)
+    circuit = Circuit()
+    mux = LutGate("mux", circuit, 3, table)
+    for values in itertools.product((False, True), repeat=3):
+        for input_, value in zip(mux.inputs, values):
+            input_.value = value
+        assert mux.output.value is (values[1] if values[2] else values[0])
+    print(mux)
+    # X is resolved exactly: equal data inputs decide an unknown select
+    assert mux.evaluate_ternary(True, True, X) is True
+    assert mux.evaluate_ternary(True, False, X) is X
+    combinations = list(itertools.product((False, True, X), repeat=3))
+    expected = [mux.evaluate_ternary(*values) for values in combinations]
+    ones, zeros = mux.evaluate_planes(
+        *[pack_planes(column) for column in zip(*combinations)])
+    mask = (1 << len(combinations)) - 1
+    assert unpack_planes((ones & mask, zeros & mask),
+                         len(combinations)) == expected
+    known = [values for values in combinations if X not in values]
+    packed = mux.evaluate_packed(
+        (1 << len(known)) - 1, *[pack(column) for column in zip(*known)])
+    assert unpack(packed, len(known)) == [mux.evaluate_ternary(*values)
+                                          for values in known]
+    # The compiled forms agree, and a constant table needs no inputs set
+    assert circuit.compile().run([True, False, True]) == [False]
+    assert circuit.to_function()(True, False, False) == (True,)
+    constant = LutGate("one", circuit, 2, 0b1111)
+    assert constant.evaluate_ternary(X, X) is True
+    for table, fan_in in ((16, 2), (-1, 2)):
+        try:
+            LutGate("bad", circuit, fan_in, table)
+        except ValueError as error:
+            print(f"LutGate({fan_in}, {table}): {error}")
+        else:
+            raise AssertionError("LutGate accepted a bad table")
+
+
+def test_flip_flops():
+    for mode in (Circuit.IMMEDIATE, Circuit.SCHEDULED, Circuit.LAZY):
+        circuit = Circuit(mode)
+        # A 3-stage shift register fed from port "data", and a flip-flop
+        # that toggles through a NOT gate
+        shift = Register("shift", circuit, 3)
+        circuit.add_input_port("data", shift.d[0])
+        for q, d in zip(shift.q, shift.d[1:]):
+            q.connect(d)
+        toggle = DFlipFlop("toggle", circuit, init=True)
+        inverter = NotGate("not", circuit)
+        toggle.q.connect(inverter.input)
+        inverter.output.connect(toggle.d)
+        assert not circuit.loops() and len(circuit) == 1
+        values = []
+        for bit in (1, 0, 1, 1):
+            circuit.set_inputs({"data": bit})
+            circuit.clock()
+            values.append((shift.value, toggle.q.value, inverter.output.value))
+        assert values == [(1, False, True), (2, True, False), (5, False, True),
+                          (11 & 7, True, False)]
+        circuit.reset()
+        assert shift.value == 0 and toggle.q.value is True
+    print(shift, toggle, sep="\n")
+    assert circuit.cost_report()["by_type"]["DFlipFlop"] == {"gates": 4,
+                                                             "cost": 360}
+    try:
+        DFlipFlop("toggle", circuit)
+    except ValueError as error:
+        print(f"Caught: {error}")
+    else:
+        raise AssertionError("A duplicate flip-flop name was accepted")
+
+
+def build_full_adder(circuit):
+    """ Wire a 1-bit full adder into circuit without setting any value
+
+    Returns ((a_inputs, b_inputs, ci_inputs), (sum_output, co_output)),
+    where each *_inputs tuple holds every gate input fed by that operand.
+    """
+    xor1 = XorGate("xor1", circuit)
+    xor2 = XorGate("xor2", circuit)
+    and1 = AndGate("and1", circuit)
+    and2 = AndGate("and2", circuit)
+    or_gate = OrGate("or", circuit)
+    xor1.output.connect(xor2.input0)
+    xor1.output.connect(and1.input0)
+    and1.output.connect(or_gate.input0)
+    and2.output.connect(or_gate.input1)
+    return (((xor1.input0, and2.input0), (xor1.input1, and2.input1),
+             (xor2.input1, and1.input1)), (xor2.output, or_gate.output))
+
+
+def build_ripple_adder(circuit, bits):
+    """ Wire a bits-wide ripple carry adder from full adders into circuit
+
+    Returns (a_ports, b_ports, ci_inputs, sum_outputs, co_output) where
+    a_ports[i] and b_ports[i] are the input tuples of operand bit i.
+    """
+    a_ports, b_ports, sums = [], [], []
+    carry = ci_inputs = None
+    for _ in range(bits):
+        (a_in, b_in, ci_in), (sum_out, co_out) = build_full_adder(circuit)
+        if carry is None:
+            ci_inputs = ci_in
+        else:
+            for input_ in ci_in:
+                carry.connect(input_)
+        a_ports.append(a_in)
+        b_ports.append(b_in)
+        sums.append(sum_out)
+        carry = co_out
+    return a_ports, b_ports, ci_inputs, sums, carry
+
+
+def build_counter(circuit, bits, name="count"):
+    """ Wire a bits-wide counter into circuit: a Register and an incrementer
+
+    The register (named name) adds the carry-in of a ripple carry adder
+    on every clock, wrapping around.  Returns (register, ci_inputs): tie
+    the carry-in to True to count every cycle, or make it an enable port.
+    """
+    register = Register(name, circuit, bits)
+    a_ports, b_ports, ci_inputs, sums, _ = build_ripple_adder(circuit, bits)
+    for q, d, a_inputs, b_inputs, sum_output in zip(
+            register.q, register.d, a_ports, b_ports, sums):
+        for input_ in a_inputs:
+            q.connect(input_)
+        for input_ in b_inputs:
+            input_.value = False
+        sum_output.connect(d)
+    return register, ci_inputs
+
+
+def build_array_multiplier(circuit, bits):
+    """ Wire a bits x bits array multiplier into circuit
+
+    Partial products are AND gates, added row by row with ripple carry
+    full adders; the adder inputs with nothing to add are set to False.
+    Returns (a_ports, b_ports, products): the input tuples of each operand
+    bit, and the product bit Outputs, least significant first (2 * bits
+    of them, or 1 for bits=1).
+    """
+    a_ports = [[] for _ in range(bits)]
+    b_ports = [[] for _ in range(bits)]
+
+    def partial_product(i, j):
+        gate = AndGate(f"pp{i}_{j}", circuit)
+        a_ports[j].append(gate.input0)
+        b_ports[i].append(gate.input1)
+        return gate.output
+
+    def add(*signals):
+        inputs, (sum_output, co_output) = build_full_adder(circuit)
+        for signal, pins in zip(signals, inputs):
+            for input_ in pins:
+                if signal is None:
+                    input_.value = False
+                else:
+                    signal.connect(input_)
+        return sum_output, co_output
+
+    # Row 0, then each row added to the running sum, whose lowest bit is
+    # final every time
+    row = [partial_product(0, j) for j in range(bits)]
+    products = [row.pop(0)]
+    for i in range(1, bits):
+        carry = None
+        total = []
+        for j in range(bits):
+            sum_output, carry = add(partial_product(i, j),
+                                    row[j] if j < len(row) else None, carry)
+            total.append(sum_output)
+        total.append(carry)
+        products.append(total.pop(0))
+        row = total
+    products += row
+    return ([tuple(port) for port in a_ports],
+            [tuple(port) for port in b_ports], products)
+
+
+def build_random_logic(circuit, inputs, gates, seed=0):
+    """ Wire gates random AND, OR, XOR and NOT gates into circuit
+
+    Each gate reads primary inputs or one of the 64 gates before it, so the
+    logic is deep as well as wide.  Declares input ports x0, x1, ... and
+    an output port y0, y1, ... for every gate output left unconnected.
+    """
+    import random
+
+    rng = random.Random(seed)
+    kinds = (AndGate, OrGate, XorGate, AndGate, OrGate, NotGate)
+    ports = [[] for _ in range(inputs)]
+    outputs = []
+    for index in range(gates):
+        gate = rng.choice(kinds)(f"g{index}", circuit)
+        for input_ in gate.inputs:
+            choice = rng.randrange(inputs + min(len(outputs), 64))
+            if choice < inputs:
+                ports[choice].append(input_)
+            else:
+                outputs[inputs - choice - 1].connect(input_)
+        outputs.append(gate.output)
+    for index, port in enumerate(ports):
+        if port:
+            circuit.add_input_port(f"x{index}", *port)
+    for output in outputs:
+        if not output.connections:
+            circuit.add_output_port(f"y{len(circuit.output_ports())}",
+                                    output)
+
+
 def full_adder(a, b, ci):
     """ Function that builds the 1-bit full adder circuit """
 
@@ -0,0 +1,1040 @@
+"""
+SAT-based reasoning about logic gate circuits (see logic_gate_part2.py)
+
+Solver is a conflict-driven clause learning (CDCL) SAT solver:
+
+- two watched literals per clause, so propagation only visits the clauses
+  whose watch became false;
+- on a conflict, the first unique implication point (1UIP) clause is
+  learned, with its literals implied by the others removed, and the
+  search jumps back to the level where it becomes unit;
+- decisions follow VSIDS: variables in recent conflicts gain activity,
+  which decays geometrically, and keep their last value (phase saving);
+- the search restarts on the Luby sequence, and the least active half of
+  the learned clauses is dropped as they pile up.
+
+encode() turns a Circuit into clauses with the Tseitin encoding: one
+variable per gate output, with clauses that hold exactly when the output
+has the value its gate computes.  Gates with the same type and inputs
+share a variable, and NOT gates are negated literals; a LUT gets a clause
+per cube of irredundant covers of its ones and zeros, not one per row.
+The clauses of a gate reach the solver only when a question needs them.
+A miter of two circuits (the OR of the XORs of their matching outputs) is
+satisfiable exactly when they differ, which is how check_equivalence()
+works; BDDs (see logic_gate_bdd.py) are faster when they stay small, but
+blow up on multipliers.
+"""
+
+import heapq
+import random
+
+from logic_gate_part2 import (Input, OP_AND, OP_LUT, OP_NAND, OP_NOR, OP_NOT,
+                              OP_OR, OP_XNOR, OP_XOR, Output, X, lut_packed)
+
+# Conflicts in the first restart interval; later ones follow the Luby
+# sequence 1, 1, 2, 1, 1, 2, 4, ... times this
+RESTART_INTERVAL = 100
+
+# Activity decay per conflict, for variables and for learned clauses
+VARIABLE_DECAY = 0.95
+CLAUSE_DECAY = 0.999
+
+# Learned clauses kept before the first reduction, and the growth of that
+# limit after each one
+LEARNED_LIMIT = 2000
+LEARNED_GROWTH = 1.1
+
+# Random vectors Encoding.sweep simulates, and the conflicts each of its
+# proofs may take
+SWEEP_VECTORS = 256
+SWEEP_CONFLICTS = 1000
+
+
+class Solver:
+    """A CDCL SAT solver.
+
+    Variables are numbered from 1 by new_var(), and literals are DIMACS
+    style: v for variable v, -v for its negation.
+    """
+
+    def __init__(self):
+        # Internally literal v is 2 * v and -v is 2 * v + 1; per internal
+        # literal, 1 (true), -1 (false) or 0 (unassigned)
+        self._values = [0, 0]
+        self._watches = [[], []]
+        # Per variable
+        self._levels = [0]
+        self._reasons = [None]
+        self._activity = [0.0]
+        self._phases = [1]
+        self._heap = []
+        self._increment = 1.0
+        # Clauses by index; deleted learned clauses become None
+        self._clauses = []
+        self._learned = {}
+        self._clause_increment = 1.0
+        self._trail = []
+        self._trail_limits = []
+        self._queue_head = 0
+        self._inconsistent = False
+        self._learned_limit = LEARNED_LIMIT
+        self.conflicts = 0
+        self.decisions = 0
+        self.propagations = 0
+
+    @property
+    def variables(self):
+        return len(self._levels) - 1
+
+    def new_var(self):
+        """Add a variable; return its number"""
+        variable = len(self._levels)
+        self._values += (0, 0)
+        self._watches += ([], [])
+        self._levels.append(0)
+        self._reasons.append(None)
+        self._activity.append(0.0)
+        self._phases.append(1)
+        heapq.heappush(self._heap, (0.0, variable))
+        return variable
+
+    def add_clause(self, literals):
+        """Add the clause: the OR of literals
+
+        Returns False if the clauses can no longer be satisfied.
+        """
+        if self._trail_limits:
+            self._backtrack(0)
+        clause = []
+        for literal in literals:
+            internal = 2 * literal if literal > 0 else -2 * literal + 1
+            if internal >> 1 >= len(self._levels) or literal == 0:
+                raise ValueError(f"No variable {abs(literal)}")
+            value = self._values[internal]
+            if value == 1 or internal ^ 1 in clause:
+                # Already satisfied, or always true
+                return True
+            if value == 0 and internal not in clause:
+                clause.append(internal)
+        if not clause:
+            self._inconsistent = True
+        elif len(clause) == 1:
+            self._assign(clause[0], None)
+            if self._propagate() is not None:
+                self._inconsistent = True
+        else:
+            self._attach(clause)
+        return not self._inconsistent
+
+    def _attach(self, clause):
+        index = len(self._clauses)
+        self._clauses.append(clause)
+        self._watches[clause[0]].append(index)
+        self._watches[clause[1]].append(index)
+        return index
+
+    def _assign(self, literal, reason):
+        self._values[literal] = 1
+        self._values[literal ^ 1] = -1
+        variable = literal >> 1
+        self._levels[variable] = len(self._trail_limits)
+        self._reasons[variable] = reason
+        self._trail.append(literal)
+
+    def _propagate(self):
+        # Assign what the trail implies; return a conflicting clause index,
+        # or None
+        values = self._values
+        clauses = self._clauses
+        watches = self._watches
+        trail = self._trail
+        levels = self._levels
+        reasons = self._reasons
+        level = len(self._trail_limits)
+        head = self._queue_head
+        conflict = None
+        while head < len(trail) and conflict is None:
+            false = trail[head] ^ 1
+            head += 1
+            watchers = watches[false]
+            kept = 0
+            count = len(watchers)
+            position = 0
+            while position < count:
+                index = watchers[position]
+                position += 1
+                clause = clauses[index]
+                if clause is None:
+                    continue
+                # Keep the false watch second
+                if clause[0] == false:
+                    clause[0] = clause[1]
+                    clause[1] = false
+                first = clause[0]
+                if values[first] == 1:
+                    watchers[kept] = index
+                    kept += 1
+                    continue
+                for other in range(2, len(clause)):
+                    literal = clause[other]
+                    if values[literal] != -1:
+                        clause[1] = literal
+                        clause[other] = false
+                        watches[literal].append(index)
+                        break
+                else:
+                    watchers[kept] = index
+                    kept += 1
+                    if values[first] == -1:
+                        conflict = index
+                        while position < count:
+                            watchers[kept] = watchers[position]
+                            kept += 1
+                            position += 1
+                    else:
+                        values[first] = 1
+                        values[first ^ 1] = -1
+                        levels[first >> 1] = level
+                        reasons[first >> 1] = index
+                        trail.append(first)
+                        self.propagations += 1
+            del watchers[kept:]
+        self._queue_head = head
+        return conflict
+
+    def _analyze(self, conflict):
+        # The 1UIP learned clause (asserting literal first, then one of the
+        # highest level among the rest) and the level to jump back to
+        levels = self._levels
+        reasons = self._reasons
+        trail = self._trail
+        level = len(self._trail_limits)
+        seen = set()
+        learned = [None]
+        pending = 0
+        literal = None
+        position = len(trail) - 1
+        index = conflict
+        while True:
+            self._bump_clause(index)
+            for other in self._clauses[index]:
+                variable = other >> 1
+                if other == literal or variable in seen:
+                    continue
+                if levels[variable] > 0:
+                    seen.add(variable)
+                    self._bump(variable)
+                    if levels[variable] == level:
+                        pending += 1
+                    else:
+                        learned.append(other)
+            while trail[position] >> 1 not in seen:
+                position -= 1
+            literal = trail[position]
+            position -= 1
+            pending -= 1
+            if not pending:
+                break
+            # Resolved away: only the learned clause's variables stay seen
+            seen.discard(literal >> 1)
+            index = reasons[literal >> 1]
+        learned[0] = literal ^ 1
+        # Drop the literals whose reasons only hold literals already here
+        kept = [learned[0]]
+        for other in learned[1:]:
+            reason = reasons[other >> 1]
+            if reason is None or any(
+                    (inner >> 1) not in seen and levels[inner >> 1] > 0
+                    for inner in self._clauses[reason] if inner != other ^ 1):
+                kept.append(other)
+        learned = kept
+        if len(learned) == 1:
+            return learned, 0
+        highest = max(range(1, len(learned)),
+                      key=lambda i: levels[learned[i] >> 1])
+        learned[1], learned[highest] = learned[highest], learned[1]
+        return learned, levels[learned[1] >> 1]
+
+    def _bump(self, variable):
+        activity = self._activity
+        activity[variable] += self._increment
+        if activity[variable] > 1e100:
+            for other in range(1, len(activity)):
+                activity[other] *= 1e-100
+            self._increment *= 1e-100
+            self._heap = [(-activity[other], other)
+                          for other in range(1, len(activity))
+                          if not self._values[2 * other]]
+            heapq.heapify(self._heap)
+        elif not self._values[2 * variable]:
+            heapq.heappush(self._heap, (-activity[variable], variable))
+
+    def _bump_clause(self, index):
+        if index in self._learned:
+            self._learned[index] += self._clause_increment
+            if self._learned[index] > 1e20:
+                for other in self._learned:
+                    self._learned[other] *= 1e-20
+                self._clause_increment *= 1e-20
+
+    def _backtrack(self, level):
+        if len(self._trail_limits) <= level:
+            return
+        values = self._values
+        activity = self._activity
+        heap = self._heap
+        start = self._trail_limits[level]
+        for literal in self._trail[start:]:
+            variable = literal >> 1
+            values[literal] = values[literal ^ 1] = 0
+            self._reasons[variable] = None
+            self._phases[variable] = literal & 1
+            heapq.heappush(heap, (-activity[variable], variable))
+        del self._trail[start:]
+        del self._trail_limits[level:]
+        self._queue_head = start
+        if len(heap) > 4 * len(activity):
+            self._heap = [(-activity[variable], variable)
+                          for variable in range(1, len(activity))
+                          if not values[2 * variable]]
+            heapq.heapify(self._heap)
+
+    def _decide(self):
+        # The unassigned variable with the highest activity, as a literal
+        # with its saved phase; None if all are assigned
+        heap = self._heap
+        values = self._values
+        while heap:
+            _, variable = heapq.heappop(heap)
+            if not values[2 * variable]:
+                return 2 * variable + self._phases[variable]
+        return None
+
+    def _reduce(self):
+        # Drop the less active half of the learned clauses, except binary
+        # ones and the reasons of current assignments
+        locked = {self._reasons[literal >> 1] for literal in self._trail}
+        candidates = sorted((activity, index)
+                            for index, activity in self._learned.items()
+                            if index not in locked
+                            and len(self._clauses[index]) > 2)
+        for _, index in candidates[:len(candidates) // 2]:
+            self._clauses[index] = None
+            del self._learned[index]
+
+    def solve(self, assumptions=(), max_conflicts=None):
+        """Return True if the clauses can all be satisfied, False if not
+
+        assumptions are literals that must hold for this call only.  With
+        max_conflicts, returns None after that many conflicts without an
+        answer.  After True, value() and model() give the assignment.
+        """
+        if self._inconsistent:
+            return False
+        self._backtrack(0)
+        if self._propagate() is not None:
+            self._inconsistent = True
+            return False
+        assumed = [2 * literal if literal > 0 else -2 * literal + 1
+                   for literal in assumptions]
+        conflicts = 0
+        restart = 1
+        limit = RESTART_INTERVAL * _luby(restart)
+        since_restart = 0
+        while True:
+            conflict = self._propagate()
+            if conflict is not None:
+                self.conflicts += 1
+                conflicts += 1
+                since_restart += 1
+                if not self._trail_limits:
+                    self._inconsistent = True
+                    return False
+                learned, level = self._analyze(conflict)
+                self._backtrack(level)
+                if len(learned) == 1:
+                    self._assign(learned[0], None)
+                else:
+                    index = self._attach(learned)
+                    self._learned[index] = self._clause_increment
+                    self._assign(learned[0], index)
+                self._increment /= VARIABLE_DECAY
+                self._clause_increment /= CLAUSE_DECAY
+                if max_conflicts is not None and conflicts >= max_conflicts:
+                    self._backtrack(0)
+                    return None
+                continue
+            if since_restart >= limit:
+                restart += 1
+                limit = RESTART_INTERVAL * _luby(restart)
+                since_restart = 0
+                self._backtrack(0)
+                continue
+            if len(self._learned) > self._learned_limit:
+                self._reduce()
+                self._learned_limit *= LEARNED_GROWTH
+            # Assumptions first, one level each
+            level = len(self._trail_limits)
+            if level < len(assumed):
+                literal = assumed[level]
+                if self._values[literal] == -1:
+                    self._backtrack(0)
+                    return False
+                self._trail_limits.append(len(self._trail))
+                if not self._values[literal]:
+                    self._assign(literal, None)
+                continue
+            literal = self._decide()
+            if literal is None:
+                return True
+            self.decisions += 1
+            self._trail_limits.append(len(self._trail))
+            self._assign(literal, None)
+
+    def value(self, literal):
+        """The value of literal in the last solution, or None"""
+        internal = 2 * literal if literal > 0 else -2 * literal + 1
+        value = self._values[internal]
+        return None if not value else value == 1
+
+    def model(self):
+        """Return {variable: value} for the last solution"""
+        return {variable: self._values[2 * variable] == 1
+                for variable in range(1, len(self._levels))}
+
+
+def _cover(lower, upper, count):
+    # An irredundant sum of products (Minato-Morreale) of a function of
+    # count inputs that is 1 on the rows of truth table lower and 0 off
+    # those of upper; each cube is a list of (input, value)
+    if not lower:
+        return []
+    half = 1 << (count - 1) if count else 0
+    if upper == (1 << (1 << count)) - 1:
+        return [[]]
+    low = (1 << half) - 1
+    lower0, lower1 = lower & low, lower >> half
+    upper0, upper1 = upper & low, upper >> half
+    if lower0 == lower1 and upper0 == upper1:
+        # Input count - 1 does not matter
+        return _cover(lower0, upper0, count - 1)
+    cubes0 = _cover(lower0 & ~upper1, upper0, count - 1)
+    cubes1 = _cover(lower1 & ~upper0, upper1, count - 1)
+    covered0 = _rows(cubes0, count - 1)
+    covered1 = _rows(cubes1, count - 1)
+    rest = _cover((lower0 & ~covered0) | (lower1 & ~covered1),
+                  upper0 & upper1, count - 1)
+    return ([cube + [(count - 1, 0)] for cube in cubes0]
+            + [cube + [(count - 1, 1)] for cube in cubes1] + rest)
+
+
+def _rows(cubes, count):
+    # The truth table of the OR of cubes
+    full = (1 << (1 << count)) - 1
+    table = 0
+    for cube in cubes:
+        rows = full
+        for i, bit in cube:
+            # The rows where input i is 1: blocks of 2**i ones and zeros
+            ones = full // ((1 << (2 << i)) - 1) * (((1 << (1 << i)) - 1)
+                                                    << (1 << i))
+            rows &= ones if bit else full ^ ones
+        table |= rows
+    return table
+
+
+def _luby(index):
+    # The index-th term (from 1) of the Luby sequence 1, 1, 2, 1, 1, 2, 4
+    position = index - 1
+    size, power = 1, 0
+    while size < position + 1:
+        size = 2 * size + 1
+        power += 1
+    while size - 1 != position:
+        size //= 2
+        power -= 1
+        position %= size
+    return 1 << power
+
+
+class Encoding:
+    """Clauses for circuits, for a Solver (a new one by default)
+
+    Signals are shared by name between the circuits encoded: input ports
+    by port name, other inputs without a value by the Input (see
+    logic_gate_bdd.circuit_bdds).  A gate's clauses only go to the solver
+    once load() asks for a literal that depends on it, so the solver only
+    sees the logic a question is about.
+    """
+
+    def __init__(self, solver=None):
+        self.solver = Solver() if solver is None else solver
+        # Signal name -> literal
+        self.inputs = {}
+        # Structural hash: (kind, input literals) -> literal
+        self._gates = {}
+        # (variable, kind, input literals, table) per gate, in order
+        self._definitions = []
+        # Variable -> (input literals, clauses) of the gates not loaded
+        self._pending = {}
+        self._true = None
+
+    def true(self):
+        """The literal that is always true"""
+        if self._true is None:
+            self._true = self.solver.new_var()
+            self.solver.add_clause([self._true])
+        return self._true
+
+    def input(self, name):
+        """The literal of signal name"""
+        literal = self.inputs.get(name)
+        if literal is None:
+            literal = self.inputs[name] = self.solver.new_var()
+        return literal
+
+    def encode(self, circuit):
+        """Encode circuit; return {output port name: literal}"""
+        circuit._require_acyclic("SAT encoding")
+        literals = {}
+        for gate, signals in circuit._signals().items():
+            inputs = []
+            for signal in signals:
+                if isinstance(signal, Output):
+                    inputs.append(literals[signal])
+                elif (isinstance(signal, Input) and signal.driver is None
+                      and signal.value is not X):
+                    inputs.append(self.true() if signal.value
+                                  else -self.true())
+                else:
+                    inputs.append(self.input(signal))
+            literals[gate.output] = self.gate(
+                gate.OPCODE, inputs,
+                gate.table if gate.OPCODE == OP_LUT else None)
+        return {name: literals[output]
+                for name, output in circuit.output_ports().items()}
+
+    def gate(self, opcode, inputs, table=None):
+        """The literal of a gate of type opcode reading literals inputs"""
+        if opcode == OP_NOT:
+            return -inputs[0]
+        if opcode in (OP_AND, OP_NAND):
+            literal = self.and_(inputs)
+        elif opcode in (OP_OR, OP_NOR):
+            literal = -self.and_([-input_ for input_ in inputs])
+        elif opcode in (OP_XOR, OP_XNOR):
+            literal = inputs[0]
+            for other in inputs[1:]:
+                literal = self.xor(literal, other)
+        else:
+            return self.lut(table, inputs)
+        return -literal if opcode in (OP_NAND, OP_NOR, OP_XNOR) else literal
+
+    def and_(self, inputs):
+        true = self._true
+        literals = set()
+        for literal in inputs:
+            if true is not None and literal == -true or -literal in literals:
+                return -self.true()
+            if true is None or literal != true:
+                literals.add(literal)
+        if not literals:
+            return self.true()
+        if len(literals) == 1:
+            return literals.pop()
+        key = (OP_AND, tuple(sorted(literals)))
+        output = self._gates.get(key)
+        if output is None:
+            output = self._define(key, OP_AND)
+            clauses = [[-output, literal] for literal in literals]
+            clauses.append([output] + [-literal for literal in literals])
+            self._pending[output] = (key[1], clauses)
+        return output
+
+    def xor(self, a, b):
+        # Complements and constants come out as a negated result
+        negated = (a < 0) != (b < 0)
+        a, b = sorted((abs(a), abs(b)))
+        if a == b:
+            return self.true() if negated else -self.true()
+        if self._true is not None and self._true in (a, b):
+            other = b if a == self._true else a
+            return other if negated else -other
+        key = (OP_XOR, (a, b))
+        output = self._gates.get(key)
+        if output is None:
+            output = self._define(key, OP_XOR)
+            self._pending[output] = ((a, b), [
+                [-output, a, b], [-output, -a, -b], [output, -a, b],
+                [output, a, -b]])
+        return -output if negated else output
+
+    def lut(self, table, inputs):
+        count = len(inputs)
+        if table == 0:
+            return -self.true()
+        if table == (1 << (1 << count)) - 1:
+            return self.true()
+        key = (OP_LUT, tuple(inputs), table)
+        output = self._gates.get(key)
+        if output is None:
+            output = self._define(key, OP_LUT, table)
+            # One clause per cube of covers of the rows giving 1 and of
+            # those giving 0: those inputs imply that output
+            full = (1 << (1 << count)) - 1
+            clauses = []
+            for rows, literal in ((table, output), (full ^ table, -output)):
+                for cube in _cover(rows, rows, count):
+                    clauses.append([-inputs[i] if bit else inputs[i]
+                                    for i, bit in cube] + [literal])
+            self._pending[output] = (key[1], clauses)
+        return output
+
+    def _define(self, key, kind, table=None):
+        # A new variable for the gate hashed as key
+        output = self._gates[key] = self.solver.new_var()
+        self._definitions.append((output, kind, key[1], table))
+        return output
+
+    def load(self, literals):
+        """Give the solver the clauses of every gate literals depend on"""
+        pending = [abs(literal) for literal in literals]
+        while pending:
+            entry = self._pending.pop(pending.pop(), None)
+            if entry is not None:
+                inputs, clauses = entry
+                for clause in clauses:
+                    self.solver.add_clause(clause)
+                pending += (abs(literal) for literal in inputs)
+
+    def differ(self, outputs, other_outputs):
+        """Add clauses that hold when any matching outputs differ"""
+        differences = [self.xor(outputs[name], other_outputs[name])
+                       for name in outputs]
+        self.load(differences)
+        self.solver.add_clause(differences)
+
+    def simulate(self, values, mask):
+        """Return the packed value of every variable, as a list
+
+        values holds the packed values of the input variables; mask has
+        one bit set per vector.
+        """
+        simulated = [0] * (self.solver.variables + 1)
+        for variable, value in values.items():
+            simulated[variable] = value
+        if self._true is not None:
+            simulated[self._true] = mask
+
+        def fetch(literal):
+            value = simulated[abs(literal)]
+            return value if literal > 0 else value ^ mask
+
+        for output, kind, inputs, table in self._definitions:
+            if kind == OP_AND:
+                value = mask
+                for literal in inputs:
+                    value &= fetch(literal)
+            elif kind == OP_XOR:
+                value = fetch(inputs[0]) ^ fetch(inputs[1])
+            else:
+                value = lut_packed(table, mask, [fetch(literal)
+                                                 for literal in inputs])
+            simulated[output] = value
+        return simulated
+
+    def sweep(self, vectors=SWEEP_VECTORS, max_conflicts=SWEEP_CONFLICTS,
+              seed=0):
+        """Merge the gates that compute the same function, up to a negation
+
+        Random simulation sorts the gates into classes of candidates by
+        their packed values.  The gates are then encoded again, in order,
+        into a new solver, with every gate proven equal to the first of
+        its class (by two SAT calls) replaced by it, so the gates that read
+        them hash together.  A solution that tells two candidates apart is
+        simulated as one more vector, splitting the classes; a proof that
+        needs more than max_conflicts conflicts is given up.  Returns
+        {old variable: new literal}.
+        """
+        rng = random.Random(seed)
+        mask = (1 << vectors) - 1
+        old_true = self.true()
+        old_inputs = self.inputs
+        definitions = self._definitions
+        simulated = self.simulate(
+            {literal: rng.getrandbits(vectors)
+             for literal in old_inputs.values()}, mask)
+        # Start again with a new solver
+        self.solver = Solver()
+        self.inputs = {}
+        self._gates = {}
+        self._definitions = []
+        self._pending = {}
+        self._true = None
+        mapped = {old_true: self.true()}
+        for name, literal in old_inputs.items():
+            mapped[literal] = self.input(name)
+
+        def normalized(variable, literal):
+            # The class of variable and literal negated to match it; every
+            # class is 0 on the first vector
+            value = simulated[variable]
+            if value & 1:
+                return value ^ mask, -literal
+            return value, literal
+
+        candidates = {}
+        for variable in [old_true] + list(old_inputs.values()):
+            signature, literal = normalized(variable, mapped[variable])
+            candidates.setdefault(signature, literal)
+        done = []
+        for output, kind, inputs, table in definitions:
+            inputs = [mapped[literal] if literal > 0 else -mapped[-literal]
+                      for literal in inputs]
+            if kind == OP_AND:
+                literal = self.and_(inputs)
+            elif kind == OP_XOR:
+                literal = self.xor(*inputs)
+            else:
+                literal = self.lut(table, inputs)
+            mapped[output] = literal
+            done.append(output)
+            signature, target = normalized(output, literal)
+            other = candidates.setdefault(signature, target)
+            if other == target:
+                continue
+            proven = True
+            self.load([target, other])
+            for assumptions in ([target, -other], [-target, other]):
+                result = self.solver.solve(assumptions, max_conflicts)
+                if result is not False:
+                    proven = result
+                    break
+            if proven is True:
+                mapped[output] = other if target == literal else -other
+                continue
+            if proven is None:
+                continue
+            # Simulate the solution as one more vector on top
+            values = {variable: int(bool(self.solver.value(
+                mapped[variable]))) for variable in old_inputs.values()}
+            values[old_true] = 1
+            extra = self._replay(definitions, values)
+            bit = 1 << vectors
+            vectors += 1
+            mask |= bit
+            for variable, value in extra.items():
+                if value:
+                    simulated[variable] |= bit
+            candidates = {}
+            for variable in [old_true] + list(old_inputs.values()) + done:
+                candidate = mapped[variable]
+                signature, candidate = normalized(variable, candidate)
+                candidates.setdefault(signature, candidate)
+        return mapped
+
+    @staticmethod
+    def _replay(definitions, values):
+        # Simulate definitions on one vector of values of the inputs and
+        # the true variable; return the value of every variable
+        values = dict(values)
+
+        def fetch(literal):
+            return values[literal] if literal > 0 else 1 - values[-literal]
+
+        for output, kind, inputs, table in definitions:
+            if kind == OP_AND:
+                value = int(all(fetch(literal) for literal in inputs))
+            elif kind == OP_XOR:
+                value = fetch(inputs[0]) ^ fetch(inputs[1])
+            else:
+                index = sum(fetch(literal) << i
+                            for i, literal in enumerate(inputs))
+                value = (table >> index) & 1
+            values[output] = value
+        return values
+
+    def assignment(self):
+        """The input signal values of the last solution"""
+        return {name: bool(self.solver.value(literal))
+                for name, literal in self.inputs.items()}
+
+
+def check_equivalence(circuit, other, max_conflicts=None, sweep=True):
+    """Return (equivalent, counterexample) for two circuits
+
+    Ports are matched by name, as in logic_gate_bdd.equivalent; raises
+    ValueError if the output port names differ.  counterexample is None,
+    or {input name: value} for inputs where an output differs.  With
+    sweep, equal gates inside the circuits are found and proven first (see
+    Encoding.sweep), which is what makes the final miter easy when the
+    circuits have similar structure.  With max_conflicts, equivalent is
+    None if the final solver call gave up.
+    """
+    if set(circuit.output_ports()) != set(other.output_ports()):
+        raise ValueError("The circuits have different output ports")
+    encoding = Encoding()
+    outputs = encoding.encode(circuit)
+    other_outputs = encoding.encode(other)
+    if sweep:
+        mapped = encoding.sweep()
+
+        def remap(literal):
+            return mapped[literal] if literal > 0 else -mapped[-literal]
+
+        outputs = {name: remap(literal) for name, literal in outputs.items()}
+        other_outputs = {name: remap(literal)
+                         for name, literal in other_outputs.items()}
+    if outputs == other_outputs:
+        # Hashed or proven to be the same
+        return True, None
+    encoding.differ(outputs, other_outputs)
+    result = encoding.solver.solve(max_conflicts=max_conflicts)
+    if result is None:
+        return None, None
+    if not result:
+        return True, None
+    return False, encoding.assignment()
+
+
+def find_input_producing(circuit, output=True, max_conflicts=None):
+    """Return input values that make the outputs take given values
+
+    output is a bool for a circuit with one output port, or {output port
+    name: value} for any of them.  Returns {input name: value} for the
+    input ports, the flip-flops (by name) and other inputs without a
+    value, or None if no input does (or, with max_conflicts, if the
+    solver gave up).
+    """
+    outputs = circuit.output_ports()
+    if isinstance(output, bool):
+        if len(outputs) != 1:
+            raise ValueError("Name the output ports: the circuit has "
+                             f"{len(outputs)}")
+        output = {name: output for name in outputs}
+    for name in output:
+        if name not in outputs:
+            raise ValueError(f"No output port {name!r}")
+    encoding = Encoding()
+    # Every input port gets a value, even if no output reads it
+    for name in circuit.input_ports():
+        encoding.input(name)
+    literals = encoding.encode(circuit)
+    encoding.load(literals[name] for name in output)
+    for name, value in output.items():
+        encoding.solver.add_clause([literals[name] if value
+                                    else -literals[name]])
+    if not encoding.solver.solve(max_conflicts=max_conflicts):
+        return None
+    return encoding.assignment()
+
+
+def test():
+    """Umbrella test function"""
+    tests = [
+        test_solver,
+        test_pigeonhole,
+        test_random_3sat,
+        test_lut_clauses,
+        test_find_input,
+        test_equivalence,
+        test_multiplier_miter,
+    ]
+    for t in tests:
+        print("Running " + t.__name__ + " " + "-" * 20)
+        t()
+
+
+def _satisfies(solver, clauses):
+    return all(any(solver.value(literal) for literal in clause)
+               for clause in clauses)
+
+
+def test_solver():
+    assert [_luby(i) for i in range(1, 16)] == [1, 1, 2, 1, 1, 2, 4, 1, 1,
+                                                2, 1, 1, 2, 4, 8]
+    solver = Solver()
+    a, b, c = (solver.new_var() for _ in range(3))
+    clauses = [[a, b], [-a, c], [-b, c], [-c, -a]]
+    for clause in clauses:
+        solver.add_clause(clause)
+    assert solver.solve()
+    assert _satisfies(solver, clauses)
+    assert solver.value(c) and not solver.value(a)
+    assert solver.solve(assumptions=[a]) is False
+    assert solver.solve(assumptions=[-a]) is True
+    solver.add_clause([-b])
+    assert solver.solve() is False
+    try:
+        solver.add_clause([4])
+    except ValueError as error:
+        print(error)
+    else:
+        raise AssertionError("An unknown variable was accepted")
+
+
+def test_pigeonhole():
+    # n + 1 pigeons don't fit in n holes, which takes real conflict analysis
+    holes = 6
+    solver = Solver()
+    sits = [[solver.new_var() for _ in range(holes)]
+            for _ in range(holes + 1)]
+    for pigeon in sits:
+        solver.add_clause(pigeon)
+    for hole in range(holes):
+        for first in range(holes + 1):
+            for second in range(first + 1, holes + 1):
+                solver.add_clause([-sits[first][hole], -sits[second][hole]])
+    assert solver.solve() is False
+    print(f"{holes + 1} pigeons: {solver.conflicts} conflicts, "
+          f"{solver.decisions} decisions")
+
+
+def test_random_3sat():
+    import itertools
+    import random
+
+    rng = random.Random(24)
+    results = []
+    for _ in range(40):
+        variables = 12
+        clauses = [[rng.choice((1, -1)) * rng.randint(1, variables)
+                    for _ in range(3)] for _ in range(52)]
+        solver = Solver()
+        for _ in range(variables):
+            solver.new_var()
+        for clause in clauses:
+            solver.add_clause(clause)
+        result = solver.solve()
+        # Check against brute force
+        expected = any(
+            all(any((literal > 0) == values[abs(literal) - 1]
+                    for literal in clause) for clause in clauses)
+            for values in itertools.product((False, True), repeat=variables))
+        assert result == expected
+        if result:
+            assert _satisfies(solver, clauses)
+        results.append(result)
+    print(f"{results.count(True)} satisfiable, {results.count(False)} not")
+    assert True in results and False in results
+
+
+def test_lut_clauses():
+    rng = random.Random(25)
+    for count in range(1, 7):
+        for _ in range(20):
+            table = rng.getrandbits(1 << count)
+            encoding = Encoding()
+            inputs = [encoding.input(f"i{i}") for i in range(count)]
+            output = encoding.lut(table, inputs)
+            encoding.load([output])
+            # Each row of inputs forces the output to its table bit
+            for row in range(1 << count):
+                assumptions = [literal if (row >> i) & 1 else -literal
+                               for i, literal in enumerate(inputs)]
+                assert encoding.solver.solve(assumptions)
+                assert (encoding.solver.value(output)
+                        == bool((table >> row) & 1))
+
+
+def test_find_input():
+    from logic_gate_part2 import (AndGate, Circuit, DFlipFlop, NotGate,
+                                  build_ripple_adder)
+
+    # Inputs of an 8-bit adder whose sum is 0xA5 with a carry out
+    circuit = Circuit()
+    a_ports, b_ports, ci_inputs, sums, carry = build_ripple_adder(circuit, 8)
+    for i, (a_inputs, b_inputs) in enumerate(zip(a_ports, b_ports)):
+        circuit.add_input_port(f"a{i}", *a_inputs)
+        circuit.add_input_port(f"b{i}", *b_inputs)
+    circuit.add_input_port("ci", *ci_inputs)
+    for i, output in enumerate(sums):
+        circuit.add_output_port(f"s{i}", output)
+    circuit.add_output_port("co", carry)
+    target = {f"s{i}": bool((0xA5 >> i) & 1) for i in range(8)}
+    target["co"] = True
+    values = find_input_producing(circuit, target)
+    a = sum(values[f"a{i}"] << i for i in range(8))
+    b = sum(values[f"b{i}"] << i for i in range(8))
+    print(f"{a} + {b} + {int(values['ci'])} = {0x1A5}")
+    assert a + b + values["ci"] == 0x1A5
+    # x AND NOT x is never 1
+    contradiction = Circuit()
+    gate = AndGate("and", contradiction)
+    inverter = NotGate("not", contradiction)
+    inverter.output.connect(gate.input1)
+    contradiction.add_input_port("x", gate.input0, inverter.input)
+    contradiction.add_output_port("y", gate.output)
+    assert find_input_producing(contradiction, True) is None
+    assert find_input_producing(contradiction, False) is not None
+    # ... and neither is q AND NOT q, for the Q of a flip-flop
+    contradiction = Circuit()
+    flip_flop = DFlipFlop("q", contradiction)
+    gate = AndGate("and", contradiction)
+    inverter = NotGate("not", contradiction)
+    flip_flop.q.connect(gate.input0)
+    flip_flop.q.connect(inverter.input)
+    inverter.output.connect(gate.input1)
+    contradiction.add_output_port("y", gate.output)
+    assert find_input_producing(contradiction, True) is None
+    assert "q" in find_input_producing(contradiction, False)
+
+
+def test_equivalence():
+    from logic_gate_part2 import Circuit, build_random_logic
+
+    circuit = Circuit()
+    build_random_logic(circuit, 16, 300, seed=24)
+    optimized, _ = circuit.optimize(aig=True)
+    mapped, _ = circuit.map_luts(6)
+    for other in (optimized, mapped):
+        assert check_equivalence(circuit, other) == (True, None)
+    # Cut one connection near the outputs and tie the input to 1
+    input_ = next(input_ for gate in reversed(mapped.topological_order())
+                  for input_ in gate.inputs if input_.driver is not None)
+    input_.driver.disconnect(input_)
+    input_.value = True
+    equivalent, counterexample = check_equivalence(circuit, mapped)
+    assert not equivalent
+    # The counterexample really tells them apart
+    results = []
+    for each in (circuit, mapped):
+        each.set_inputs({name: counterexample.get(name, False)
+                         for name in each.input_ports()})
+        results.append({name: output.value
+                        for name, output in each.output_ports().items()})
+    assert results[0] != results[1]
+
+
+def _multiplier(bits):
+    from logic_gate_part2 import Circuit, build_array_multiplier
+
+    circuit = Circuit()
+    a_ports, b_ports, products = build_array_multiplier(circuit, bits)
+    for i in range(bits):
+        circuit.add_input_port(f"a{i}", *a_ports[i])
+        circuit.add_input_port(f"b{i}", *b_ports[i])
+    for i, output in enumerate(products):
+        circuit.add_output_port(f"p{i}", output)
+    return circuit
+
+
+def test_multiplier_miter():
+    import time
+
+    # An array multiplier against its aig=True optimization
+    circuit = _multiplier(4)
+    aig, _ = circuit.optimize(aig=True)
+    start = time.perf_counter()
+    assert check_equivalence(circuit, aig) == (True, None)
+    print(f"4x4 multiplier miter: {time.perf_counter() - start:.2f}s")
+    # a * b = 143 = 11 * 13
+    target = {f"p{i}": bool((143 >> i) & 1) for i in range(8)}
+    values = find_input_producing(circuit, target)
+    a = sum(values[f"a{i}"] << i for i in range(4))
+    b = sum(values[f"b{i}"] << i for i in range(4))
+    assert a * b == 143 and {a, b} == {11, 13}
+
+
+if __name__ == '__main__':
+    test()
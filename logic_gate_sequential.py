@@ -0,0 +1,340 @@
+"""
+Cycle-based simulation of circuits with flip-flops (see logic_gate_part2.py)
+
+DFlipFlops hold a circuit's state.  Their Q outputs are primary inputs of
+the combinational logic and their D inputs sample it, so Circuit.clock()
+can latch them through the object model, one gate evaluation at a time.
+
+A CycleSimulator runs many cycles instead.  The combinational logic is
+compiled (see logic_gate_compiled.py) into one generated step function
+that takes the flip-flop state and the input port values and returns the
+output port values and the next state.  A cycle is then a single call:
+every gate is evaluated once, in level order, and all the flip-flops
+latch at once.  With width > 1 every value packs that many independent
+simulations, one per bit, as in CompiledCircuit.run.
+"""
+
+from logic_gate_part2 import Circuit, DFlipFlop, Register, X, lut_packed
+
+
+class CycleSimulator:
+    """Clocked simulation of a circuit, snapshotted from its structure
+
+    The state starts from the flip-flops' current Q values, and the input
+    ports from the current values of their inputs.  The circuit's own
+    signal values are left untouched.
+    """
+
+    def __init__(self, circuit, width=1):
+        if not isinstance(circuit, Circuit):
+            raise TypeError("CycleSimulator needs a Circuit to simulate")
+        if width < 1:
+            raise ValueError("width must be at least 1")
+        compiled = circuit.compile()
+        flip_flops = circuit.flip_flops()
+        ports = circuit.input_ports()
+        self._width = width
+        self._mask = True if width == 1 else (1 << width) - 1
+        self._flip_flops = flip_flops
+        self._indices = {flip_flop: index
+                         for index, flip_flop in enumerate(flip_flops)}
+        self._input_names = tuple(ports)
+        self._output_names = tuple(circuit.output_ports())
+        self._positions = {name: position
+                           for position, name in enumerate(ports)}
+        state_of = {flip_flop.q: f"q{index}"
+                    for index, flip_flop in enumerate(flip_flops)}
+        port_of = {input_: f"p{position}"
+                   for position, inputs in enumerate(ports.values())
+                   for input_ in inputs}
+
+        def source(input_):
+            # What an input reads: a flip-flop, a port, a gate output (by
+            # slot) or, from anywhere else, its current value
+            driver = input_.driver
+            if driver in state_of:
+                return state_of[driver]
+            if input_ in port_of:
+                return port_of[input_]
+            if driver is not None and driver.owner in circuit:
+                return f"s{compiled.slot(driver)}"
+            if input_.value is X:
+                raise ValueError(f"An input of {input_.owner.name} is "
+                                 f"neither driven, part of a port, nor set")
+            return self._literal(input_.value)
+
+        # The step function: the compiled inputs read the flip-flops and
+        # ports, then the gates run, then D is sampled
+        parameters = ([f"q{index}" for index in range(len(flip_flops))]
+                      + [f"p{position}" for position in range(len(ports))])
+        lines = [f"def step({''.join(name + ', ' for name in parameters)}"
+                 f"mask):"]
+        lines += [f"    s{slot} = {source(input_)}"
+                  for slot, input_ in enumerate(compiled.inputs)]
+        outputs = [f"s{compiled.slot(output)}"
+                   for output in circuit.output_ports().values()]
+        state = [source(flip_flop.d) for flip_flop in flip_flops]
+        result = "({}), ({})".format(
+            "".join(f"{name}, " for name in outputs),
+            "".join(f"{name}, " for name in state))
+        lines += compiled._source_lines("    ", width == 1, result)
+        namespace = {"lut_packed": lut_packed}
+        exec(compile("\n".join(lines) + "\n", "<cycle step>", "exec"),
+             namespace)
+        self._step = namespace["step"]
+        self._gates = len(compiled)
+        self._state = [self._normalize(flip_flop.q.value)
+                       for flip_flop in flip_flops]
+        # A port without inputs reads as False; nothing depends on it
+        self._values = [self._normalize(inputs[0].value if inputs else False)
+                        for inputs in ports.values()]
+        self._cycle = 0
+
+    def __str__(self):
+        return (f"CycleSimulator: {self._gates} gates, "
+                f"{len(self._flip_flops)} flip-flops, width={self._width}, "
+                f"cycle={self._cycle}")
+
+    def _literal(self, value):
+        if self._width == 1:
+            return str(bool(value))
+        return "mask" if value else "0"
+
+    def _normalize(self, value):
+        # A packed int for width > 1, where a bool stands for all of them
+        if value is X:
+            return X
+        if self._width == 1:
+            return bool(value)
+        if value is True or value is False:
+            return self._mask if value else 0
+        return int(value) & self._mask
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def cycle(self):
+        """The number of cycles simulated since the start or reset()"""
+        return self._cycle
+
+    @property
+    def inputs(self):
+        """The input port names"""
+        return self._input_names
+
+    @property
+    def outputs(self):
+        """The output port names, in the order run() gives their values"""
+        return self._output_names
+
+    @property
+    def state(self):
+        """Return {flip-flop name: value} for the current state"""
+        return {flip_flop.name: value
+                for flip_flop, value in zip(self._flip_flops, self._state)}
+
+    def value(self, element):
+        """The current value of a DFlipFlop, or of a Register as an int
+
+        A Register's value needs width=1; a flip-flop's is packed like
+        every other value.
+        """
+        if isinstance(element, Register):
+            if self._width != 1:
+                raise ValueError("Register values need width=1")
+            value = 0
+            for i, flip_flop in enumerate(element.flip_flops):
+                bit = self._state[self._indices[flip_flop]]
+                if bit is X:
+                    return X
+                value |= bit << i
+            return value
+        return self._state[self._indices[element]]
+
+    def run(self, cycles, stimulus=None):
+        """Simulate cycles clock cycles; return each cycle's output values
+
+        stimulus is an iterable yielding, per cycle, a dict of input port
+        name -> value (or None for no change), packed ints for width > 1
+        (a bool sets every simulation); ports keep their values
+        from one cycle to the next, and after the stimulus runs out.  Each
+        cycle evaluates the logic, records the output port values as a
+        tuple in outputs order (before the clock edge), and then latches
+        every flip-flop.
+        """
+        if X in self._state:
+            raise ValueError("Every flip-flop needs a value before the "
+                             "simulation starts")
+        step = self._step
+        state = self._state
+        values = self._values
+        positions = self._positions
+        normalize = self._normalize
+        mask = self._mask
+        stimulus = iter(() if stimulus is None else stimulus)
+        trace = []
+        append = trace.append
+        for cycle in range(cycles):
+            changes = next(stimulus, None)
+            if changes:
+                for name, value in changes.items():
+                    values[positions[name]] = normalize(value)
+            if cycle == 0 and X in values:
+                name = self._input_names[values.index(X)]
+                raise ValueError(f"Input port {name!r} has no value")
+            outputs, state = step(*state, *values, mask)
+            append(outputs)
+        self._state = list(state)
+        self._cycle += cycles
+        return trace
+
+    def checkpoint(self):
+        """Return the state, input port values and cycle as a plain dict
+
+        restore() takes it back, and it can be pickled or written as JSON
+        (at width=1).
+        """
+        return {"cycle": self._cycle, "state": self.state,
+                "inputs": dict(zip(self._input_names, self._values))}
+
+    def restore(self, checkpoint):
+        """Go back to the point where checkpoint() was called"""
+        state = checkpoint["state"]
+        if set(state) != {flip_flop.name for flip_flop in self._flip_flops}:
+            raise ValueError("The checkpoint is of different flip-flops")
+        self._state = [self._normalize(state[flip_flop.name])
+                       for flip_flop in self._flip_flops]
+        self._values = [self._normalize(checkpoint["inputs"][name])
+                        for name in self._input_names]
+        self._cycle = checkpoint["cycle"]
+
+    def reset(self):
+        """Put every flip-flop back to its initial value, at cycle 0"""
+        self._state = [self._normalize(flip_flop.init)
+                       for flip_flop in self._flip_flops]
+        self._cycle = 0
+
+
+def test():
+    """Umbrella test function"""
+    tests = [
+        test_counter,
+        test_stimulus,
+        test_packed,
+        test_checkpoint,
+    ]
+    for t in tests:
+        print("Running " + t.__name__ + " " + "-" * 20)
+        t()
+
+
+def _accumulator(bits):
+    # acc <= acc + x, with input ports x0, x1, ... and output ports y0, ...
+    # for the sum before the clock
+    from logic_gate_part2 import build_ripple_adder
+
+    circuit = Circuit()
+    register = Register("acc", circuit, bits)
+    a_ports, b_ports, ci_inputs, sums, _ = build_ripple_adder(circuit, bits)
+    for i, (q, d, a_inputs, b_inputs, sum_output) in enumerate(zip(
+            register.q, register.d, a_ports, b_ports, sums)):
+        for input_ in a_inputs:
+            q.connect(input_)
+        circuit.add_input_port(f"x{i}", *b_inputs)
+        sum_output.connect(d)
+        circuit.add_output_port(f"y{i}", sum_output)
+    for input_ in ci_inputs:
+        input_.value = False
+    return circuit, register
+
+
+def test_counter():
+    from logic_gate_part2 import build_counter
+
+    for mode in (Circuit.IMMEDIATE, Circuit.SCHEDULED, Circuit.LAZY):
+        circuit = Circuit(mode)
+        register, ci_inputs = build_counter(circuit, 4)
+        for input_ in ci_inputs:
+            input_.value = True
+        # The feedback goes through the register, so there is no loop
+        assert not circuit.loops()
+        simulator = circuit.simulator()
+        print(simulator)
+        simulator.run(21)
+        circuit.clock(21)
+        assert register.value == simulator.value(register) == 21 % 16
+        circuit.reset()
+        assert register.value == 0
+    print(f"4-bit counter after 21 cycles: {simulator.value(register)}")
+
+
+def test_stimulus():
+    circuit, register = _accumulator(8)
+    simulator = circuit.simulator()
+    addends = [3, 200, 7, 0, 100]
+    trace = simulator.run(6, ({f"x{i}": (x >> i) & 1 for i in range(8)}
+                              for x in addends))
+    total = 0
+    for x, outputs in zip(addends + [addends[-1]], trace):
+        total = (total + x) % 256
+        assert sum(bit << i for i, bit in enumerate(outputs)) == total
+    assert simulator.value(register) == total
+    assert simulator.cycle == 6
+    # The object model agrees, one clock at a time
+    for x in addends + [addends[-1]]:
+        circuit.set_inputs({f"x{i}": (x >> i) & 1 for i in range(8)})
+        circuit.clock()
+    assert register.value == total
+    print(f"Accumulated {addends}: {total}")
+
+
+def test_packed():
+    import random
+
+    from logic_gate_part2 import pack
+
+    # 64 accumulators at once, each adding its own random numbers
+    circuit, register = _accumulator(8)
+    width = 64
+    simulator = circuit.simulator(width)
+    rng = random.Random(25)
+    addends = [[rng.randrange(256) for _ in range(width)] for _ in range(10)]
+    stimulus = [{f"x{i}": pack([(x >> i) & 1 for x in row])
+                 for i in range(8)} for row in addends]
+    simulator.run(len(stimulus), stimulus)
+    for lane in range(width):
+        expected = sum(row[lane] for row in addends) % 256
+        value = sum(((simulator.value(flip_flop) >> lane) & 1) << i
+                    for i, flip_flop in enumerate(register.flip_flops))
+        assert value == expected
+
+
+def test_checkpoint():
+    import pickle
+
+    circuit, register = _accumulator(8)
+    simulator = circuit.simulator()
+    stimulus = [{f"x{i}": (cycle * 37 >> i) & 1 for i in range(8)}
+                for cycle in range(20)]
+    simulator.run(10, stimulus[:10])
+    saved = pickle.dumps(simulator.checkpoint())
+    first = simulator.run(10, stimulus[10:])
+    simulator.restore(pickle.loads(saved))
+    assert simulator.cycle == 10
+    assert simulator.run(10, stimulus[10:]) == first
+    simulator.reset()
+    assert simulator.value(register) == 0 and simulator.cycle == 0
+    # Flip-flops starting at X need a value first
+    DFlipFlop("unknown", circuit, init=X).d.value = True
+    try:
+        circuit.simulator().run(1)
+    except ValueError as error:
+        print(f"Caught: {error}")
+    else:
+        raise AssertionError("A flip-flop at X should not simulate")
+
+
+if __name__ == '__main__':
+    test()
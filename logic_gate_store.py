@@ -0,0 +1,647 @@
+"""
+Struct-of-arrays circuit store (see logic_gate_part2.py)
+
+A CircuitStore keeps a netlist in a handful of contiguous array.array
+buffers instead of one Python object per gate, input and output:
+
+    types          node type per node (INPUT or a gate OP_* code)
+    fanin_starts   CSR offsets into fanin, one per node plus the end
+    fanin          driving node index of every gate input
+    fanout_starts  CSR offsets into fanout (built on demand)
+    fanout         driven node indices, grouped per node
+    name_starts    offsets of each node's UTF-8 name inside names
+    tables         truth table of every LUT node, by node index
+
+Nodes are kept in topological order: a gate may only read nodes added
+before it, so a single pass over the arrays simulates the whole netlist.
+NodeView objects give the familiar gate-like view of a node, but they are
+created on demand and hold nothing but the store and an index.
+
+save() writes the same arrays, back to back, to a binary file, and open()
+maps such a file into memory: the arrays become read-only memoryviews of
+the mapping, so opening is O(1) whatever the netlist size, and worker
+processes opening the same file share its pages through the page cache.
+The layout is a header (see _HEADER) followed by these sections, each
+padded to 8 bytes: types (int8), fanin_starts, fanin, fanout_starts,
+fanout, name_starts (int64), names (UTF-8), inputs, outputs,
+output_name_starts (int64), output_names (UTF-8), then the LUT node
+indices (int64) and their tables (uint64, so LUTs of up to 6 inputs).
+Version 1 files, which have no LUT sections, can still be opened.
+"""
+
+import mmap
+import struct
+from array import array
+
+from logic_gate_part2 import (Circuit, GATE_CLASSES, NARY_CLASSES, OP_AND,
+                              OP_LUT, OP_NAND, OP_NOR, OP_NOT, OP_OR, OP_XNOR,
+                              OP_XOR, lut_packed, make_gate)
+
+# Node type of a primary input
+INPUT = -1
+
+# Magic, format version, then the number of nodes, fan-in entries, name
+# bytes, inputs, outputs, output name bytes and LUT nodes
+_HEADER = struct.Struct("<8sI4x7q")
+# The header of version 1, before LUTs
+_HEADER_V1 = struct.Struct("<8sI4x6q")
+_MAGIC = b"LGSTORE\0"
+_VERSION = 2
+
+# Widest LUT whose table fits a section entry
+_FILE_LUT_INPUTS = 6
+
+TYPE_NAMES = {INPUT: "INPUT", OP_NOT: "NOT", OP_AND: "AND", OP_OR: "OR",
+              OP_XOR: "XOR", OP_NAND: "NAND", OP_NOR: "NOR", OP_XNOR: "XNOR",
+              OP_LUT: "LUT"}
+
+# Packed kernel per gate type, for any fan-in
+_KERNELS = {opcode: NARY_CLASSES.get(opcode, gate_class).evaluate_packed
+            for opcode, gate_class in GATE_CLASSES.items()}
+
+
+class NodeView:
+    """A lightweight, on-demand view of one node of a CircuitStore"""
+
+    __slots__ = ("_store", "_index")
+
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+
+    def __eq__(self, other):
+        return (isinstance(other, NodeView) and other._store is self._store
+                and other._index == self._index)
+
+    def __hash__(self):
+        return hash((id(self._store), self._index))
+
+    def __str__(self):
+        fanin = ", ".join(str(index) for index in self._store.fanin(self._index))
+        return (f"Node {self._index} {self.type_name} {self.name}: "
+                f"fanin=[{fanin}]")
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def type(self):
+        return self._store.type(self._index)
+
+    @property
+    def type_name(self):
+        return TYPE_NAMES[self.type]
+
+    @property
+    def name(self):
+        return self._store.name(self._index)
+
+    @property
+    def table(self):
+        """Truth table of a LUT node, else None"""
+        return self._store.table(self._index)
+
+    @property
+    def fanin(self):
+        return [NodeView(self._store, index)
+                for index in self._store.fanin(self._index)]
+
+    @property
+    def fanout(self):
+        return [NodeView(self._store, index)
+                for index in self._store.fanout(self._index)]
+
+
+class CircuitStore:
+    """A netlist held in contiguous arrays instead of gate objects"""
+
+    def __init__(self):
+        self._types = array("b")
+        self._fanin_starts = array("q", [0])
+        self._fanin = array("q")
+        self._name_starts = array("q", [0])
+        self._names = bytearray()
+        self._inputs = array("q")
+        self._outputs = array("q")
+        self._output_names = []
+        # LUT node index -> truth table
+        self._tables = {}
+        # The LUT sections of a store made by open(), read into _tables
+        # when first needed
+        self._lut_sections = None
+        # Fanout CSR, built from the fan-in arrays when first needed
+        self._fanout_starts = None
+        self._fanout = None
+        # The mapping backing the arrays of a store made by open()
+        self._mmap = None
+
+    def __len__(self):
+        return len(self._types)
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError("node index out of range")
+        return NodeView(self, index % len(self))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield NodeView(self, index)
+
+    def __str__(self):
+        return (f"CircuitStore: {len(self._inputs)} inputs, "
+                f"{len(self) - len(self._inputs)} gates, "
+                f"{len(self._outputs)} outputs")
+
+    @property
+    def inputs(self):
+        """Node indices of the primary inputs, in order"""
+        return memoryview(self._inputs).toreadonly()
+
+    @property
+    def outputs(self):
+        """Node indices of the primary outputs, in order"""
+        return memoryview(self._outputs).toreadonly()
+
+    @property
+    def output_names(self):
+        return tuple(self._output_names)
+
+    @property
+    def gate_count(self):
+        return len(self) - len(self._inputs)
+
+    # Building
+
+    def _add_node(self, kind, fanin, name):
+        if self._mmap is not None:
+            raise TypeError("A memory-mapped CircuitStore is read-only")
+        self._types.append(kind)
+        self._fanin.extend(fanin)
+        self._fanin_starts.append(len(self._fanin))
+        self._names += name.encode()
+        self._name_starts.append(len(self._names))
+        self._fanout_starts = self._fanout = None
+        return len(self._types) - 1
+
+    def add_input(self, name=""):
+        """Add a primary input node and return its index"""
+        index = self._add_node(INPUT, (), name)
+        self._inputs.append(index)
+        return index
+
+    def add_gate(self, opcode, fanin, name="", table=None):
+        """Add a gate reading the nodes in fanin and return its index
+
+        A LUT (OP_LUT) gate also needs its truth table (see LutGate).
+        """
+        if opcode not in GATE_CLASSES and opcode != OP_LUT:
+            raise ValueError(f"Unknown gate opcode {opcode!r}")
+        if opcode == OP_LUT:
+            if not isinstance(table, int):
+                raise TypeError("A LUT gate needs an int truth table")
+            if not fanin or not 0 <= table < 1 << (1 << len(fanin)):
+                raise ValueError(f"Bad truth table for a LUT of "
+                                 f"{len(fanin)} inputs")
+        elif opcode == OP_NOT and len(fanin) != 1:
+            raise ValueError(f"NOT gate needs 1 input, got {len(fanin)}")
+        elif opcode != OP_NOT and len(fanin) < 2:
+            raise ValueError(f"{TYPE_NAMES[opcode]} gate needs at least 2 "
+                             f"inputs, got {len(fanin)}")
+        for source in fanin:
+            if not 0 <= source < len(self._types):
+                raise ValueError(f"Fan-in {source} is not an existing node; "
+                                 f"nodes must be added in topological order")
+        index = self._add_node(opcode, fanin, name)
+        if opcode == OP_LUT:
+            self._tables[index] = table
+        return index
+
+    def add_output(self, index, name=""):
+        """Mark an existing node as a primary output"""
+        if not 0 <= index < len(self._types):
+            raise IndexError("node index out of range")
+        if self._mmap is not None:
+            raise TypeError("A memory-mapped CircuitStore is read-only")
+        self._outputs.append(index)
+        self._output_names.append(name)
+
+    # Traversal
+
+    def type(self, index):
+        return self._types[index]
+
+    def name(self, index):
+        return str(self._names[self._name_starts[index]:
+                               self._name_starts[index + 1]], "utf-8")
+
+    def table(self, index):
+        """Return the truth table of LUT node index, else None"""
+        return self._lut_tables().get(index)
+
+    def _lut_tables(self):
+        if self._lut_sections is not None:
+            self._tables = dict(zip(*self._lut_sections))
+            self._lut_sections = None
+        return self._tables
+
+    def fanin(self, index):
+        return self._fanin[self._fanin_starts[index]:
+                           self._fanin_starts[index + 1]]
+
+    def fanout(self, index):
+        if self._fanout_starts is None:
+            self._build_fanout()
+        return self._fanout[self._fanout_starts[index]:
+                            self._fanout_starts[index + 1]]
+
+    def _build_fanout(self):
+        # Counting sort of the (source, sink) pairs by source
+        count = len(self._types)
+        starts = array("q", bytes(8 * (count + 1)))
+        for source in self._fanin:
+            starts[source + 1] += 1
+        for index in range(count):
+            starts[index + 1] += starts[index]
+        fanout = array("q", bytes(8 * len(self._fanin)))
+        position = array("q", starts)
+        fanin_starts = self._fanin_starts
+        for sink in range(count):
+            for offset in range(fanin_starts[sink], fanin_starts[sink + 1]):
+                source = self._fanin[offset]
+                fanout[position[source]] = sink
+                position[source] += 1
+        self._fanout_starts = starts
+        self._fanout = fanout
+
+    # Simulation
+
+    def simulate(self, values, width=1):
+        """Return the value of every node, in node order.
+
+        values holds one bool (or packed int, with width > 1) per primary
+        input.  Gates have the same semantics as the gate classes of their
+        type (see GATE_CLASSES and NARY_CLASSES).
+        """
+        if len(values) != len(self._inputs):
+            raise ValueError(f"Expected {len(self._inputs)} input values, "
+                             f"got {len(values)}")
+        mask = (1 << width) - 1
+        signals = []
+        append = signals.append
+        next_input = iter(values).__next__
+        starts = self._fanin_starts
+        fanin = self._fanin
+        for index, kind in enumerate(self._types):
+            if kind == INPUT:
+                append(int(next_input()) & mask)
+                continue
+            start = starts[index]
+            end = starts[index + 1]
+            a = signals[fanin[start]]
+            if kind == OP_NOT:
+                append(a ^ mask)
+            elif kind == OP_LUT:
+                append(lut_packed(self.table(index), mask,
+                                  [signals[source]
+                                   for source in fanin[start:end]]))
+            elif end - start != 2:
+                append(_KERNELS[kind](mask, *[signals[source]
+                                              for source in fanin[start:end]]))
+            elif kind == OP_AND:
+                append(a & signals[fanin[start + 1]])
+            elif kind == OP_XOR:
+                append(a ^ signals[fanin[start + 1]])
+            elif kind == OP_OR:
+                append(a | signals[fanin[start + 1]])
+            else:
+                append(_KERNELS[kind](mask, a, signals[fanin[start + 1]]))
+        return signals
+
+    def evaluate(self, values, width=1):
+        """Simulate and return only the primary output values"""
+        signals = self.simulate(values, width)
+        if width == 1:
+            return [bool(signals[index]) for index in self._outputs]
+        return [signals[index] for index in self._outputs]
+
+    # Binary files
+
+    def save(self, path):
+        """Write the store to a binary file that open() can map"""
+        if self._fanout_starts is None:
+            self._build_fanout()
+        output_names = bytearray()
+        output_name_starts = array("q", [0])
+        for name in self._output_names:
+            output_names += name.encode()
+            output_name_starts.append(len(output_names))
+        tables = self._lut_tables()
+        for index in tables:
+            if len(self.fanin(index)) > _FILE_LUT_INPUTS:
+                raise ValueError(f"LUT node {index} has more than "
+                                 f"{_FILE_LUT_INPUTS} inputs, too many for "
+                                 f"a CircuitStore file")
+        lut_nodes = array("q", tables)
+        lut_tables = array("Q", tables.values())
+        sections = [self._types, self._fanin_starts, self._fanin,
+                    self._fanout_starts, self._fanout, self._name_starts,
+                    self._names, self._inputs, self._outputs,
+                    output_name_starts, output_names, lut_nodes, lut_tables]
+        with open(path, "wb") as fp:
+            fp.write(_HEADER.pack(_MAGIC, _VERSION, len(self._types),
+                                  len(self._fanin), len(self._names),
+                                  len(self._inputs), len(self._outputs),
+                                  len(output_names), len(lut_nodes)))
+            for section in sections:
+                data = memoryview(section).cast("B")
+                fp.write(data)
+                fp.write(bytes(-len(data) % 8))
+
+    @classmethod
+    def open(cls, path):
+        """Map a file written by save() and return a read-only store"""
+        with open(path, "rb") as fp:
+            mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapping)
+        if len(view) < _HEADER_V1.size:
+            raise ValueError(f"{path} is not a CircuitStore file")
+        magic, version = struct.unpack_from("<8sI", view)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not a CircuitStore file")
+        if version == 1:
+            header = _HEADER_V1.unpack_from(view)
+            luts = 0
+            offset = _HEADER_V1.size
+        elif version == _VERSION and len(view) >= _HEADER.size:
+            header = _HEADER.unpack_from(view)
+            luts = header[-1]
+            offset = _HEADER.size
+        else:
+            raise ValueError(f"Unsupported CircuitStore version {version}")
+        nodes, fanin, names, inputs, outputs, output_names = header[2:8]
+
+        def section(count, size, typecode):
+            nonlocal offset
+            start = offset
+            offset += count * size + (-count * size % 8)
+            if offset > len(view):
+                raise ValueError(f"{path} is truncated")
+            return view[start:start + count * size].cast(typecode)
+
+        store = cls.__new__(cls)
+        store._mmap = mapping
+        store._types = section(nodes, 1, "b")
+        store._fanin_starts = section(nodes + 1, 8, "q")
+        store._fanin = section(fanin, 8, "q")
+        store._fanout_starts = section(nodes + 1, 8, "q")
+        store._fanout = section(fanin, 8, "q")
+        store._name_starts = section(nodes + 1, 8, "q")
+        store._names = section(names, 1, "B")
+        store._inputs = section(inputs, 8, "q")
+        store._outputs = section(outputs, 8, "q")
+        name_starts = section(outputs + 1, 8, "q")
+        blob = section(output_names, 1, "B")
+        store._output_names = [str(blob[name_starts[i]:name_starts[i + 1]],
+                                   "utf-8") for i in range(outputs)]
+        store._lut_sections = (section(luts, 8, "q"), section(luts, 8, "Q"))
+        return store
+
+    @staticmethod
+    def is_store_file(path):
+        """Return whether path starts like a file written by save()"""
+        with open(path, "rb") as fp:
+            return fp.read(len(_MAGIC)) == _MAGIC
+
+    # Conversion to and from gate objects
+
+    @classmethod
+    def from_circuit(cls, circuit):
+        """Build a store from a Circuit.
+
+        Every input port of the circuit becomes one INPUT node and every
+        output port an output, keeping the port names.  Any other undriven
+        gate input gets an INPUT node of its own.  Only combinational
+        circuits fit; save circuits with flip-flops as BLIF instead.
+        """
+        circuit._require_acyclic("CircuitStore")
+        if circuit.flip_flops():
+            raise ValueError("CircuitStore holds combinational logic only, "
+                             "not flip-flops")
+        store = cls()
+        nodes = {}
+        for name, inputs in circuit.input_ports().items():
+            index = store.add_input(name)
+            for input_ in inputs:
+                nodes[input_] = index
+        for input_ in circuit.primary_inputs():
+            if input_ not in nodes:
+                position = input_.owner.inputs.index(input_)
+                nodes[input_] = store.add_input(
+                    f"{input_.owner.name}.in{position}")
+        for gate in circuit.topological_order():
+            fanin = [nodes[input_] if input_ in nodes
+                     else nodes[input_.driver] for input_ in gate.inputs]
+            nodes[gate.output] = store.add_gate(
+                gate.OPCODE, fanin, gate.name,
+                gate.table if gate.OPCODE == OP_LUT else None)
+        for name, output in circuit.output_ports().items():
+            store.add_output(nodes[output], name)
+        return store
+
+    def to_circuit(self, mode=Circuit.IMMEDIATE):
+        """Build gate objects for this store.
+
+        Input nodes and outputs become the circuit's named ports.  Returns
+        (circuit, input_groups): input_groups holds, for each primary input
+        node, the tuple of gate Inputs it feeds (the format
+        Circuit.evaluate_batch takes as input_order).
+        """
+        circuit = Circuit(mode)
+        groups, outputs = self.build_into(circuit)
+        for index, group in zip(self._inputs, groups):
+            circuit.add_input_port(self.name(index) or f"in{index}", *group)
+        for position, (output, name) in enumerate(zip(outputs,
+                                                      self._output_names)):
+            circuit.add_output_port(name or f"out{position}", output)
+        return circuit, groups
+
+    def build_into(self, circuit, prefix=""):
+        """Add gate objects for this store to an existing circuit.
+
+        Gate names get prefix in front.  No ports are declared; instead
+        returns (input_groups, outputs): the tuple of gate Inputs fed by
+        each primary input node, and the Output of each primary output.
+        """
+        gates = [None] * len(self)
+        groups = {index: [] for index in self._inputs}
+        for index, kind in enumerate(self._types):
+            if kind == INPUT:
+                continue
+            fanin = self.fanin(index)
+            gate = make_gate(kind, prefix + self.name(index), circuit,
+                             len(fanin), self.table(index))
+            gates[index] = gate
+            for input_, source in zip(gate.inputs, fanin):
+                if gates[source] is not None:
+                    gates[source].output.connect(input_)
+                else:
+                    groups[source].append(input_)
+        return ([tuple(groups[index]) for index in self._inputs],
+                [gates[index].output for index in self._outputs])
+
+
+def test():
+    """Umbrella test function"""
+    tests = [
+        test_round_trip,
+        test_large_store,
+        test_binary_file,
+        test_wide_gates,
+        test_lut_gates,
+    ]
+    for t in tests:
+        print("Running " + t.__name__ + " " + "-" * 20)
+        t()
+
+
+def test_round_trip():
+    from logic_gate_part2 import build_full_adder, exhaustive_stimulus
+
+    circuit = Circuit()
+    build_full_adder(circuit)
+    store = CircuitStore.from_circuit(circuit)
+    print(store)
+    for node in store:
+        print(node)
+    patterns, width = exhaustive_stimulus(circuit.primary_inputs())
+    signals = circuit.simulate_packed(patterns, width)
+    expected = [signals[output] for output in circuit.primary_outputs()]
+    values = [patterns[input_] for input_ in circuit.primary_inputs()]
+    assert store.evaluate(values, width) == expected
+    rebuilt, groups = store.to_circuit()
+    print(f"Rebuilt circuit has {len(rebuilt)} gates and cost {rebuilt.cost}")
+    print(f"Ports: {list(rebuilt.input_ports())} -> "
+          f"{list(rebuilt.output_ports())}")
+    stimulus = {input_: patterns[original]
+                for original, group in zip(circuit.primary_inputs(), groups)
+                for input_ in group}
+    signals = rebuilt.simulate_packed(stimulus, width)
+    assert [signals[output]
+            for output in rebuilt.output_ports().values()] == expected
+
+
+def test_large_store():
+    import random
+    import time
+
+    random.seed(10)
+    start = time.perf_counter()
+    store = CircuitStore()
+    for _ in range(64):
+        store.add_input()
+    for index in range(64, 200000):
+        opcode = random.choice((OP_NOT, OP_AND, OP_OR, OP_XOR))
+        arity = 1 if opcode == OP_NOT else 2
+        store.add_gate(opcode, [random.randrange(index - 64, index)
+                                for _ in range(arity)])
+    store.add_output(len(store) - 1)
+    built = time.perf_counter()
+    fanout = sum(len(store.fanout(index)) for index in range(len(store)))
+    traversed = time.perf_counter()
+    signals = store.simulate([random.getrandbits(64) for _ in range(64)], 64)
+    simulated = time.perf_counter()
+    print(f"{store}: built in {built - start:.2f}s, {fanout} fanout edges "
+          f"in {traversed - built:.2f}s, 64 vectors simulated in "
+          f"{simulated - traversed:.2f}s")
+    assert fanout == sum(len(store.fanin(index)) for index in range(len(store)))
+    assert len(signals) == len(store)
+
+
+def test_binary_file():
+    import os
+    import tempfile
+    import time
+
+    from logic_gate_part2 import build_ripple_adder
+
+    circuit = Circuit()
+    a_ports, b_ports, ci_inputs, sums, carry = build_ripple_adder(circuit, 64)
+    store = CircuitStore.from_circuit(circuit)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "adder.lgs")
+        store.save(path)
+        start = time.perf_counter()
+        mapped = CircuitStore.open(path)
+        opened = time.perf_counter() - start
+        print(f"{mapped} ({os.path.getsize(path)} bytes) opened in "
+              f"{opened * 1e6:.0f}us")
+        values = [i % 3 == 0 for i in range(len(store.inputs))]
+        assert mapped.evaluate(values) == store.evaluate(values)
+        assert mapped.output_names == store.output_names
+        assert list(mapped.fanout(5)) == list(store.fanout(5))
+        loaded = Circuit.load(path)
+        print(f"Loaded as a Circuit with {len(loaded)} gates, cost "
+              f"{loaded.cost}")
+        assert loaded.to_store().evaluate(values) == store.evaluate(values)
+        from logic_gate_compiled import CompiledCircuit
+        compiled = CompiledCircuit.from_store(mapped)
+        print(compiled)
+        assert compiled.run(values) == store.evaluate(values)
+
+
+def test_wide_gates():
+    import random
+
+    random.seed(20)
+    store = CircuitStore()
+    for k in range(8):
+        store.add_input(f"x{k}")
+    for opcode in (OP_AND, OP_OR, OP_XOR, OP_NAND, OP_NOR, OP_XNOR):
+        for fan_in in (2, 5):
+            store.add_output(store.add_gate(
+                opcode, random.sample(range(len(store)), fan_in),
+                f"{TYPE_NAMES[opcode].lower()}{fan_in}"))
+    circuit, groups = store.to_circuit()
+    print(f"{store} -> {sorted(circuit.cost_report()['by_type'])}")
+    values = [random.getrandbits(64) for _ in range(8)]
+    stimulus = {input_: value for group, value in zip(groups, values)
+                for input_ in group}
+    signals = circuit.simulate_packed(stimulus, 64)
+    assert ([signals[output] for output in circuit.output_ports().values()]
+            == store.evaluate(values, 64))
+    from logic_gate_compiled import CompiledCircuit
+    compiled = CompiledCircuit.from_store(store)
+    assert compiled.run(values, 64) == store.evaluate(values, 64)
+    assert (list(compiled.to_function()(*values, mask=(1 << 64) - 1))
+            == store.evaluate(values, 64))
+
+
+def test_lut_gates():
+    import os
+    import tempfile
+
+    from logic_gate_part2 import build_random_logic
+
+    circuit = Circuit()
+    build_random_logic(circuit, 10, 120, seed=22)
+    mapped, _ = circuit.map_luts(4)
+    store = CircuitStore.from_circuit(mapped)
+    print(f"{store}: {[node.table for node in store][10:14]} ...")
+    values = [0x5A5A, 0x3C3C, 0x0FF0, 0xFFFF, 0, 0x1234, 0xBEEF, 0x8001,
+              0x7777, 0xC0DE]
+    expected = circuit.to_store().evaluate(values, 16)
+    assert store.evaluate(values, 16) == expected
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "luts.lgs")
+        store.save(path)
+        opened = CircuitStore.open(path)
+        assert opened.evaluate(values, 16) == expected
+        from logic_gate_compiled import CompiledCircuit
+        assert CompiledCircuit.from_store(opened).run(values, 16) == expected
+        rebuilt, _ = opened.to_circuit()
+        assert rebuilt.to_store().evaluate(values, 16) == expected
+
+
+if __name__ == '__main__':
+    test()